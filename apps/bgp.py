@@ -1,6 +1,5 @@
-from ravel.app import AppConsole, mk_watchcmd
+from ravel.app import AppConsole, mk_watchcmd, print_query
 import psycopg2
-import tabulate
 import re
 
 rib_file = './topo/RouteView/rib.txt'
@@ -23,11 +22,7 @@ class BGPConsole(AppConsole):
             return
 
         try:
-            self.db.cursor.execute("select * from output;")
-            data = self.db.cursor.fetchall()
-            if data is not None:
-                names = [row[0] for row in self.db.cursor.description]
-                print(tabulate.tabulate(data, headers=names))
+            print_query(self.db, "select * from output;")
         except psycopg2.ProgrammingError:
             # no results, eg from an insert/delete
             pass
@@ -332,11 +327,7 @@ class BGPConsole(AppConsole):
 
         try:
             print('\n************************************************************************')
-            self.db.cursor.execute("select * from {};".format(new_name))
-            data = self.db.cursor.fetchall()
-            if data is not None:
-                names = [row[0] for row in self.db.cursor.description]
-                print(tabulate.tabulate(data, headers=names))
+            print_query(self.db, "select * from {};".format(new_name))
             print('************************************************************************')
         except psycopg2.ProgrammingError:
             # no results, eg from an insert/delete
@@ -419,11 +410,7 @@ class BGPConsole(AppConsole):
         
         try:
             print('\n************************************************************************')
-            self.db.cursor.execute("select * from {};".format(name))
-            data = self.db.cursor.fetchall()
-            if data is not None:
-                names = [row[0] for row in self.db.cursor.description]
-                print(tabulate.tabulate(data, headers=names))
+            print_query(self.db, "select * from {};".format(name))
             print('************************************************************************')
         except psycopg2.ProgrammingError:
             # no results, eg from an insert/delete
@@ -2,13 +2,26 @@ import cmd
 from ravel.app import AppConsole
 
 class FirewallConsole(AppConsole):
+    def __init__(self, db, env, components):
+        AppConsole.__init__(self, db, env, components)
+        self.db.register("fw_user_insert",
+                         "INSERT INTO FW_policy_user VALUES ($1)",
+                         ["integer"])
+        self.db.register("fw_user_delete",
+                         "DELETE FROM FW_policy_user WHERE uid=$1",
+                         ["integer"])
+        self.db.register("fw_acl_insert",
+                         "INSERT INTO FW_policy_acl VALUES ($1, $2, 1)",
+                         ["integer", "integer"])
+        self.db.register("fw_acl_delete",
+                         "DELETE FROM FW_policy_acl WHERE end1=$1 AND end2=$2",
+                         ["integer", "integer"])
+
     def _getHostId(self, hname):
-        hostnames = self.env.provider.cache_name
-        if hname not in hostnames:
+        hid = self.env.provider.node_id(hname)
+        if hid is None:
             print("Unknown host", hname)
-            return None
-
-        return hostnames[hname]
+        return hid
 
     def do_addhost(self, line):
         """Add a host to the whitelist
@@ -23,8 +36,7 @@ class FirewallConsole(AppConsole):
             return
 
         try:
-            self.db.cursor.execute("INSERT INTO FW_policy_user VALUES ({0});"
-                                   .format(hostid))
+            self.db.query("fw_user_insert", hostid)
         except Exception as e:
             print("Failure: host not added --", e)
             return
@@ -44,8 +56,7 @@ class FirewallConsole(AppConsole):
             return
 
         try:
-            self.db.cursor.execute("DELETE FROM FW_policy_user WHERE uid={0};"
-                                   .format(hostid))
+            self.db.query("fw_user_delete", hostid)
         except Exception as e:
             print("Failure: host not removed --", e)
             return
@@ -66,9 +77,7 @@ class FirewallConsole(AppConsole):
             return
 
         try:
-            self.db.cursor.execute("INSERT INTO FW_policy_acl VALUES "
-                                   "({0},{1},1);"
-                                   .format(src, dst))
+            self.db.query("fw_acl_insert", src, dst)
         except Exception as e:
             print("Failure: flow not added --", e)
             return
@@ -89,9 +98,7 @@ class FirewallConsole(AppConsole):
             return
 
         try:
-            self.db.cursor.execute("DELETE FROM FW_policy_acl VALUES WHERE "
-                                   "end1={0} AND end2={1};"
-                                   .format(src, dst))
+            self.db.query("fw_acl_delete", src, dst)
         except Exception as e:
             print("Failure: flow not removed --", e)
             return
@@ -17,15 +17,14 @@ class MyRoutingConsole(AppConsole):
             print("Invalid syntax")
             return
 
-        hostnames = self.env.provider.cache_name
-        src = args[0]
-        dst = args[1]
-        if src not in hostnames:
-            print("Unknown host", src)
+        src = self.env.provider.node_id(args[0])
+        if src is None:
+            print("Unknown host", args[0])
             return
 
-        if dst not in hostnames:
-            print("Unknown host", dst)
+        dst = self.env.provider.node_id(args[1])
+        if dst is None:
+            print("Unknown host", args[1])
             return
 
         fw = 1
@@ -40,8 +39,6 @@ class MyRoutingConsole(AppConsole):
                 print("Invalid firewall option:", fw)
                 return
 
-        src = hostnames[src]
-        dst = hostnames[dst]
         try:
             self.db.cursor.execute("SELECT MAX(fid) FROM my_rm;")
             fid = self.db.cursor.fetchall()[0][0]
@@ -59,18 +56,17 @@ class MyRoutingConsole(AppConsole):
         print("Success: installed flow with fid", fid)
 
     def _delFlowByName(self, src, dst):
-        hostnames = self.env.provider.cache_name
-
-        if src not in hostnames:
-            print("Unknown host", src)
+        srcname, dstname = src, dst
+        src = self.env.provider.node_id(srcname)
+        if src is None:
+            print("Unknown host", srcname)
             return
 
-        if dst not in hostnames:
-            print("Unknown host", dst)
+        dst = self.env.provider.node_id(dstname)
+        if dst is None:
+            print("Unknown host", dstname)
             return
 
-        src = hostnames[src]
-        dst = hostnames[dst]
         self.db.cursor.execute("SELECT fid FROM my_rm WHERE src={0} and dst={1};"
                                .format(src, dst))
         result = self.db.cursor.fetchall()
@@ -5,6 +5,7 @@ Orchestration is a core application that is enabled by default.
 """
 
 import os
+import time
 from itertools import tee
 from ravel.app import AppConsole, discoverComponents
 from ravel.log import logger
@@ -77,6 +78,12 @@ class OrchConsole(AppConsole):
         self.sql = None
         self._auto = False
         AppConsole.__init__(self, db, env, components)
+        self.db.register("orch_violations",
+                         "SELECT violation FROM app_violation WHERE app=$1",
+                         ["varchar"])
+        self.db.register("orch_violations_delete",
+                         "DELETE FROM app_violation WHERE app=$1",
+                         ["varchar"])
 
     @property
     def auto(self):
@@ -112,19 +119,28 @@ class OrchConsole(AppConsole):
 
     def do_run(self, line):
         "Execute the orchestration protocol"
-        if self.ordering is None:
+        if not self.ordering:
             print("Must first set ordering")
             return
 
         try:
-            self.db.cursor.execute("SELECT MAX(counts) FROM clock;")
-            count = self.db.cursor.fetchall()[0][0] + 1
-            hipri = self.ordering[-1]
-
-            self.db.cursor.execute("INSERT INTO p_{0} VALUES ({1}, 'on');"
-                                   .format(hipri, count))
+            fids = [row[0] for row in
+                    self.db.query("rm_delta_adds").fetchall()]
+            since = time.time()
+            count = self.db.query("clock_max").fetchall()[0][0] + 1
+            self.db.query("orch_run", count)
         except Exception as e:
             print(e)
+            return
+
+        # wait for the switches to confirm new flows, unless there is no
+        # network or controller to confirm them
+        opts = self.env.opts
+        if fids and not (opts.onlydb or opts.noctl):
+            pending = self.db.wait_flows(fids, since)
+            if pending:
+                logger.warning("flows not confirmed by switches: %s",
+                               " ".join(str(fid) for fid in pending))
 
     def do_list(self, line):
         "List orchestrated applications and their priority"
@@ -175,8 +191,7 @@ class OrchConsole(AppConsole):
         for app in [x for x in ordering if x != "routing"]:
             sql += ptable_template.format(app)
             try:
-                self.db.cursor.execute("SELECT violation FROM app_violation WHERE app = '{0}';".format(app))
-                violations = self.db.cursor.fetchall()
+                violations = self.db.query("orch_violations", app).fetchall()
                 if len(violations) > 0:
                     vtable = violations[0][0]
                     for v in violations[1:]:
@@ -197,6 +212,10 @@ class OrchConsole(AppConsole):
 
         self.ordering = [x for x in reversed(ordering)]
         self.sql = sql
+        self.db.register("orch_run",
+                         "INSERT INTO p_{0} VALUES ($1, 'on')"
+                         .format(self.ordering[-1]),
+                         ["integer"])
 
         log = resource_file("orch_log.sql")
         f = open(log, 'w')
@@ -218,7 +237,7 @@ class OrchConsole(AppConsole):
         apps = line.split()
         for app in apps:
             try:
-                self.db.cursor.execute("DELETE FROM app_violation WHERE app = '{0}'".format(app))
+                self.db.query("orch_violations_delete", app)
             except Exception as e:
                 print(e)
             self.ordering.remove(app.lower())
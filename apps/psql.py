@@ -7,11 +7,18 @@ PostgreSQL sub-shell is a core application that is enabled by default.
 import psycopg2
 import tabulate
 
-from ravel.app import AppConsole
+from ravel.app import AppConsole, is_select, print_query
 
 class PSqlConsole(AppConsole):
     def default(self, line):
         "Execute a PostgreSQL statement"
+        if is_select(line):
+            try:
+                print_query(self.db, line)
+            except psycopg2.Error as e:
+                print(e)
+            return
+
         try:
             self.db.cursor.execute(line)
         except psycopg2.ProgrammingError as e:
@@ -2,6 +2,8 @@
 Routing sub-shell.
 """
 
+import time
+
 from ravel.app import AppConsole
 from ravel.log import logger
 
@@ -10,22 +12,34 @@ class RoutingConsole(AppConsole):
         AppConsole.__init__(self, db, env, components)
 
     def do_addflow(self, line):
-        """Add a flow between two hosts, using Mininet hostnames
-           Usage: addflow [host1] [host2]"""
+        """Add a flow between two hosts, using Mininet hostnames.  With
+           --wait, orchestrate the flow and wait for the switches to confirm
+           its installation (requires orch auto on)
+           Usage: addflow [--wait] [host1] [host2] [firewall]"""
         args = line.split()
+        wait = "--wait" in args
+        if wait:
+            args.remove("--wait")
+
+            # the flow is only installed once orchestration runs
+            orch = self.env.loaded.get("orch")
+            if orch is None or not orch.console.auto:
+                print("Invalid option --wait: flows are installed by "
+                      "orchestration, enable it with orch auto on")
+                return
+
         if len(args) != 2 and len(args) != 3:
             print("Invalid syntax")
             return
 
-        hostnames = self.env.provider.cache_name
-        src = args[0]
-        dst = args[1]
-        if src not in hostnames:
-            print("Unknown host", src)
+        src = self.env.provider.node_id(args[0])
+        if src is None:
+            print("Unknown host", args[0])
             return
 
-        if dst not in hostnames:
-            print("Unknown host", dst)
+        dst = self.env.provider.node_id(args[1])
+        if dst is None:
+            print("Unknown host", args[1])
             return
 
         fw = 1
@@ -40,40 +54,43 @@ class RoutingConsole(AppConsole):
                 print("Invalid firewall option:", fw)
                 return
 
-        src = hostnames[src]
-        dst = hostnames[dst]
         try:
-            self.db.cursor.execute("SELECT MAX(fid) FROM rm;")
-            fid = self.db.cursor.fetchall()[0][0]
+            fid = self.db.query("rm_max_fid").fetchall()[0][0]
             if fid is None:
                 fid = 0
 
             fid += 1
-            self.db.cursor.execute("INSERT INTO rm (fid, src, dst, FW) "
-                                   "VALUES ({0}, {1}, {2}, {3});"
-                                   .format(fid, src, dst, fw))
+            since = time.time()
+            self.db.query("rm_insert", fid, src, dst, fw)
         except Exception as e:
             print("Failure: flow not installed --", e)
             return
 
+        # orchestrate now rather than after this command returns, so the
+        # flow's path is in cf when waiting.  There are no switches to
+        # confirm flows without a network or controller
+        opts = self.env.opts
+        if wait and not (opts.onlydb or opts.noctl):
+            orch.console.onecmd("run")
+            if self.db.wait_flows([fid], since):
+                print("Failure: flow with fid", fid, "not confirmed")
+                return
+
         print("Success: installed flow with fid", fid)
 
     def _delFlowByName(self, src, dst):
-        hostnames = self.env.provider.cache_name
-
-        if src not in hostnames:
-            print("Unknown host", src)
+        srcname, dstname = src, dst
+        src = self.env.provider.node_id(srcname)
+        if src is None:
+            print("Unknown host", srcname)
             return
 
-        if dst not in hostnames:
-            print("Unknown host", dst)
+        dst = self.env.provider.node_id(dstname)
+        if dst is None:
+            print("Unknown host", dstname)
             return
 
-        src = hostnames[src]
-        dst = hostnames[dst]
-        self.db.cursor.execute("SELECT fid FROM rm WHERE src={0} and dst={1};"
-                               .format(src, dst))
-        result = self.db.cursor.fetchall()
+        result = self.db.query("rm_fids", src, dst).fetchall()
 
         if len(result) == 0:
             logger.warning("no flow installed for hosts {0},{1}".format(src, dst))
@@ -88,12 +105,11 @@ class RoutingConsole(AppConsole):
     def _delFlowById(self, fid):
         try:
             # does the flow exist?
-            self.db.cursor.execute("SELECT fid FROM rm WHERE fid={0}".format(fid))
-            if len(self.db.cursor.fetchall()) == 0:
+            if len(self.db.query("rm_fid", fid).fetchall()) == 0:
                 logger.warning("no flow installed with fid %s", fid)
                 return None
 
-            self.db.cursor.execute("DELETE FROM rm WHERE fid={0}".format(fid))
+            self.db.query("rm_delete", fid)
             return fid
         except Exception as e:
             print(e)
@@ -117,6 +133,37 @@ class RoutingConsole(AppConsole):
         else:
             print("Failure: flow not removed")
 
+    def do_wait(self, line):
+        """Wait for the switches to confirm installation of flows
+           Usage: wait [flow id] ... [timeout=seconds]"""
+        args = line.split()
+        timeout = None
+        fids = []
+        for arg in args:
+            if arg.startswith("timeout="):
+                try:
+                    timeout = float(arg.split("=", 1)[1])
+                except ValueError:
+                    print("Invalid timeout", arg)
+                    return
+            else:
+                try:
+                    fids.append(int(arg))
+                except ValueError:
+                    print("Invalid flow id", arg)
+                    return
+
+        if len(fids) == 0:
+            print("Invalid syntax")
+            return
+
+        pending = self.db.wait_flows(fids, timeout=timeout)
+        if pending:
+            print("Failure: flows not confirmed --",
+                  " ".join(str(fid) for fid in pending))
+        else:
+            print("Success: flows confirmed")
+
 shortcut = "rt"
 description = "IP routing"
 console = RoutingConsole
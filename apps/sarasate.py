@@ -1,6 +1,5 @@
-from ravel.app import AppConsole, mk_watchcmd
+from ravel.app import AppConsole, mk_watchcmd, print_query
 import psycopg2
-import tabulate
 import re
 from z3 import *
 
@@ -17,11 +16,7 @@ class RelaAlgConsole(AppConsole):
             return
 
         try:
-            self.db.cursor.execute("select * from output;")
-            data = self.db.cursor.fetchall()
-            if data is not None:
-                names = [row[0] for row in self.db.cursor.description]
-                print(tabulate.tabulate(data, headers=names))
+            print_query(self.db, "select * from output;")
         except psycopg2.ProgrammingError:
             # no results, eg from an insert/delete
             pass
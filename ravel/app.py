@@ -12,6 +12,7 @@ import tempfile
 
 import psycopg2
 import sqlparse
+import tabulate
 from sqlparse.tokens import Keyword
 
 import ravel.util
@@ -53,6 +54,36 @@ def mk_watchcmd(db, args):
     cmd = "xterm -e " + watch
     return cmd, temp.name
 
+def is_select(sql):
+    """Check if a SQL statement returns rows and can be streamed with
+       ravel.db.RavelDb.stream
+       sql: a SQL statement
+       returns: true if the statement is a single SELECT query"""
+    parsed = [stmt for stmt in sqlparse.parse(sql) if str(stmt).strip()]
+    return len(parsed) == 1 and parsed[0].get_type() == "SELECT"
+
+def print_query(db, query, params=None, limit=None):
+    """Print the results of a query as a table, one page per batch of rows
+       fetched from a server-side cursor, so that memory use does not grow
+       with the size of the result
+       db: ravel.db.RavelDb instance on which to execute the query
+       query: a SELECT query
+       params: the query's parameters
+       limit: the maximum number of rows to print, defaults to RowLimit
+       from ravel.cfg"""
+    if limit is None and ravel.util.Config.DbRowLimit:
+        limit = ravel.util.Config.DbRowLimit
+
+    count = 0
+    for names, rows in db.stream(query, params, limit=limit):
+        if count > 0:
+            print("")
+        print(tabulate.tabulate(rows, headers=names))
+        count += len(rows)
+
+    if limit is not None and count >= limit:
+        print("({0} rows shown, limit reached)".format(count))
+
 class SqlObjMatch(object):
     """Regular expression for matching a SQL component within an application's
        SQL implementation"""
@@ -0,0 +1,256 @@
+"""
+In-process cache of the network topology.
+
+The cache loads the switches, hosts, ports and tp tables once, then applies
+row-level changes sent by database triggers (topo_notify_fun in base.sql)
+over LISTEN/NOTIFY.  Lookups are dictionary accesses and stay current without
+rescanning the tables.
+"""
+
+import json
+import select
+import threading
+
+import psycopg2
+
+from ravel.log import logger
+
+Channel = "ravel_topo"
+
+class TopologyCache(object):
+    "A cache of switches, hosts, ports and links kept current by notifications"
+
+    def __init__(self, db):
+        "db: a ravel.db.RavelDb instance"
+        self.db = db
+        self.switches = {}
+        self.hosts = {}
+        self.ports = {}
+        self.links = {}
+        self.dpids = {}
+        self.names = {}
+        self.ids = {}
+        self.running = False
+        self._lock = threading.RLock()
+        self._conn = None
+        self._handlers = { "switches" : self._switch,
+                           "hosts" : self._host,
+                           "ports" : self._port,
+                           "tp" : self._link
+        }
+
+    def load(self, tables=None):
+        """Load tables into the cache, replacing any cached rows
+           tables: a list of tables to load, defaults to all cached tables"""
+        if tables is None:
+            tables = list(self._handlers.keys())
+
+        # hold the lock from the select until the rows are applied, so a
+        # notification received meanwhile is applied after the reload
+        # rather than overwritten by it
+        cursor = self.db.cursor
+        for table in tables:
+            with self._lock:
+                cursor.execute("SELECT * FROM {0};".format(table))
+                names = [desc[0] for desc in cursor.description]
+                rows = [dict(zip(names, row)) for row in cursor.fetchall()]
+                self._clear(table)
+                for row in rows:
+                    self._handlers[table]("INSERT", row, None)
+
+        logger.debug("loaded topology cache: %s", ", ".join(tables))
+
+    def _clear(self, table):
+        if table == "switches":
+            for sid, sw in self.switches.items():
+                self.dpids.pop(sw["dpid"], None)
+                self._unname(sid, sw["name"])
+            self.switches = {}
+        elif table == "hosts":
+            for hid, host in self.hosts.items():
+                self._unname(hid, host["name"])
+            self.hosts = {}
+        elif table == "ports":
+            self.ports = {}
+        elif table == "tp":
+            self.links = {}
+
+    def _unname(self, nid, name):
+        if self.names.get(name) == nid:
+            del self.names[name]
+        if self.ids.get(nid) == name:
+            del self.ids[nid]
+
+    def _name(self, nid, name):
+        if name is not None:
+            self.names[name] = nid
+            self.ids[nid] = name
+
+    def _switch(self, op, row, old):
+        if old is not None:
+            self.dpids.pop(old["dpid"], None)
+            self._unname(old["sid"], old["name"])
+
+        if op == "DELETE":
+            self.switches.pop(row["sid"], None)
+            self.dpids.pop(row["dpid"], None)
+            self._unname(row["sid"], row["name"])
+        else:
+            self.switches[row["sid"]] = row
+            if row["dpid"] is not None:
+                self.dpids[row["dpid"]] = row["sid"]
+            self._name(row["sid"], row["name"])
+
+    def _host(self, op, row, old):
+        if old is not None:
+            self._unname(old["hid"], old["name"])
+
+        if op == "DELETE":
+            self.hosts.pop(row["hid"], None)
+            self._unname(row["hid"], row["name"])
+        else:
+            self.hosts[row["hid"]] = row
+            self._name(row["hid"], row["name"])
+
+    def _port(self, op, row, old):
+        if old is not None:
+            self.ports.pop((old["sid"], old["nid"]), None)
+
+        if op == "DELETE":
+            self.ports.pop((row["sid"], row["nid"]), None)
+        else:
+            self.ports[(row["sid"], row["nid"])] = row["port"]
+
+    def _link(self, op, row, old):
+        if old is not None:
+            self.links.pop((old["sid"], old["nid"]), None)
+
+        if op == "DELETE":
+            self.links.pop((row["sid"], row["nid"]), None)
+        else:
+            self.links[(row["sid"], row["nid"])] = row
+
+    def add_name(self, nid, name):
+        """Cache the name of a node before its row notification arrives
+           nid: the id of a switch or host
+           name: the node's name"""
+        with self._lock:
+            self._name(nid, name)
+
+    def remove_name(self, nid, name):
+        """Remove the name of a node before its row notification arrives
+           nid: the id of a switch or host
+           name: the node's name"""
+        with self._lock:
+            self._unname(nid, name)
+
+    def name_map(self):
+        "returns: a copy of the dictionary mapping node names to ids"
+        with self._lock:
+            return dict(self.names)
+
+    def id_map(self):
+        "returns: a copy of the dictionary mapping node ids to names"
+        with self._lock:
+            return dict(self.ids)
+
+    def apply(self, payload):
+        """Apply a change notification to the cache
+           payload: the JSON payload sent by topo_notify_fun"""
+        change = json.loads(payload)
+        table = change["table"]
+        if table not in self._handlers:
+            return
+
+        # a truncated table may be refilled in the same transaction (eg,
+        # restoring a snapshot), so reload it rather than clearing it
+        if change["op"] == "TRUNCATE":
+            self.load([table])
+            return
+
+        with self._lock:
+            self._handlers[table](change["op"],
+                                  change["row"],
+                                  change.get("old"))
+
+    def start(self):
+        "Start listening for changes in a new thread"
+        self._conn = self.db.connection(self)
+        self._conn.cursor().execute("LISTEN {0};".format(Channel))
+        self.running = True
+        self.t = threading.Thread(target=self._run)
+        self.t.daemon = True
+        self.t.start()
+
+    def _run(self):
+        while self.running:
+            try:
+                ready, _, _ = select.select([self._conn], [], [], 1.0)
+                if not ready:
+                    continue
+                self._conn.poll()
+            except (psycopg2.Error, ValueError) as e:
+                if self.running:
+                    logger.warning("topology cache stopped listening: %s", e)
+                break
+
+            while self._conn.notifies:
+                notify = self._conn.notifies.pop(0)
+                try:
+                    self.apply(notify.payload)
+                except (ValueError, KeyError) as e:
+                    logger.warning("bad topology notification %s: %s",
+                                   notify.payload, e)
+
+    def stop(self):
+        "Stop listening for changes"
+        if not self.running:
+            return
+
+        self.running = False
+        self.t.join()
+        try:
+            self._conn.cursor().execute("UNLISTEN {0};".format(Channel))
+        except psycopg2.Error:
+            pass
+        self.db.release(self)
+
+    def switch(self, sid):
+        """sid: a switch id
+           returns: the switch's row as a dictionary, or None"""
+        return self.switches.get(sid)
+
+    def switch_by_dpid(self, dpid):
+        """dpid: a datapath id
+           returns: the switch's row as a dictionary, or None"""
+        sid = self.dpids.get(dpid)
+        if sid is None:
+            return None
+        return self.switches.get(sid)
+
+    def host(self, hid):
+        """hid: a host id
+           returns: the host's row as a dictionary, or None"""
+        return self.hosts.get(hid)
+
+    def node_id(self, name):
+        """name: the name of a switch or host
+           returns: the node's id, or None"""
+        return self.names.get(name)
+
+    def node_name(self, nid):
+        """nid: the id of a switch or host
+           returns: the node's name, or None"""
+        return self.ids.get(nid)
+
+    def port(self, sid, nid):
+        """sid: a switch id
+           nid: the id of the next-hop node
+           returns: the outport on sid for nid, or None"""
+        return self.ports.get((sid, nid))
+
+    def link(self, sid, nid):
+        """sid: a switch id
+           nid: the id of the other end of the link
+           returns: the link's row from tp as a dictionary, or None"""
+        return self.links.get((sid, nid))
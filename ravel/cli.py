@@ -12,13 +12,14 @@ import sys
 import time
 from functools import partial
 
+import ravel.flow
 import ravel.mndeps
 import ravel.profiling
 from ravel.db import RavelDb, BASE_SQL
 from ravel.env import Environment
 from ravel.log import logger
 from ravel.of import PoxInstance
-from ravel.util import Config, resource_file
+from ravel.util import Config, ConnectionType, resource_file
 from ravel.cmdlog import cmdLogger
 
 class RavelConsole(cmd.Cmd):
@@ -38,6 +39,10 @@ class RavelConsole(cmd.Cmd):
         self.env.set_cli(self)
         self.logOn = False
 
+        # summaries of profiled commands, to compare repeated runs
+        self.profiles = {}
+        ravel.profiling.ProcessName = "cli"
+
     def default(self, line):
         "Check loaded applications before raising unknown command error"
 
@@ -149,28 +154,109 @@ class RavelConsole(cmd.Cmd):
                                            shortcut, description))
 
     def do_profile(self, line):
-        """Run command and report detailed execution time.
+        """Run command and report detailed execution time: the count,
+           percentiles and rate of each performance counter, compared with
+           the last profile of the same command.
+           Usage: profile [--save] [--dump file] [--trace file] command
+             --save: save the counters to the perf_counters table
+             --dump: save the counters to a binary file
+             --trace: export the counters as a Chrome trace (JSON)
            Note - if no counters are found, try enabling auto-orchestration
            with orch auto on"""
-        if line:
-            pe = ravel.profiling.ProfiledExecution()
-            pe.start()
-            self.onecmd(line)
+        save = False
+        files = {}
+        while line.startswith("--"):
+            parts = line.split(None, 2)
+            if parts[0] == "--save":
+                save = True
+                line = parts[1] if len(parts) > 1 else ""
+            elif parts[0] in ("--dump", "--trace") and len(parts) > 1:
+                files[parts[0]] = parts[1]
+                line = parts[2] if len(parts) > 2 else ""
+            else:
+                print("Invalid option {0}".format(parts[0]))
+                return
+
+        if not line:
+            print("Usage: profile [--save] [--dump file] [--trace file] "
+                  "command")
+            return
+
+        pe = ravel.profiling.ProfiledExecution()
+        pe.start()
+        self.onecmd(line)
+
+        # wait for straggling counters to report
+        time.sleep(0.5)
 
-            # wait for straggling counters to report
-            time.sleep(0.5)
+        pe.stop()
+        sys.stdout.write("\n")
 
-            pe.stop()
-            sys.stdout.write("\n")
-            pe.print_summary()
+        # compare against the last profile of the same command
+        pe.print_summary(self.profiles.get(line))
+        if pe.counters:
+            self.profiles[line] = pe.summary()
+
+        if save:
+            run = pe.save(self.env.db, line)
+            print("Saved counters to perf_counters, run {0}".format(run))
+        if "--dump" in files:
+            pe.dump(files["--dump"])
+            print("Saved counters to {0}".format(files["--dump"]))
+        if "--trace" in files:
+            pe.trace(files["--trace"])
+            print("Saved trace to {0}".format(files["--trace"]))
 
     def do_reinit(self, line):
-        "Reinitialize the database, deleting all data except topology"
-        self.env.db.truncate()
+        """Reinitialize the database, deleting all data except topology, or
+           restore the database from a snapshot
+           Usage: reinit [snapshot]"""
+        args = line.split()
+        if len(args) == 0:
+            self.env.db.truncate()
+        elif len(args) == 1:
+            self.env.db.restore(args[0])
+        else:
+            print("Invalid syntax")
+
+    def do_snapshot(self, line):
+        """Save, restore, list or delete snapshots of the database, including
+           tables of loaded applications
+           Usage: snapshot save [name]
+                  snapshot restore [name]
+                  snapshot delete [name]
+                  snapshot list"""
+        args = line.split()
+        if len(args) == 1 and args[0] == "list":
+            for name in self.env.db.snapshots():
+                print("  ", name)
+        elif len(args) == 2 and args[0] == "save":
+            if self.env.db.snapshot(args[1]):
+                print("Success: saved snapshot", args[1])
+        elif len(args) == 2 and args[0] == "restore":
+            if self.env.db.restore(args[1]):
+                print("Success: restored snapshot", args[1])
+        elif len(args) == 2 and args[0] == "delete":
+            if self.env.db.drop_snapshot(args[1]):
+                print("Success: deleted snapshot", args[1])
+        else:
+            print("Invalid syntax")
 
     def do_stat(self, line):
         "Show running configuration, state"
         print(self.env.pprint())
+        stats = self.env.db.pool.stats()
+        print("  db pool:", ", ".join("{0}={1}".format(k, v)
+                                      for k, v in stats.items()))
+        stats = self.env.provider.receiver.stats()
+        print("  provider queue:", ", ".join("{0}={1}".format(k, v)
+                                             for k, v in stats.items()))
+
+        # counts are this process's sends; depth and spill are queue-wide
+        if Config.Connection == ConnectionType.Mq:
+            stats = ravel.flow.getSender().stats()
+            print("  flow queue:", ", ".join("{0}={1}".format(k, v)
+                                             for k, v in stats.items()))
 
     def do_time(self, line):
         "Run command and report execution time"
@@ -0,0 +1,154 @@
+"""
+Binary wire format for messages passed between Ravel's processes.
+
+Each message is a version byte and a type code followed by the message's
+fields, packed with struct in a fixed layout registered by the module that
+defines the message class.  Messages are received from world-writable queues,
+a TCP socket and shared memory, so only registered layouts are decoded:
+objects without one cannot be sent, and there is no pickle fallback.
+"""
+
+import importlib
+import socket
+import struct
+
+Version = 4
+
+# type codes; 1 was pickled messages, which are no longer accepted
+Null = 0
+
+# modules that register message types, imported on the first decode of an
+# unknown type code (eg, in the OpenFlow manager, which never imports the
+# modules defining the messages it receives)
+Modules = ["ravel.flow", "ravel.network", "ravel.profiling"]
+
+_header = struct.Struct("!BB")
+_length = struct.Struct("!H")
+_nolength = 0xFFFF
+
+_encoders = {}
+_decoders = {}
+
+class CodecError(Exception):
+    "An error encoding or decoding a message"
+    pass
+
+def register(code, cls, encoder, decoder):
+    """Register the binary layout of a message class
+       code: the type code for the class, unique across Ravel
+       cls: the message class
+       encoder: a function taking an instance and returning its packed fields
+       decoder: a function taking a buffer and offset and returning the
+       decoded instance and the offset following it"""
+    _encoders[cls] = (code, encoder)
+    _decoders[code] = decoder
+
+def encode_body(obj):
+    """Encode a message without the version header
+       obj: the message to encode
+       returns: a tuple of the type code and packed fields"""
+    if obj is None:
+        return Null, b""
+
+    if type(obj) not in _encoders:
+        raise CodecError("no layout registered for {0}"
+                         .format(type(obj).__name__))
+
+    code, encoder = _encoders[type(obj)]
+    try:
+        return code, encoder(obj)
+    except (struct.error, ValueError, TypeError, OSError,
+            AttributeError) as e:
+        raise CodecError("cannot encode {0}: {1}"
+                         .format(type(obj).__name__, e))
+
+def decode_body(code, data, offset=0, end=None):
+    """Decode a message encoded with encode_body
+       code: the message's type code
+       data: a buffer containing the packed fields
+       offset: the offset of the fields in data
+       end: the offset following the fields, unused by fixed layouts
+       returns: a tuple of the message and the offset following it"""
+    if code == Null:
+        return None, offset
+
+    if code not in _decoders:
+        for module in Modules:
+            importlib.import_module(module)
+        if code not in _decoders:
+            raise CodecError("unknown message type {0}".format(code))
+
+    return _decoders[code](data, offset)
+
+def encode(obj):
+    """Encode a message for sending
+       obj: the message to encode
+       returns: the encoded message as bytes"""
+    code, body = encode_body(obj)
+    return _header.pack(Version, code) + body
+
+def decode(data):
+    """Decode a message encoded with encode
+       data: the encoded message
+       returns: the decoded message"""
+    if len(data) < _header.size:
+        raise CodecError("truncated message")
+
+    version, code = _header.unpack_from(data)
+    if version != Version:
+        raise CodecError("unsupported message version {0}".format(version))
+
+    data = memoryview(data)
+    obj, _ = decode_body(code, data, _header.size)
+    return obj
+
+def pack_str(s):
+    """Pack a string, or None, with a length prefix
+       s: the string to pack
+       returns: the packed string"""
+    if s is None:
+        return _length.pack(_nolength)
+    b = str(s).encode("utf-8")
+    return _length.pack(len(b)) + b
+
+def unpack_str(data, offset):
+    """Unpack a string packed with pack_str
+       data: the buffer containing the string
+       offset: the offset of the string in data
+       returns: a tuple of the string and the offset following it"""
+    n, = _length.unpack_from(data, offset)
+    offset += _length.size
+    if n == _nolength:
+        return None, offset
+    return bytes(data[offset:offset + n]).decode("utf-8"), offset + n
+
+def pack_ip(ip):
+    """Pack a dotted IPv4 address
+       ip: the address as a string
+       returns: the address as 4 bytes"""
+    return socket.inet_aton(ip)
+
+def unpack_ip(data, offset):
+    """Unpack an IPv4 address packed with pack_ip
+       data: the buffer containing the address
+       offset: the offset of the address in data
+       returns: a tuple of the dotted address and the offset following it"""
+    return socket.inet_ntoa(bytes(data[offset:offset + 4])), offset + 4
+
+def pack_mac(mac):
+    """Pack a colon-separated MAC address
+       mac: the address as a string
+       returns: the address as 6 bytes"""
+    b = bytes.fromhex(mac.replace(":", ""))
+    if len(b) != 6:
+        raise ValueError("invalid MAC address {0}".format(mac))
+    return b
+
+def unpack_mac(data, offset):
+    """Unpack a MAC address packed with pack_mac
+       data: the buffer containing the address
+       offset: the offset of the address in data
+       returns: a tuple of the colon-separated address and the offset
+       following it"""
+    b = bytes(data[offset:offset + 6])
+    return ":".join("{0:02x}".format(x) for x in b), offset + 6
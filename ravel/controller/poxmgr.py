@@ -3,6 +3,9 @@
 Pox-based OpenFlow manager
 """
 
+import time
+from collections import OrderedDict
+
 import pox.openflow.libopenflow_01 as of
 from pox.core import core
 from pox.lib.recoco import *
@@ -10,17 +13,23 @@ from pox.lib.revent import *
 from pox.lib.addresses import IPAddr, EthAddr
 from pox.lib.util import dpid_to_str
 from pox.lib.util import str_to_dpid
+from psycopg2.extras import execute_values
 
-from ravel.util import Config
+from ravel.util import Config, ConnectionType
+from ravel.cache import TopologyCache
 from ravel.db import RavelDb
+import ravel.profiling
 from ravel.profiling import PerfCounter
-from ravel.messaging import MsgQueueReceiver, RpcReceiver
+from ravel.messaging import MsgQueueReceiver, RpcReceiver, ShmReceiver
 from ravel.of import OfManager
 
 log = core.getLogger()
 
 class PoxManager(OfManager):
-    "Pox-based OpenFlow manager"
+    """Pox-based OpenFlow manager.  Messages are consumed by the receivers'
+       threads, so anything touching switch connections, outstanding
+       barriers or the database is handed to POX's event loop with
+       core.callLater, which runs calls in the order they were made"""
 
     def __init__(self, log, dbname, dbuser):
         super(PoxManager, self).__init__()
@@ -28,8 +37,14 @@ class PoxManager(OfManager):
         self.log = log
         self.datapaths = {}
         self.flowstats = []
-        self.perfcounter = PerfCounter("sw_delay")
-        self.dpid_cache = {}
+        # outstanding barriers: xid -> (int dpid, PerfCounter, fids, sent)
+        self.barriers = {}
+        self.topo = TopologyCache(self.db)
+        self.topo.start()
+        self.topo.load(["switches"])
+
+        # switches removed on disconnect, restored if they reconnect
+        self.offline = {}
 
         core.openflow.addListeners(self, priority=0)
         self.log.info("ravel: starting pox manager")
@@ -40,46 +55,52 @@ class PoxManager(OfManager):
 
         core.call_when_ready(startup, ("openflow", "openflow_discovery"))
 
-    def update_switch_cache(self):
-        self.db.cursor.execute("SELECT * FROM switches;")
-        result = self.db.cursor.fetchall()
-        for sw in result:
-            self.dpid_cache[sw[1]] = { 'sid' : sw[0],
-                                       'dpid' : sw[1],
-                                       'ip' : sw[2],
-                                       'mac': sw[3],
-                                       'name': sw[4] }
+    def _switch(self, dpid):
+        """Look up a switch in the topology cache, reloading the cache if
+           the switch's notification has not yet arrived
+           dpid: the datapath id of the switch"""
+        sw = self.topo.switch_by_dpid(dpid)
+        if sw is None:
+            self.topo.load(["switches"])
+            sw = self.topo.switch_by_dpid(dpid)
+        return sw
 
     def _handle_ConnectionDown(self, event):
         dpid = "%0.16x" % event.dpid
-        self.update_switch_cache()
+        sw = self.topo.switch_by_dpid(dpid)
+        if sw is not None:
+            self.offline[dpid] = sw
         del self.datapaths[event.dpid]
-        self.db.cursor.execute("DELETE FROM switches WHERE dpid='{0}';"
-                               .format(dpid))
+
+        # replies to outstanding barriers will never arrive
+        for xid, barrier in list(self.barriers.items()):
+            if barrier[0] == event.dpid:
+                del self.barriers[xid]
+        self.db.query("switch_delete", dpid)
         self.log.info("ravel: dpid {0} removed".format(event.dpid))
 
     def _handle_ConnectionUp(self, event):
         dpid = "%0.16x" % event.dpid
-        self.update_switch_cache()
         self.datapaths[event.dpid] = event.connection
 
-        self.db.cursor.execute("SELECT COUNT(*) FROM switches WHERE dpid='{0}';"
-                               .format(dpid))
-        count = self.db.cursor.fetchall()[0][0]
+        count = self.db.query("switch_count", dpid).fetchall()[0][0]
 
         if count > 0:
             # switch already in db
             pass
-        elif dpid in self.dpid_cache:
-            sw = self.dpid_cache[dpid]
-            self.db.cursor.execute("INSERT INTO switches (sid, dpid, ip, mac, name) "
-                                   "VALUES ({0}, '{1}', '{2}', '{3}', '{4}');".format(
-                                   sw['sid'], sw['dpid'], sw['ip'], sw['mac'], sw['name']))
+        elif dpid in self.offline:
+            sw = self.offline.pop(dpid)
+            self.db.query("switch_insert", sw['sid'], sw['dpid'], sw['ip'],
+                          sw['mac'], sw['name'])
         else:
-            sid = len(self.dpid_cache) + 1
+            # notifications are asynchronous, reload in case a switch was
+            # added moments ago
+            self.topo.load(["switches"])
+            sids = list(self.topo.switches.keys()) + \
+                   [sw['sid'] for sw in self.offline.values()]
+            sid = max(sids + [0]) + 1
             name = "s{0}".format(sid)
-            self.db.cursor.execute("INSERT INTO switches (sid, dpid, name) VALUES "
-                                   "({0}, '{1}', '{2}')".format(sid, dpid, name))
+            self.db.query("switch_insert", sid, dpid, None, None, name)
 
         self.log.info("ravel: dpid {0} online".format(event.dpid))
         self.log.info("ravel: online dpids: {0}".format(self.datapaths))
@@ -89,47 +110,65 @@ class PoxManager(OfManager):
         dpid2 = "%0.16x" % event.link.dpid2
         port1 = event.link.port1
         port2 = event.link.port2
-        sid1 = self.dpid_cache[dpid1]['sid']
-        sid2 = self.dpid_cache[dpid2]['sid']
+        sid1 = self._switch(dpid1)['sid']
+        sid2 = self._switch(dpid2)['sid']
 
         if event.removed:
-            self.db.cursor.execute("UPDATE tp SET isactive=0 WHERE "
-                                   " (sid={0} AND nid={1}) OR "
-                                   " (sid={1} AND nid={0});"
-                                   .format(sid1, sid2))
+            self.db.query("tp_link_down", sid1, sid2)
 
             self.log.info("Link down {0}".format(event.link))
         elif event.added:
             # does the forward link exist in Postgres?
-            self.db.cursor.execute("SELECT COUNT(*) FROM tp WHERE "
-                                   "sid={0} AND nid={1};"
-                                   .format(sid1, sid2))
-            count = self.db.cursor.fetchall()[0][0]
+            count = self.db.query("tp_count", sid1, sid2).fetchall()[0][0]
             if count == 0:
-                self.db.cursor.execute("INSERT INTO tp (sid, nid, ishost, isactive) "
-                                       "VALUES ({0}, {1}, 0, 1);"
-                                       .format(sid1, sid2))
-                self.db.cursor.execute("INSERT INTO ports (sid, nid, port) VALUES "
-                                       "({0}, {1}, {2});"
-                                       .format(sid1, sid2, port1))
+                self.db.query("tp_insert", sid1, sid2, 0, 1)
+                self.db.query("port_insert", sid1, sid2, port1)
 
             # does the reverse link already exist in Postgres?
-            self.db.cursor.execute("SELECT COUNT(*) FROM tp WHERE "
-                                   "sid={0} AND nid={1};"
-                                   .format(sid2, sid1))
-            count = self.db.cursor.fetchall()[0][0]
+            count = self.db.query("tp_count", sid2, sid1).fetchall()[0][0]
             if count == 0:
-                self.db.cursor.execute("INSERT INTO tp (sid, nid, ishost, isactive) "
-                                       "VALUES ({0}, {1}, 0, 1);"
-                                       .format(sid2, sid1))
-                self.db.cursor.execute("INSERT INTO ports (sid, nid, port) VALUES "
-                                       "({0}, {1}, {2});"
-                                       .format(sid2, sid1, port2))
+                self.db.query("tp_insert", sid2, sid1, 0, 1)
+                self.db.query("port_insert", sid2, sid1, port2)
             self.log.info("Link up {0}".format(event.link))
 
     def _handle_BarrierIn(self, event):
-        self.perfcounter.stop()
-        self.log.debug("received barrier")
+        barrier = self.barriers.pop(event.xid, None)
+        if barrier is None:
+            self.log.debug("received unknown barrier xid={0}".format(
+                event.xid))
+            return
+
+        dpid, pc, fids, sent = barrier
+        pc.stop()
+
+        # reported from POX's event loop, after the receivers last flushed
+        ravel.profiling.flush()
+        self.log.debug("dpid {0} received barrier xid={1}".format(
+            dpid, event.xid))
+
+        if fids:
+            self.confirmFlows(dpid, fids, sent)
+
+    def confirmFlows(self, dpid, fids, sent):
+        """Record that a switch applied the flowmods installing flows
+           dpid: the datapath id of the switch, as an integer
+           fids: ids of the installed flows
+           sent: when the flowmods were sent, in seconds since the epoch"""
+        now = time.time()
+        if sent is None:
+            sent = now
+
+        rows = [(fid, str(dpid), sent, now) for fid in fids]
+        try:
+            execute_values(self.db.cursor,
+                           "INSERT INTO flow_status "
+                           "(fid, dpid, requested, installed) VALUES %s",
+                           rows,
+                           template="(%s, %s, to_timestamp(%s), "
+                                    "to_timestamp(%s))")
+        except Exception as e:
+            self.log.warning("ravel: could not record flow status: {0}"
+                             .format(e))
 
     def _handle_FlowStatsReceived(self, event):
         self.log.info("ravel: flow stat received dpid={0}, len={1}".format(
@@ -140,6 +179,10 @@ class PoxManager(OfManager):
 
     def requestStats(self):
         "Send all switches a flow statistics request"
+        core.callLater(self._requestStats)
+        return True
+
+    def _requestStats(self):
         self.flowstats = []
         for connection in list(core.openflow._connections.values()):
             connection.send(of.ofp_stats_request(body=of.ofp_flow_stats_request()))
@@ -147,21 +190,27 @@ class PoxManager(OfManager):
         self.log.debug("ravel: sent {0} flow stats requests".format(
             len(core.openflow._connections)))
 
+    def sendBarrier(self, dpid, fids=None, sent=None):
+        """Send a barrier message
+           dpid: datapath id of the switch to receive the barrier
+           fids: ids of the flows to confirm when the switch replies
+           sent: when the flows' flowmods were sent, in seconds since the
+           epoch"""
+        core.callLater(self._sendBarrier, dpid, fids, sent)
         return True
 
-    def sendBarrier(self, dpid):
-        """Send a barrier message
-           dpid: datapath id of the switch to receive the barrier"""
-        dpid = int(dpid)
-        if dpid in self.datapaths:
-            dp = self.datapaths[dpid]
+    def _sendBarrier(self, dpid, fids, sent):
+        if int(dpid) in self.datapaths:
+            dp = self.datapaths[int(dpid)]
             msg = of.ofp_barrier_request()
+            pc = PerfCounter("sw_delay")
+            pc.start()
+            self.barriers[msg.xid] = (int(dpid), pc, fids, sent)
             dp.send(msg)
-            self.perfcounter.start()
-            self.log.debug("dpid {0} sent barrier".format(dpid))
+            self.log.debug("dpid {0} sent barrier xid={1}".format(
+                dpid, msg.xid))
         else:
             self.log.debug("dpid {0} not in datapath list".format(dpid))
-        return True
 
     def registerReceiver(self, receiver):
         """Register a new message receiver
@@ -201,9 +250,11 @@ class PoxManager(OfManager):
            dpid: datapath id of the switch
            msg: OpenFlow message"""
         self.log.debug("ravel: flow mod dpid={0}".format(dpid))
+        core.callLater(self._write, dpid, msg.pack())
+
+    def _write(self, dpid, data):
         if dpid in self.datapaths:
-            dp = self.datapaths[dpid]
-            dp.send(msg)
+            self.datapaths[dpid].send(data)
         else:
             self.log.debug("dpid {0} not in datapath list".format(dpid))
 
@@ -213,11 +264,40 @@ class PoxManager(OfManager):
         dpid = int(flow.switch.dpid)
         self.send(dpid, self.mk_msg(flow))
 
+    def sendFlowmodBatch(self, batch):
+        """Send a batch of flow modification messages.  Flowmods are packed
+           by the calling thread, then written to each datapath's connection
+           at once from POX's event loop, followed by one barrier per switch
+           batch: a ravel.flow.FlowModBatch instance"""
+        data = {}
+        barriers = OrderedDict()
+        for msg in batch.msgs:
+            if hasattr(msg, 'command'):
+                dpid = int(msg.switch.dpid)
+                data.setdefault(dpid, []).append(self.mk_msg(msg).pack())
+            elif msg.dpid not in barriers:
+                barriers[msg.dpid] = msg
+            else:
+                barriers[msg.dpid].fids.extend(msg.fids)
+
+        for dpid, packed in data.items():
+            self.log.debug("ravel: {0} flow mods dpid={1}".format(
+                len(packed), dpid))
+            core.callLater(self._write, dpid, b"".join(packed))
+
+        for dpid, msg in barriers.items():
+            self.sendBarrier(dpid, msg.fids, msg.sent)
+
 def launch():
     "Start the OpenFlow manager and message receivers"
+    ravel.profiling.ProcessName = "pox"
     ctrl = PoxManager(log, Config.DbName, Config.DbUser)
-    mq = MsgQueueReceiver(Config.QueueId, ctrl)
+    mq = MsgQueueReceiver(Config.QueueId, ctrl, Config.Workers)
     ctrl.registerReceiver(mq)
     rpc = RpcReceiver(Config.RpcHost, Config.RpcPort, ctrl)
     ctrl.registerReceiver(rpc)
+    if Config.Connection == ConnectionType.Shm:
+        shm = ShmReceiver(Config.ShmPath, Config.ShmSize, Config.ShmSemId,
+                          ctrl)
+        ctrl.registerReceiver(shm)
     core.register("ravelcontroller", ctrl)
@@ -2,12 +2,31 @@
 The Ravel backend PostgreSQL database
 """
 
+import hashlib
+import io
+import itertools
+import os
+import re
+import shutil
+import threading
+import time
+
 import psycopg2
+import psycopg2.pool
+from psycopg2.extensions import quote_ident
 
+import ravel.profiling
 from ravel.log import logger
-from ravel.util import resource_file
+from ravel.util import Config, resource_file, set_trigger_path
 
 ISOLEVEL = psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT
+POOL_SIZE = 8
+POOL_TIMEOUT = 10
+FETCH_SIZE = 1000
+WAIT_TIMEOUT = 10
+
+# numbers the server-side cursors opened by RavelDb.stream
+_stream_ids = itertools.count()
 
 BASE_SQL = resource_file("ravel/sql/base.sql")
 FLOW_SQL = resource_file("ravel/sql/flows.sql")
@@ -15,6 +34,341 @@ NOFLOW_SQL = resource_file("ravel/sql/noflows.sql")
 TOPO_SQL = resource_file("ravel/sql/topo.sql")
 AUXILIARY_FUN_SQL = resource_file("ravel/sql/auxiliary_functions.sql")
 
+# schemas installed in the template database after the base schema, bump
+# TEMPLATE_VERSION when the way the template is built changes
+TEMPLATE_SQL = [FLOW_SQL, TOPO_SQL, AUXILIARY_FUN_SQL]
+TEMPLATE_VERSION = 1
+
+# snapshot names are used as directory names under Config.SnapshotDir
+SNAPSHOT_NAME = re.compile(r"^[A-Za-z0-9_.-]+$")
+
+# file in a snapshot holding the values of the database's sequences
+SEQUENCES_FILE = ".sequences"
+
+class Query(object):
+    "A named statement, prepared on the server with typed parameters"
+
+    def __init__(self, name, sql, types=None):
+        """name: the name of the prepared statement
+           sql: the statement, using $1, $2, ... for parameters
+           types: a list of PostgreSQL types, one per parameter"""
+        self.name = name
+        self.sql = sql
+        self.types = types if types is not None else []
+
+    @property
+    def prepare(self):
+        "returns: the PREPARE statement for the query"
+        if self.types:
+            return "PREPARE {0} ({1}) AS {2};".format(self.name,
+                                                     ", ".join(self.types),
+                                                     self.sql)
+        return "PREPARE {0} AS {1};".format(self.name, self.sql)
+
+    @property
+    def execute(self):
+        """returns: the EXECUTE statement for the query, with a placeholder
+           for each parameter"""
+        if self.types:
+            return "EXECUTE {0} ({1});".format(self.name,
+                                               ", ".join(["%s"] * len(self.types)))
+        return "EXECUTE {0};".format(self.name)
+
+    def __repr__(self):
+        return str(self)
+
+    def __str__(self):
+        return "{0}: {1}".format(self.name, self.sql)
+
+# statements on the flow, link event and topology paths, applications can
+# register their own with RavelDb.register
+QUERIES = [
+    Query("switch_insert",
+          "INSERT INTO switches (sid, dpid, ip, mac, name) "
+          "VALUES ($1, $2, $3, $4, $5)",
+          ["integer", "varchar", "varchar", "varchar", "varchar"]),
+    Query("switch_count",
+          "SELECT COUNT(*) FROM switches WHERE dpid=$1",
+          ["varchar"]),
+    Query("switch_delete",
+          "DELETE FROM switches WHERE dpid=$1",
+          ["varchar"]),
+    Query("switch_set_name",
+          "UPDATE switches SET name=$2 WHERE sid=$1",
+          ["integer", "varchar"]),
+    Query("switch_set_dpid",
+          "UPDATE switches SET dpid=$2 WHERE sid=$1",
+          ["integer", "varchar"]),
+    Query("host_addr",
+          "SELECT ip, mac FROM hosts WHERE hid=$1",
+          ["integer"]),
+    Query("host_set_name",
+          "UPDATE hosts SET name=$2 WHERE hid=$1",
+          ["integer", "varchar"]),
+    Query("host_set_ip",
+          "UPDATE hosts SET ip=$2 WHERE hid=$1",
+          ["integer", "varchar"]),
+    Query("host_set_mac",
+          "UPDATE hosts SET mac=$2 WHERE hid=$1",
+          ["integer", "varchar"]),
+    Query("tp_insert",
+          "INSERT INTO tp (sid, nid, ishost, isactive) VALUES ($1, $2, $3, $4)",
+          ["integer", "integer", "integer", "integer"]),
+    Query("tp_count",
+          "SELECT COUNT(*) FROM tp WHERE sid=$1 AND nid=$2",
+          ["integer", "integer"]),
+    Query("tp_link_down",
+          "UPDATE tp SET isactive=0 WHERE (sid=$1 AND nid=$2) "
+          "OR (sid=$2 AND nid=$1)",
+          ["integer", "integer"]),
+    Query("port_insert",
+          "INSERT INTO ports (sid, nid, port) VALUES ($1, $2, $3)",
+          ["integer", "integer", "integer"]),
+    Query("rm_max_fid",
+          "SELECT MAX(fid) FROM rm"),
+    Query("rm_insert",
+          "INSERT INTO rm (fid, src, dst, FW) VALUES ($1, $2, $3, $4)",
+          ["integer", "integer", "integer", "integer"]),
+    Query("rm_fid",
+          "SELECT fid FROM rm WHERE fid=$1",
+          ["integer"]),
+    Query("rm_fids",
+          "SELECT fid FROM rm WHERE src=$1 AND dst=$2",
+          ["integer", "integer"]),
+    Query("rm_delete",
+          "DELETE FROM rm WHERE fid=$1",
+          ["integer"]),
+    Query("clock_max",
+          "SELECT MAX(counts) FROM clock"),
+    Query("rm_delta_adds",
+          "SELECT fid FROM rm_delta WHERE isadd=1"),
+    # a flow with no path in cf (not orchestrated, unroutable or unknown)
+    # is pending, as is one not yet confirmed by every switch on its path
+    Query("flow_pending",
+          "SELECT f.fid FROM unnest($1) AS f(fid) "
+          "WHERE NOT EXISTS (SELECT 1 FROM cf c WHERE c.fid = f.fid) "
+          "OR (SELECT count(DISTINCT c.sid) FROM cf c WHERE c.fid = f.fid) > "
+          "(SELECT count(DISTINCT s.dpid) FROM flow_status s "
+          "WHERE s.fid = f.fid AND s.requested >= to_timestamp($2))",
+          ["integer[]", "double precision"]),
+]
+
+_literal = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_whitespace = re.compile(r"\s+")
+
+def normalize(statement):
+    """Normalize a SQL statement for aggregation by replacing literals with
+       placeholders and collapsing whitespace
+       statement: a SQL statement as a string
+       returns: the normalized statement"""
+    statement = _literal.sub("?", statement)
+    return _whitespace.sub(" ", statement).strip()
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    """A cursor that reports the normalized text, execution time and row
+       count of each statement it executes as a
+       ravel.profiling.StatementCounter while profiling is enabled"""
+
+    def _timed(self, statement, fn, *args):
+        if not ravel.profiling.is_profiled():
+            return fn(*args)
+
+        ts = time.time()
+        start = time.perf_counter_ns()
+        try:
+            return fn(*args)
+        finally:
+            if isinstance(statement, bytes):
+                statement = statement.decode("utf-8", "ignore")
+            elif not isinstance(statement, str):
+                statement = statement.as_string(self)
+            pc = ravel.profiling.StatementCounter(
+                normalize(statement),
+                (time.perf_counter_ns() - start) / 1e6,
+                self.rowcount,
+                ts)
+            pc.report()
+
+    def execute(self, query, vars=None):
+        return self._timed(query, super(InstrumentedCursor, self).execute,
+                           query, vars)
+
+    def executemany(self, query, vars_list):
+        return self._timed(query, super(InstrumentedCursor, self).executemany,
+                           query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        return self._timed(sql, super(InstrumentedCursor, self).copy_expert,
+                           sql, file, size)
+
+def _copy_value(value):
+    # format a value for COPY's text format
+    if value is None:
+        return "\\N"
+    return str(value).replace("\\", "\\\\") \
+                     .replace("\t", "\\t") \
+                     .replace("\n", "\\n")
+
+class ConnectionPool(object):
+    """A bounded pool of connections to the PostgreSQL database.  Each thread
+       (or named client, such as an application) checks out its own
+       connection, so message receiver threads and the CLI do not contend
+       on a single socket"""
+
+    def __init__(self, name, user, passwd=None, size=None,
+                 timeout=POOL_TIMEOUT, cursor_factory=None):
+        """name: the name of the database to connect to
+           user: the username to use to connect
+           passwd: the password to connect to the database
+           size: the maximum number of open connections
+           timeout: seconds to wait for a free connection before raising
+           psycopg2.pool.PoolError
+           cursor_factory: the cursor class for new connections"""
+        self.name = name
+        self.user = user
+        self.passwd = passwd
+        self.cursor_factory = cursor_factory
+        self.size = size if size else POOL_SIZE
+        self.timeout = timeout
+        self._cond = threading.Condition()
+        self._idle = []
+        self._inuse = {}
+        self._prepared = {}
+        self.created = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.discarded = 0
+
+    def _connect(self):
+        conn = psycopg2.connect(database=self.name,
+                                user=self.user,
+                                password=self.passwd,
+                                cursor_factory=self.cursor_factory)
+        conn.set_isolation_level(ISOLEVEL)
+        self.created += 1
+        return conn
+
+    def _healthy(self, conn):
+        if conn.closed:
+            return False
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1;")
+            cursor.close()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn):
+        self.discarded += 1
+        self._prepared.pop(id(conn), None)
+        if not conn.closed:
+            conn.close()
+
+    def _reap(self):
+        # return connections held by threads that have exited
+        alive = set(t.ident for t in threading.enumerate())
+        dead = [key for key in self._inuse
+                if isinstance(key, int) and key not in alive]
+        for key in dead:
+            self._idle.append(self._inuse.pop(key))
+        return len(dead) > 0
+
+    def checkout(self, key=None):
+        """Check out a connection.  Repeated checkouts with the same key
+           return the same connection until it is checked back in.
+           key: the client holding the connection, defaults to the calling
+           thread
+           returns: a psycopg2 connection"""
+        if key is None:
+            key = threading.get_ident()
+
+        with self._cond:
+            conn = self._inuse.get(key)
+            if conn is not None:
+                if not conn.closed:
+                    return conn
+                del self._inuse[key]
+                self._discard(conn)
+
+            deadline = time.time() + self.timeout
+            while True:
+                conn = None
+                while self._idle and conn is None:
+                    conn = self._idle.pop()
+                    if not self._healthy(conn):
+                        self._discard(conn)
+                        conn = None
+
+                if conn is None and \
+                   len(self._inuse) + len(self._idle) < self.size:
+                    conn = self._connect()
+
+                if conn is not None:
+                    self._inuse[key] = conn
+                    self.checkouts += 1
+                    return conn
+
+                if self._reap():
+                    continue
+
+                remaining = deadline - time.time()
+                self.waits += 1
+                if remaining <= 0 or not self._cond.wait(remaining):
+                    raise psycopg2.pool.PoolError(
+                        "connection pool exhausted ({0} connections)"
+                        .format(self.size))
+
+    def checkin(self, key=None):
+        """Return a checked out connection to the pool
+           key: the client holding the connection, defaults to the calling
+           thread"""
+        if key is None:
+            key = threading.get_ident()
+
+        with self._cond:
+            conn = self._inuse.pop(key, None)
+            if conn is None:
+                return
+            if conn.closed:
+                self._discard(conn)
+            else:
+                self._idle.append(conn)
+            self._cond.notify()
+
+    def closeall(self):
+        "Close all open connections, whether idle or checked out"
+        with self._cond:
+            for conn in self._idle + list(self._inuse.values()):
+                if not conn.closed:
+                    conn.close()
+            self._idle = []
+            self._inuse = {}
+            self._prepared = {}
+            self._cond.notify_all()
+
+    def prepared(self, conn):
+        """conn: a connection checked out from the pool
+           returns: a dictionary of statements prepared on the connection,
+           mapping statement name to its SQL"""
+        with self._cond:
+            return self._prepared.setdefault(id(conn), {})
+
+    def stats(self):
+        """returns: a dictionary of pool metrics: connection limit, open,
+           checked out and idle connections, total connections created and
+           discarded, checkouts and checkouts that had to wait"""
+        with self._cond:
+            return { "size" : self.size,
+                     "open" : len(self._inuse) + len(self._idle),
+                     "inuse" : len(self._inuse),
+                     "idle" : len(self._idle),
+                     "created" : self.created,
+                     "discarded" : self.discarded,
+                     "checkouts" : self.checkouts,
+                     "waits" : self.waits
+            }
+
 class RavelDb():
     """A representation of Ravel's backend PostgreSQL database."""
 
@@ -30,8 +384,12 @@ class RavelDb():
         self.passwd = passwd
         self.base = base
         self.cleaned = not reconnect
-        self._cursor = None
-        self._conn = None
+        self.templated = False
+        factory = InstrumentedCursor if Config.ProfileStatements else None
+        self.pool = ConnectionPool(name, user, passwd, Config.DbPoolSize,
+                                   cursor_factory=factory)
+        self.queries = dict((q.name, q) for q in QUERIES)
+        self._local = threading.local()
 
         if not reconnect and self.num_connections() > 0:
             logger.warning("existing connections to database, skipping reinit")
@@ -42,21 +400,129 @@ class RavelDb():
 
     @property
     def conn(self):
-        "returns: a psycopg2 connection to the PostgreSQL database"
-        if not self._conn or self._conn.closed:
-            self._conn = psycopg2.connect(database=self.name,
-                                          user=self.user,
-                                          password=self.passwd)
-            self._conn.set_isolation_level(ISOLEVEL)
-        return self._conn
+        """returns: the calling thread's psycopg2 connection to the
+           PostgreSQL database, checked out from RavelDb.pool"""
+        return self.pool.checkout()
 
     @property
     def cursor(self):
         """returns: a psycopg2 cursor from RavelDb.conn for the PostgreSQL
-           database"""
-        if not self._cursor or self._cursor.closed:
-            self._cursor = self.conn.cursor()
-        return self._cursor
+           database.  Each thread has its own cursor"""
+        conn = self.conn
+        cursor = getattr(self._local, "cursor", None)
+        if cursor is None or cursor.closed or cursor.connection is not conn:
+            cursor = conn.cursor()
+            self._local.cursor = cursor
+        return cursor
+
+    def connection(self, key):
+        """Check out a dedicated connection for a client other than the
+           calling thread, such as an application
+           key: a hashable name for the client
+           returns: a psycopg2 connection"""
+        return self.pool.checkout(key)
+
+    def release(self, key=None):
+        """Return a connection to the pool
+           key: the client that checked out the connection, defaults to the
+           calling thread"""
+        if key is None:
+            self._local.cursor = None
+        self.pool.checkin(key)
+
+    def register(self, name, sql, types=None):
+        """Register a named statement.  The statement is prepared on each
+           connection the first time it is executed there, so its plan is
+           reused by later executions
+           name: the name of the statement
+           sql: the statement, using $1, $2, ... for parameters
+           types: a list of PostgreSQL types, one per parameter"""
+        self.queries[name] = Query(name, sql, types)
+
+    def query(self, name, *params):
+        """Execute a registered statement
+           name: the name of the statement
+           params: the statement's parameters
+           returns: the cursor used to execute the statement"""
+        query = self.queries[name]
+        cursor = self.cursor
+        prepared = self.pool.prepared(cursor.connection)
+        if prepared.get(name) != query.sql:
+            if name in prepared:
+                cursor.execute("DEALLOCATE {0};".format(name))
+                del prepared[name]
+            cursor.execute(query.prepare)
+            prepared[name] = query.sql
+        cursor.execute(query.execute, params)
+        return cursor
+
+    def stream(self, sql, params=None, size=None, limit=None):
+        """Execute a query with a named server-side cursor and fetch its
+           results in batches, so that only one batch is held in memory.
+           The first batch is always returned, even if it is empty
+           sql: a SELECT query
+           params: the query's parameters
+           size: the number of rows per batch
+           limit: the maximum number of rows to fetch
+           returns: a generator of (column names, list of rows) tuples"""
+        if size is None:
+            size = Config.DbFetchSize if Config.DbFetchSize else FETCH_SIZE
+
+        # streams open at once on this thread's connection share one
+        # transaction: each needs its own cursor name, and only the last
+        # to finish ends the transaction
+        conn = self.conn
+        streams = getattr(self._local, "streams", 0)
+        if streams == 0:
+            conn.autocommit = False
+        self._local.streams = streams + 1
+        cursor = conn.cursor(name="ravel_stream_{0}_{1}".format(
+            id(conn), next(_stream_ids)))
+        try:
+            cursor.itersize = size
+            cursor.execute(sql, params)
+            count = 0
+            while limit is None or count < limit:
+                batch = size if limit is None else min(size, limit - count)
+                rows = cursor.fetchmany(batch)
+                if count > 0 and len(rows) == 0:
+                    break
+                count += len(rows)
+                yield [desc[0] for desc in cursor.description], rows
+                if len(rows) < batch:
+                    break
+        except psycopg2.Error:
+            conn.rollback()
+            raise
+        finally:
+            if not cursor.closed:
+                cursor.close()
+            self._local.streams -= 1
+            if self._local.streams == 0:
+                conn.commit()
+                conn.autocommit = True
+
+    def wait_flows(self, fids, since=0, timeout=None):
+        """Wait for the switches on each flow's path to confirm its
+           installation in flow_status
+           fids: ids of the flows to wait for
+           since: only count installs requested at or after this time, in
+           seconds since the epoch
+           timeout: seconds to wait, defaults to WAIT_TIMEOUT
+           returns: a list of the fids not confirmed before the timeout"""
+        if timeout is None:
+            timeout = WAIT_TIMEOUT
+
+        fids = [int(fid) for fid in fids]
+        deadline = time.time() + timeout
+        delay = 0.01
+        while True:
+            pending = [row[0] for row in
+                       self.query("flow_pending", fids, since).fetchall()]
+            if not pending or time.time() >= deadline:
+                return pending
+            time.sleep(min(delay, max(deadline - time.time(), 0)))
+            delay = min(delay * 2, 0.1)
 
     def num_connections(self):
         """Returns the number of existing connections to the database.  If
@@ -67,8 +533,8 @@ class RavelDb():
             self.cursor.execute("SELECT * FROM pg_stat_activity WHERE "
                                 "datname='{0}'".format(self.name))
 
-            # ignore cursor connection
-            return len(self.cursor.fetchall()) - 1
+            # ignore connections held by our own pool
+            return len(self.cursor.fetchall()) - self.pool.stats()["open"]
         except psycopg2.DatabaseError as e:
             logger.warning("error loading schema: %s", self.fmt_errmsg(e))
 
@@ -78,72 +544,180 @@ class RavelDb():
         """Initialize the database with the base Ravel SQL implementation.
            Removes any existing Ravel objects from the database"""
         self.clean()
+        if Config.DbTemplate and self.clone_template():
+            self.templated = True
+            return
+
         self.create()
         self.add_extensions()
         self.load_schema(self.base)
 
+    @property
+    def template(self):
+        "returns: the name of the template database for this database"
+        return "{0}_template".format(self.name)
+
+    def template_version(self):
+        """Compute the version of the template database from the contents
+           of the SQL files installed in it
+           returns: the version as a string"""
+        # triggers' PYTHONPATH is part of the loaded text
+        digest = hashlib.sha1()
+        for script in [self.base] + TEMPLATE_SQL:
+            digest.update(self.schema_source(script).encode("utf-8"))
+
+        return "ravel-{0}-{1}".format(TEMPLATE_VERSION, digest.hexdigest())
+
+    def build_template(self, version):
+        """Build the template database with extensions, the base schema
+           and the schemas in TEMPLATE_SQL installed
+           version: the version to record on the template"""
+        template = RavelDb(self.template, self.user, self.base, self.passwd,
+                           reconnect=True)
+        template.create()
+        template.add_extensions()
+        for script in [self.base] + TEMPLATE_SQL:
+            template.load_schema(script)
+        template.cursor.execute("COMMENT ON DATABASE {0} IS %s;"
+                                .format(self.template), (version,))
+        template.pool.closeall()
+        logger.debug("built template database %s", self.template)
+
+    def clone_template(self):
+        """Create the database as a copy of the template database, first
+           rebuilding the template if the SQL files have changed
+           returns: true if the database was created from the template"""
+        conn = None
+        try:
+            version = self.template_version()
+            conn = psycopg2.connect(database="postgres",
+                                    user=self.user,
+                                    password=self.passwd)
+            conn.set_isolation_level(ISOLEVEL)
+            cursor = conn.cursor()
+            cursor.execute("SELECT shobj_description(oid, 'pg_database') "
+                           "FROM pg_database WHERE datname=%s;",
+                           (self.template,))
+            fetch = cursor.fetchall()
+            if len(fetch) > 0 and fetch[0][0] != version:
+                cursor.execute("DROP DATABASE {0};".format(self.template))
+            if len(fetch) == 0 or fetch[0][0] != version:
+                self.build_template(version)
+
+            cursor.execute("CREATE DATABASE {0} TEMPLATE {1};"
+                           .format(self.name, self.template))
+            logger.debug("created database %s from template %s",
+                         self.name, self.template)
+            return True
+        except (psycopg2.DatabaseError, IOError) as e:
+            logger.warning("error cloning template database: %s",
+                           self.fmt_errmsg(e))
+            return False
+        finally:
+            if conn:
+                conn.close()
+
+    def schema_source(self, script):
+        """Read a SQL script, pointing its Python-based triggers' PYTHONPATH
+           at this distribution
+           script: path to a SQL script
+           returns: the text of the script"""
+        with open(script, "r") as f:
+            return set_trigger_path(f.read(), resource_file())
+
     def load_schema(self, script):
         """Load the specified schema into the database"
            script: path to a SQL script"""
         try:
-            s = open(script, "r").read()
+            s = self.schema_source(script)
             logger.debug("loaded schema %s", script)
             self.cursor.execute(s)
         except psycopg2.DatabaseError as e:
             logger.warning("error loading schema: %s", self.fmt_errmsg(e))
 
     def load_topo(self, provider):
-        """Load a topology from the specified network provider
+        """Load a topology from the specified network provider.  Rows for
+           all switches, hosts, links and ports are built in memory and
+           streamed into the database with COPY in a single transaction
            provider: a ravel.network.NetworkProvider instance"""
         topo = provider.topo
-        try:
-            node_count = 0
-            nodes = {}
-            for sw in topo.switches():
-                node_count += 1
-                dpid = provider.getNodeByName(sw).dpid
-                ip = provider.getNodeByName(sw).IP()
-                mac = provider.getNodeByName(sw).MAC()
-                nodes[sw] = node_count
-                self.cursor.execute("INSERT INTO switches (sid, dpid, ip, mac, name) "
-                                    "VALUES ({0}, '{1}', '{2}', '{3}', '{4}');"
-                                    .format(node_count, dpid, ip, mac, sw))
-
-            for host in topo.hosts():
-                node_count += 1
-                ip = provider.getNodeByName(host).IP()
-                mac = provider.getNodeByName(host).MAC()
-                nodes[host] = node_count
-                self.cursor.execute("INSERT INTO hosts (hid, ip, mac, name) "
-                                    "VALUES ({0}, '{1}', '{2}', '{3}');"
-                                    .format(node_count, ip, mac, host))
-
-            for link in topo.links():
-                h1,h2 = link
-                if h1 in topo.switches() and h2 in topo.switches():
-                    ishost = 0
-                else:
-                    ishost = 1
-
-                sid = nodes[h1]
-                nid = nodes[h2]
-                self.cursor.execute("INSERT INTO tp(sid, nid, ishost, isactive) "
-                                    "VALUES ({0}, {1}, {2}, {3});"
-                                    .format(sid, nid, ishost, 1))
-
-                # bidirectional edges
-                self.cursor.execute("INSERT INTO tp(sid, nid, ishost, isactive) "
-                                    "VALUES ({1}, {0}, {2}, {3});"
-                                    .format(sid, nid, ishost, 1))
-
-                self.cursor.execute("INSERT INTO ports(sid, nid, port) "
-                                    "VALUES ({0}, {1}, {2}), ({1}, {0}, {3});"
-                                    .format(sid, nid,
-                                            topo.port(h1, h2)[0],
-                                            topo.port(h1, h2)[1]))
+        start = time.time()
+
+        switches = []
+        hosts = []
+        links = []
+        ports = []
+        nodes = {}
+        node_count = 0
+        for sw in topo.switches():
+            node_count += 1
+            node = provider.getNodeByName(sw)
+            nodes[sw] = node_count
+            switches.append((node_count, node.dpid, node.IP(), node.MAC(), sw))
+
+        for host in topo.hosts():
+            node_count += 1
+            node = provider.getNodeByName(host)
+            nodes[host] = node_count
+            hosts.append((node_count, node.IP(), node.MAC(), host))
 
+        swset = set(topo.switches())
+        for h1, h2 in topo.links():
+            if h1 in swset and h2 in swset:
+                ishost = 0
+            else:
+                ishost = 1
+
+            sid = nodes[h1]
+            nid = nodes[h2]
+            port1, port2 = topo.port(h1, h2)
+
+            # bidirectional edges
+            links.append((sid, nid, ishost, 1))
+            links.append((nid, sid, ishost, 1))
+            ports.append((sid, nid, port1))
+            ports.append((nid, sid, port2))
+
+        tables = [("switches", ("sid", "dpid", "ip", "mac", "name"), switches),
+                  ("hosts", ("hid", "ip", "mac", "name"), hosts),
+                  ("tp", ("sid", "nid", "ishost", "isactive"), links),
+                  ("ports", ("sid", "nid", "port"), ports)]
+
+        cursor = self.cursor
+        try:
+            cursor.execute("BEGIN;")
+            for table, columns, rows in tables:
+                # topology triggers may already be installed (eg, when the
+                # database is cloned from a template), but they should only
+                # catch updates after the initial load
+                cursor.execute("ALTER TABLE {0} DISABLE TRIGGER USER;"
+                               .format(table))
+                self.copy_rows(table, columns, rows)
+                cursor.execute("ALTER TABLE {0} ENABLE TRIGGER USER;"
+                               .format(table))
+            cursor.execute("COMMIT;")
         except psycopg2.DatabaseError as e:
+            cursor.execute("ROLLBACK;")
             logger.warning("error loading topology: %s", self.fmt_errmsg(e))
+            return
+
+        count = sum(len(rows) for _, _, rows in tables)
+        elapsed = max(time.time() - start, 1e-6)
+        logger.info("loaded topology: %s rows in %.3fs (%d rows/s)",
+                    count, elapsed, count / elapsed)
+
+    def copy_rows(self, table, columns, rows):
+        """Bulk insert rows into a table using COPY FROM STDIN
+           table: the name of the table
+           columns: a list of column names
+           rows: a list of tuples, one value per column"""
+        buf = io.StringIO()
+        for row in rows:
+            buf.write("\t".join(_copy_value(v) for v in row))
+            buf.write("\n")
+        buf.seek(0)
+        self.cursor.copy_from(buf, table, sep="\t", null="\\N",
+                              columns=columns)
 
     def create(self):
         """If not created, create a database with the name specified in
@@ -189,7 +763,7 @@ class RavelDb():
     def clean(self):
         """Clean the database of any existing Ravel components"""
         # close existing connections
-        self.conn.close()
+        self.pool.closeall()
 
         conn = None
         try:
@@ -210,8 +784,9 @@ class RavelDb():
            topology tables.  This rolls back the database to the state after
            the topology is first loaded"""
         try:
-            tables = ["cf", "clock", "p_spv", "spatial_ref_sys", "spv_tb_del",
-                      "spv_tb_ins", "rm", "rm_delta", "urm"]
+            tables = ["arp_refs", "cf", "clock", "flow_lookup", "flow_status",
+                      "p_spv", "spatial_ref_sys", "spv_tb_del", "spv_tb_ins",
+                      "rm", "rm_delta", "urm"]
 
             self.cursor.execute("truncate %s;" % ", ".join(tables))
             logger.debug("truncated tables")
@@ -219,5 +794,173 @@ class RavelDb():
         except psycopg2.DatabaseError as e:
             logger.warning("error truncating databases: %s", self.fmt_errmsg(e))
 
+    def tables(self):
+        """returns: a list of Ravel's tables, including tables loaded by
+           applications but excluding those owned by extensions and the
+           perf_counters history, which outlives snapshots"""
+        self.cursor.execute("SELECT c.relname FROM pg_class c "
+                            "JOIN pg_namespace n ON n.oid = c.relnamespace "
+                            "WHERE n.nspname = 'public' AND c.relkind = 'r' "
+                            "AND NOT EXISTS (SELECT 1 FROM pg_depend d "
+                            "WHERE d.objid = c.oid AND d.deptype = 'e') "
+                            "AND c.relname <> 'perf_counters' "
+                            "ORDER BY c.relname;")
+        return [row[0] for row in self.cursor.fetchall()]
+
+    def _snapshot_path(self, name=None):
+        path = os.path.join(Config.SnapshotDir, self.name)
+        if name is not None:
+            path = os.path.join(path, name)
+        return path
+
+    def valid_snapshot(self, name):
+        """Check that a snapshot name is safe to use as a directory name:
+           letters, digits, underscores, dashes and dots, but not .. or a
+           name ending in .tmp
+           name: the name of the snapshot
+           returns: true if the name is valid"""
+        if (not SNAPSHOT_NAME.match(name) or ".." in name
+                or name.endswith(".tmp")):
+            logger.warning("invalid snapshot name %s: use letters, digits, "
+                           "_, - and .", name)
+            return False
+        return True
+
+    def snapshots(self):
+        "returns: a list of the names of saved snapshots"
+        path = self._snapshot_path()
+        if not os.path.isdir(path):
+            return []
+        return sorted(name for name in os.listdir(path)
+                      if not name.endswith(".tmp"))
+
+    def sequences(self):
+        """returns: a list of the sequences in the public schema, excluding
+           sequences installed by extensions"""
+        self.cursor.execute("SELECT c.relname FROM pg_class c "
+                            "JOIN pg_namespace n ON n.oid = c.relnamespace "
+                            "WHERE n.nspname = 'public' AND c.relkind = 'S' "
+                            "AND NOT EXISTS (SELECT 1 FROM pg_depend d "
+                            "WHERE d.objid = c.oid AND d.deptype = 'e') "
+                            "AND c.relname <> 'perf_counters' "
+                            "ORDER BY c.relname;")
+        return [row[0] for row in self.cursor.fetchall()]
+
+    def snapshot(self, name):
+        """Save the contents of all of Ravel's tables, including application
+           tables, to a named snapshot.  Tables are written as binary COPY
+           files from a single consistent view of the database
+           name: the name of the snapshot, replacing any existing snapshot
+           with the same name
+           returns: true if the snapshot was saved"""
+        if not self.valid_snapshot(name):
+            return False
+
+        path = self._snapshot_path(name)
+        tmp = path + ".tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+
+        cursor = self.cursor
+        try:
+            cursor.execute("BEGIN ISOLATION LEVEL REPEATABLE READ;")
+            for table in self.tables():
+                with open(os.path.join(tmp, table), "wb") as f:
+                    cursor.copy_expert("COPY {0} TO STDOUT (FORMAT binary);"
+                                       .format(quote_ident(table, cursor)), f)
+
+            # sequences, so ids handed out after a restore don't repeat
+            with open(os.path.join(tmp, SEQUENCES_FILE), "w") as f:
+                for seq in self.sequences():
+                    cursor.execute("SELECT last_value, is_called FROM {0};"
+                                   .format(quote_ident(seq, cursor)))
+                    value, called = cursor.fetchall()[0]
+                    f.write("{0}\t{1}\t{2}\n".format(seq, value, int(called)))
+            cursor.execute("COMMIT;")
+        except (psycopg2.DatabaseError, IOError) as e:
+            cursor.execute("ROLLBACK;")
+            shutil.rmtree(tmp, ignore_errors=True)
+            logger.warning("error saving snapshot %s: %s",
+                           name, self.fmt_errmsg(e))
+            return False
+
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(tmp, path)
+        logger.debug("saved snapshot %s to %s", name, path)
+        return True
+
+    def restore(self, name):
+        """Restore Ravel's tables from a named snapshot.  Tables are
+           truncated and reloaded with binary COPY in a single transaction,
+           with triggers disabled, so flows in the snapshot are not
+           reinstalled in the network
+           name: the name of the snapshot
+           returns: true if the snapshot was restored"""
+        if not self.valid_snapshot(name):
+            return False
+
+        path = self._snapshot_path(name)
+        if not os.path.isdir(path):
+            logger.warning("no snapshot named %s", name)
+            return False
+
+        cursor = self.cursor
+        current = self.tables()
+        files = set(os.listdir(path)) - set([SEQUENCES_FILE])
+        tables = [t for t in sorted(files) if t in current]
+        for table in files - set(tables):
+            logger.debug("skipping table %s, not in database", table)
+
+        sequences = []
+        seqpath = os.path.join(path, SEQUENCES_FILE)
+        if os.path.isfile(seqpath):
+            currentseqs = self.sequences()
+            with open(seqpath) as f:
+                for line in f:
+                    seq, value, called = line.rstrip("\n").split("\t")
+                    if seq in currentseqs:
+                        sequences.append((seq, int(value), called == "1"))
+
+        names = [quote_ident(t, cursor) for t in tables]
+        try:
+            cursor.execute("BEGIN;")
+            if names:
+                cursor.execute("TRUNCATE {0};".format(", ".join(names)))
+            for table, qname in zip(tables, names):
+                cursor.execute("ALTER TABLE {0} DISABLE TRIGGER USER;"
+                               .format(qname))
+                with open(os.path.join(path, table), "rb") as f:
+                    cursor.copy_expert("COPY {0} FROM STDIN (FORMAT binary);"
+                                       .format(qname), f)
+                cursor.execute("ALTER TABLE {0} ENABLE TRIGGER USER;"
+                               .format(qname))
+            for seq, value, called in sequences:
+                cursor.execute("SELECT setval(%s, %s, %s);",
+                               (quote_ident(seq, cursor), value, called))
+            cursor.execute("COMMIT;")
+        except (psycopg2.DatabaseError, IOError) as e:
+            cursor.execute("ROLLBACK;")
+            logger.warning("error restoring snapshot %s: %s",
+                           name, self.fmt_errmsg(e))
+            return False
+
+        logger.debug("restored snapshot %s", name)
+        return True
+
+    def drop_snapshot(self, name):
+        """Delete a named snapshot
+           name: the name of the snapshot
+           returns: true if the snapshot was deleted"""
+        if not self.valid_snapshot(name):
+            return False
+
+        path = self._snapshot_path(name)
+        if not os.path.isdir(path):
+            logger.warning("no snapshot named %s", name)
+            return False
+
+        shutil.rmtree(path)
+        return True
+
     def fmt_errmsg(self, exception):
         return str(exception).strip()
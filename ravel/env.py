@@ -7,7 +7,6 @@ import subprocess
 
 import ravel.db
 import ravel.messaging
-import ravel.util
 from ravel.app import Application
 from ravel.log import logger
 from ravel.util import Config
@@ -50,17 +49,13 @@ class Environment(object):
         # only load topo if connecting to a clean db
         if self.db.cleaned:
             self.db.load_topo(self.provider)
-            ravel.util.update_trigger_path(ravel.db.FLOW_SQL,
-                                           ravel.util.resource_file())
-            self.db.load_schema(ravel.db.FLOW_SQL)
 
-            # delay loading topo triggers until after db is loaded
-            # we only want to catch updates after initial load
-            ravel.util.update_trigger_path(ravel.db.TOPO_SQL,
-                                           ravel.util.resource_file())
-            self.db.load_schema(ravel.db.TOPO_SQL)
-
-            self.db.load_schema(ravel.db.AUXILIARY_FUN_SQL)
+            # flow and topo triggers are already installed from the template;
+            # otherwise, delay loading them until after the topo is loaded,
+            # since we only want to catch updates after initial load
+            if not self.db.templated:
+                for script in ravel.db.TEMPLATE_SQL:
+                    self.db.load_schema(script)
         else:
             logger.debug("connecting to existing db, skipping load_topo()")
 
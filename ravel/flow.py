@@ -10,18 +10,22 @@ messages to the switches.
 
 import os
 import pickle
+import struct
 import threading
-import xmlrpc.client
-from xmlrpc.server import SimpleXMLRPCServer
+import time
+from collections import OrderedDict
 
 import sysv_ipc
 from mininet.net import macColonHex, netParse, ipAdd
 
+import ravel.codec
 import ravel.messaging
+import ravel.profiling
 from ravel.log import logger
 from ravel.of import OFPP_FLOOD, OFPFC_ADD, OFPFC_DELETE, OFPFC_DELETE_STRICT
 from ravel.profiling import PerfCounter
-from ravel.messaging import MsgQueueSender, RpcSender, OvsSender
+from ravel.messaging import MsgQueueSender, RpcSender, OvsSender, ShmSender
+from ravel.messaging import PersistentSender
 from ravel.util import Config, append_path, ConnectionType
 
 def connectionFactory(conn):
@@ -33,14 +37,26 @@ def connectionFactory(conn):
         return RpcSender(Config.RpcHost, Config.RpcPort)
     elif conn == ConnectionType.Ovs:
         return OvsSender()
+    elif conn == ConnectionType.Shm:
+        return ShmSender(Config.ShmPath, Config.ShmSize, Config.ShmSemId)
     else:
         raise Exception("Unrecognized messaging protocol %s", conn)
 
-def _send_msg(command, flow_id, sw, src_ip, src_mac, dst_ip, dst_mac, outport,
-              revoutport):
-    pc = PerfCounter("msg_create")
-    pc.start()
-    conn = connectionFactory(Config.Connection)
+# persistent senders, one per connection type, reused across trigger calls
+_senders = {}
+
+def getSender(conn=None):
+    """Get the persistent message sender for a connection type, creating it
+       on first use
+       conn: a ConnectionType, defaults to Config.Connection"""
+    if conn is None:
+        conn = Config.Connection
+
+    if conn not in _senders:
+        _senders[conn] = PersistentSender(lambda: connectionFactory(conn))
+    return _senders[conn]
+
+def _flow_msgs(command, sw, src_ip, dst_ip, outport, revoutport):
     msg1 = OfMessage(command=command,
                      priority=10,
                      switch=sw,
@@ -53,24 +69,126 @@ def _send_msg(command, flow_id, sw, src_ip, src_mac, dst_ip, dst_mac, outport,
                      match=Match(nw_src=dst_ip, nw_dst=src_ip, dl_type=0x0800),
                      actions=[revoutport])
 
-    arp1 = OfMessage(command=command,
-                     priority=1,
-                     switch=sw,
-                     match=Match(dl_src=src_mac, dl_type=0x0806),
-                     actions=[OFPP_FLOOD])
+    return [msg1, msg2]
 
-    arp2 = OfMessage(command=command,
+def _arp_msg(command, sw, mac):
+    return OfMessage(command=command,
                      priority=1,
                      switch=sw,
-                     match=Match(dl_src=dst_mac, dl_type=0x0806),
+                     match=Match(dl_src=mac, dl_type=0x0806),
                      actions=[OFPP_FLOOD])
 
+def _send_msgs(command, flows, arps):
+    pc = PerfCounter("msg_create")
+    pc.start()
+    msgs = []
+
+    # flowmods stream to each switch without waiting, followed by a single
+    # barrier per switch for the whole batch.  For installs, the barrier
+    # carries the flows to confirm in flow_status when the switch replies
+    dpids = OrderedDict()
+    for flow in flows:
+        sw = Switch(flow["sw_name"], flow["sw_ip"], flow["sw_dpid"])
+        msgs.extend(_flow_msgs(command,
+                               sw,
+                               flow["src_ip"],
+                               flow["dst_ip"],
+                               flow["outport"],
+                               flow["revoutport"]))
+        fids = dpids.setdefault(sw.dpid, [])
+        if command == OFPFC_ADD and flow.get("fid") is not None:
+            fids.append(flow["fid"])
+
+    for arp in arps:
+        sw = Switch(arp["sw_name"], arp["sw_ip"], arp["sw_dpid"])
+        msgs.append(_arp_msg(command, sw, arp["mac"]))
+        dpids.setdefault(sw.dpid, [])
+
+    sent = time.time()
+    msgs.extend(BarrierMessage(dpid, fids, sent)
+                for dpid, fids in dpids.items())
     pc.stop()
-    conn.send(msg1)
-    conn.send(msg2)
-    conn.send(arp1)
-    conn.send(arp2)
-    conn.send(BarrierMessage(sw.dpid))
+
+    if msgs:
+        getSender().send(FlowModBatch(msgs))
+
+    # report this trigger's counters before the backend goes idle
+    ravel.profiling.flush()
+
+def _send_msg(command, flow_id, sw, src_ip, src_mac, dst_ip, dst_mac, outport,
+              revoutport):
+    flow = { "fid" : flow_id,
+             "sw_name" : sw.name,
+             "sw_ip" : sw.ip,
+             "sw_dpid" : sw.dpid,
+             "src_ip" : src_ip,
+             "dst_ip" : dst_ip,
+             "outport" : outport,
+             "revoutport" : revoutport }
+    arps = [{ "sw_name" : sw.name,
+              "sw_ip" : sw.ip,
+              "sw_dpid" : sw.dpid,
+              "mac" : mac } for mac in (src_mac, dst_mac)]
+    _send_msgs(command, [flow], arps)
+
+def arpDelta(flows):
+    """Count the rules in a batch relying on each switch's ARP flood rules,
+       one per host at either end of the flow
+       flows: an iterable of dictionaries with keys sid, src_mac and dst_mac
+       returns: parallel lists of switch ids, MAC addresses and counts"""
+    counts = {}
+    for flow in flows:
+        for mac in set([flow["src_mac"], flow["dst_mac"]]):
+            if mac is not None:
+                key = (flow["sid"], mac)
+                counts[key] = counts.get(key, 0) + 1
+
+    keys = list(counts.keys())
+    return ([k[0] for k in keys],
+            [k[1] for k in keys],
+            [counts[k] for k in keys])
+
+def arpRules(flows, refs):
+    """Build the ARP flood rules to install or remove
+       flows: an iterable of dictionaries with keys sid, sw_name, sw_ip and
+       sw_dpid, as passed to installFlows
+       refs: an iterable of dictionaries with keys sid and mac, one per rule
+       whose reference count crossed zero
+       returns: a list of dictionaries, as passed to installFlows"""
+    switches = {}
+    for flow in flows:
+        switches[flow["sid"]] = flow
+
+    arps = []
+    for ref in refs:
+        sw = switches[ref["sid"]]
+        arps.append({ "sw_name" : sw["sw_name"],
+                      "sw_ip" : sw["sw_ip"],
+                      "sw_dpid" : sw["sw_dpid"],
+                      "mac" : ref["mac"] })
+    return arps
+
+def installFlows(flows, arps=None):
+    """Construct add-flow messages for a batch of per-switch rules and send
+       them to the OpenFlow manager.  Installs the forward and reverse paths
+       flows: an iterable of dictionaries, one per rule, with keys fid,
+       sw_name, sw_ip, sw_dpid, src_ip, dst_ip, outport and revoutport (eg,
+       rows of flow_lookup)
+       arps: an iterable of dictionaries with keys sw_name, sw_ip, sw_dpid
+       and mac, one per ARP flood rule to install (ie, the rules whose
+       reference count went from 0 to 1)"""
+    _send_msgs(OFPFC_ADD, flows, arps or [])
+
+def removeFlows(flows, arps=None):
+    """Construct delete-flow messages for a batch of per-switch rules and
+       send them to the OpenFlow manager.  Removes the forward and reverse
+       paths
+       flows: an iterable of dictionaries, one per rule, with the same keys
+       as for installFlows
+       arps: an iterable of dictionaries, one per ARP flood rule to remove
+       (ie, the rules whose reference count dropped to 0), with the same
+       keys as for installFlows"""
+    _send_msgs(OFPFC_DELETE_STRICT, flows, arps or [])
 
 def installFlow(flowid, sw, src_ip, src_mac, dst_ip, dst_mac, outport,
                 revoutport):
@@ -119,6 +237,8 @@ def removeFlow(flowid, sw, src_ip, src_mac, dst_ip, dst_mac, outport,
 class Switch(object):
     "A representation of an OpenFlow switch"
 
+    __slots__ = ("name", "ip", "dpid")
+
     def __init__(self, name, ip, dpid):
         """name: a Mininet-style name for the switch
            ip: the IP address of the switch, if it is remote
@@ -136,6 +256,8 @@ class Switch(object):
 class Match(object):
     "A match object for an OpenFlow flow modification message"
 
+    __slots__ = ("nw_src", "nw_dst", "dl_src", "dl_dst", "dl_type")
+
     def __init__(self, nw_src=None, nw_dst=None,
                 dl_src=None, dl_dst=None, dl_type=None):
        """nw_src: the source node's network address
@@ -162,6 +284,8 @@ class Match(object):
 class OfMessage(ravel.messaging.ConsumableMessage):
     "A OpenFlow flow modification message"
 
+    __slots__ = ("command", "priority", "switch", "match", "actions")
+
     def __init__(self, command=None, priority=1, switch=None,
                  match=None, actions=None):
         """command: an OpenFlow flow modification command
@@ -182,6 +306,11 @@ class OfMessage(ravel.messaging.ConsumableMessage):
            consumer: a ravel.of.OfManager instance to consume the message"""
         consumer.sendFlowmod(self)
 
+    def partition(self):
+        """returns: a list of (key, message) tuples, keyed by the dpid of
+           the switch to send the message"""
+        return [(self.switch.dpid, self)]
+
     def __repr__(self):
         return str(self)
 
@@ -193,11 +322,223 @@ class OfMessage(ravel.messaging.ConsumableMessage):
 class BarrierMessage(ravel.messaging.ConsumableMessage):
     """An OpenFlow barrier message"""
 
-    def __init__(self, dpid):
-        "dpid: the dpid of the switch to send the barrier message"
+    __slots__ = ("dpid", "fids", "sent")
+
+    def __init__(self, dpid, fids=None, sent=None):
+        """dpid: the dpid of the switch to send the barrier message
+           fids: ids of the flows installed by the flowmods preceding the
+           barrier, confirmed when the switch replies
+           sent: when the flowmods were sent, in seconds since the epoch"""
         self.dpid = dpid
+        self.fids = fids
+        self.sent = sent
+        if fids is None:
+            self.fids = []
 
     def consume(self, consumer):
         """Consume the message
            consumer: a ravel.of.OfManager instance to consume the message"""
-        consumer.sendBarrier(self.dpid)
+        consumer.sendBarrier(self.dpid, self.fids, self.sent)
+
+    def partition(self):
+        """returns: a list of (key, message) tuples, keyed by the dpid of
+           the switch to send the message"""
+        return [(self.dpid, self)]
+
+class FlowModBatch(ravel.messaging.ConsumableMessage):
+    """A batch of flow modification and barrier messages for any number of
+       switches, sent to the OpenFlow manager as a single message"""
+
+    __slots__ = ("msgs",)
+
+    def __init__(self, msgs=None):
+        """msgs: a list of OfMessage and BarrierMessage instances, in the
+           order they should be sent"""
+        self.msgs = msgs
+        if msgs is None:
+            self.msgs = []
+
+    def append(self, msg):
+        """Add a message to the end of the batch
+           msg: an OfMessage or BarrierMessage instance"""
+        self.msgs.append(msg)
+
+    def split(self):
+        """Split the batch in two, preserving message order
+           returns: a list of two FlowModBatch instances"""
+        mid = len(self.msgs) // 2
+        return [FlowModBatch(self.msgs[:mid]), FlowModBatch(self.msgs[mid:])]
+
+    def consume(self, consumer):
+        """Consume the message
+           consumer: a ravel.of.OfManager instance to consume the message"""
+        consumer.sendFlowmodBatch(self)
+
+    def partition(self):
+        """Split the batch into one batch per switch, preserving the order
+           of each switch's messages
+           returns: a list of (dpid, FlowModBatch) tuples"""
+        batches = OrderedDict()
+        for msg in self.msgs:
+            for key, part in msg.partition():
+                batches.setdefault(key, []).append(part)
+        return [(key, FlowModBatch(msgs)) for key, msgs in batches.items()]
+
+    def __len__(self):
+        return len(self.msgs)
+
+    def __repr__(self):
+        return str(self)
+
+    def __str__(self):
+        return "batch of {0} messages".format(len(self.msgs))
+
+# binary layouts for ravel.codec
+_OfMessageCode = 2
+_BarrierMessageCode = 3
+_FlowModBatchCode = 4
+
+_ofmsg = struct.Struct("!BHB")
+_dltype = struct.Struct("!H")
+_port = struct.Struct("!H")
+_count = struct.Struct("!I")
+_item = struct.Struct("!BI")
+_sent = struct.Struct("!d")
+_fid = struct.Struct("!i")
+
+# Match field presence bits
+_NwSrc = 0x01
+_NwDst = 0x02
+_DlSrc = 0x04
+_DlDst = 0x08
+_DlType = 0x10
+# addresses are packed as strings, when one is not a dotted IPv4 address or
+# a colon-separated MAC address
+_Text = 0x80
+
+def _pack_addrs(match, pack_ip, pack_mac):
+    flags = 0
+    fields = []
+    if match.nw_src is not None:
+        flags |= _NwSrc
+        fields.append(pack_ip(match.nw_src))
+    if match.nw_dst is not None:
+        flags |= _NwDst
+        fields.append(pack_ip(match.nw_dst))
+    if match.dl_src is not None:
+        flags |= _DlSrc
+        fields.append(pack_mac(match.dl_src))
+    if match.dl_dst is not None:
+        flags |= _DlDst
+        fields.append(pack_mac(match.dl_dst))
+    return flags, fields
+
+def _encode_ofmessage(msg):
+    match = msg.match
+    try:
+        flags, fields = _pack_addrs(match, ravel.codec.pack_ip,
+                                    ravel.codec.pack_mac)
+    except (OSError, ValueError):
+        flags, fields = _pack_addrs(match, ravel.codec.pack_str,
+                                    ravel.codec.pack_str)
+        flags |= _Text
+
+    if match.dl_type is not None:
+        flags |= _DlType
+        fields.append(_dltype.pack(match.dl_type))
+
+    sw = msg.switch
+    return b"".join([_ofmsg.pack(msg.command, msg.priority, flags),
+                     ravel.codec.pack_str(sw.name),
+                     ravel.codec.pack_str(sw.ip),
+                     ravel.codec.pack_str(sw.dpid)] +
+                    fields +
+                    [bytes([len(msg.actions)])] +
+                    [_port.pack(a) for a in msg.actions])
+
+def _decode_ofmessage(data, offset):
+    command, priority, flags = _ofmsg.unpack_from(data, offset)
+    offset += _ofmsg.size
+    name, offset = ravel.codec.unpack_str(data, offset)
+    ip, offset = ravel.codec.unpack_str(data, offset)
+    dpid, offset = ravel.codec.unpack_str(data, offset)
+
+    unpack_ip = ravel.codec.unpack_ip
+    unpack_mac = ravel.codec.unpack_mac
+    if flags & _Text:
+        unpack_ip = unpack_mac = ravel.codec.unpack_str
+
+    match = Match()
+    if flags & _NwSrc:
+        match.nw_src, offset = unpack_ip(data, offset)
+    if flags & _NwDst:
+        match.nw_dst, offset = unpack_ip(data, offset)
+    if flags & _DlSrc:
+        match.dl_src, offset = unpack_mac(data, offset)
+    if flags & _DlDst:
+        match.dl_dst, offset = unpack_mac(data, offset)
+    if flags & _DlType:
+        match.dl_type, = _dltype.unpack_from(data, offset)
+        offset += _dltype.size
+
+    nactions = data[offset]
+    offset += 1
+    actions = []
+    for i in range(nactions):
+        actions.append(_port.unpack_from(data, offset)[0])
+        offset += _port.size
+
+    msg = OfMessage(command=command,
+                    priority=priority,
+                    switch=Switch(name, ip, dpid),
+                    match=match,
+                    actions=actions)
+    return msg, offset
+
+def _encode_barrier(msg):
+    sent = msg.sent if msg.sent is not None else float("nan")
+    return b"".join([ravel.codec.pack_str(msg.dpid),
+                     _sent.pack(sent),
+                     _count.pack(len(msg.fids))] +
+                    [_fid.pack(fid) for fid in msg.fids])
+
+def _decode_barrier(data, offset):
+    dpid, offset = ravel.codec.unpack_str(data, offset)
+    sent, = _sent.unpack_from(data, offset)
+    offset += _sent.size
+    count, = _count.unpack_from(data, offset)
+    offset += _count.size
+    fids = []
+    for i in range(count):
+        fids.append(_fid.unpack_from(data, offset)[0])
+        offset += _fid.size
+    if sent != sent:
+        sent = None
+    return BarrierMessage(dpid, fids, sent), offset
+
+def _encode_batch(batch):
+    parts = [_count.pack(len(batch.msgs))]
+    for msg in batch.msgs:
+        code, body = ravel.codec.encode_body(msg)
+        parts.append(_item.pack(code, len(body)))
+        parts.append(body)
+    return b"".join(parts)
+
+def _decode_batch(data, offset):
+    count, = _count.unpack_from(data, offset)
+    offset += _count.size
+    msgs = []
+    for i in range(count):
+        code, length = _item.unpack_from(data, offset)
+        offset += _item.size
+        msg, _ = ravel.codec.decode_body(code, data, offset, offset + length)
+        msgs.append(msg)
+        offset += length
+    return FlowModBatch(msgs), offset
+
+ravel.codec.register(_OfMessageCode, OfMessage,
+                     _encode_ofmessage, _decode_ofmessage)
+ravel.codec.register(_BarrierMessageCode, BarrierMessage,
+                     _encode_barrier, _decode_barrier)
+ravel.codec.register(_FlowModBatchCode, FlowModBatch,
+                     _encode_batch, _decode_batch)
@@ -3,18 +3,48 @@ Abstraction for communicating between Ravel's processes: the main CLI, the
 OpenFlow manager, and the database triggers.
 """
 
+import fcntl
+import mmap
 import os
-import pickle
+import queue
+import re
+import select
+import socket
+import socketserver
+import struct
+import subprocess
 import threading
 import time
-import xmlrpc.client
+from collections import OrderedDict
+
 import sysv_ipc
-from xmlrpc.server import SimpleXMLRPCServer
 
+import ravel.codec
 import ravel.profiling
+import ravel.util
 from ravel.log import logger
 from ravel.of import OFPP_FLOOD, OFPFC_ADD, OFPFC_DELETE, OFPFC_DELETE_STRICT
 
+# priority lanes, sent as System V message types: a receiver takes the
+# lowest lane's messages first
+LaneControl = 1
+LaneFlow = 2
+LaneProfile = 3
+Lanes = 3
+
+MsgMaxPath = "/proc/sys/kernel/msgmax"
+DefaultMsgMax = 8192
+
+def msgmax():
+    """Get the largest message, in bytes, the kernel accepts on a System V
+       message queue
+       returns: the value of kernel.msgmax, or a default if unavailable"""
+    try:
+        with open(MsgMaxPath) as f:
+            return int(f.read().strip())
+    except (IOError, ValueError):
+        return DefaultMsgMax
+
 def clear_queue(queue_id):
     try:
         mq = sysv_ipc.MessageQueue(queue_id,
@@ -26,13 +56,26 @@ def clear_queue(queue_id):
                        .format(queue_id))
 
 class ConsumableMessage(object):
-    "A consumable message"
+    """A consumable message.  lane is the message's priority lane: control
+       messages overtake flow messages queued before them, while messages in
+       the same lane are received in order"""
+
+    __slots__ = ()
+
+    lane = LaneFlow
 
     def consume(self, consumer):
         """Consume the message
            consumer: an object containing a function to consume the message"""
         pass
 
+    def partition(self):
+        """Split the message by the switch it applies to, so a receiver can
+           consume different switches' messages in parallel
+           returns: a list of (key, message) tuples, where key is a switch's
+           dpid or None if the message applies to no particular switch"""
+        return [(None, self)]
+
 class MessageSender(object):
     "A message sender"
 
@@ -53,84 +96,419 @@ class MessageReceiver(object):
            event: an optional quit message"""
         pass
 
-class MsgQueueSender(MessageSender):
-    "A message queue-based message sender"
+class PersistentSender(MessageSender):
+    """A message sender that opens its connection once and reuses it for
+       every message, reconnecting if a send fails.  Database triggers keep
+       one per backend session so the connect cost is paid once, not once
+       per rule"""
+
+    def __init__(self, factory):
+        "factory: a function returning a new MessageSender"
+        self.factory = factory
+        self.sender = None
+
+    def send(self, msg):
+        """Send the specified message, reconnecting and retrying once if
+           the connection has failed.  Errors encoding the message would
+           fail again on a new connection, so they are raised at once
+           msg: the message to send"""
+        if self.sender is None:
+            self.sender = self.factory()
+
+        try:
+            self.sender.send(msg)
+        except (OSError, sysv_ipc.Error) as e:
+            logger.warning("send failed, reconnecting: %s", e)
+            self.sender = self.factory()
+            self.sender.send(msg)
+
+    def stats(self):
+        """returns: the underlying sender's statistics, connecting if
+           needed, or None if the sender does not keep any"""
+        if self.sender is None:
+            self.sender = self.factory()
+
+        if not hasattr(self.sender, "stats"):
+            return None
+        return self.sender.stats()
+
+class SpillLog(object):
+    """An append-only file of encoded messages that could not be sent
+       because a message queue was full.  Senders append to the log under
+       an exclusive lock, and the receiver drains it once the queue has
+       emptied, so spilled messages are consumed in the order sent"""
+
+    frame = struct.Struct("!I")
+
+    def __init__(self, path):
+        "path: the path of the log file"
+        self.path = path
+
+    def pending(self):
+        "returns: true if the log holds messages not yet drained"
+        return self.size() > 0
+
+    def size(self):
+        "returns: the number of bytes in the log not yet drained"
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def append(self, data):
+        """Append a message to the log
+           data: the encoded message"""
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            os.write(fd, SpillLog.frame.pack(len(data)) + data)
+        finally:
+            os.close(fd)
+
+    def drain(self):
+        """Read and remove all messages in the log
+           returns: a list of the encoded messages"""
+        try:
+            fd = os.open(self.path, os.O_RDWR)
+        except OSError:
+            return []
 
-    def __init__(self, queue_id):
-        "queue_id: the integer id of the queue to be used"
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            buf = bytearray()
+            chunk = os.read(fd, 1 << 20)
+            while chunk:
+                buf.extend(chunk)
+                chunk = os.read(fd, 1 << 20)
+            os.ftruncate(fd, 0)
+        finally:
+            os.close(fd)
+
+        msgs = []
+        offset = 0
+        while offset + SpillLog.frame.size <= len(buf):
+            n, = SpillLog.frame.unpack_from(buf, offset)
+            offset += SpillLog.frame.size
+            msgs.append(bytes(buf[offset:offset + n]))
+            offset += n
+        return msgs
+
+    def clear(self):
+        "Remove the log"
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+def spill_path(queue_id):
+    """Get the path of the spill log for a message queue
+       queue_id: the integer id of the queue"""
+    return os.path.join(ravel.util.Config.SpillDir,
+                        "ravel_mq_{0}.spill".format(queue_id))
+
+class MsgQueueSender(MessageSender):
+    """A message queue-based message sender.  Messages are sent without
+       blocking; if the queue is full, the sender retries for up to timeout
+       seconds and then spills the message to an on-disk log that the
+       receiver drains.  While the log holds messages, later messages are
+       spilled too, to keep them in order"""
+
+    def __init__(self, queue_id, timeout=None):
+        """queue_id: the integer id of the queue to be used
+           timeout: seconds to retry sending to a full queue before
+           spilling, defaults to Config.SendTimeout"""
         self.queue_id = queue_id
+        self.maxsize = msgmax()
+        self.timeout = timeout
+        if self.timeout is None:
+            self.timeout = ravel.util.Config.SendTimeout
+        self.spill = SpillLog(spill_path(queue_id))
+        self.sent = 0
+        self.bytes = 0
+        self.stalls = 0
+        self.spilled = 0
         pc = ravel.profiling.PerfCounter("mq_connect")
         pc.start()
         try:
             self.mq = sysv_ipc.MessageQueue(self.queue_id,
-                                            mode=0o777)
+                                            mode=0o777,
+                                            max_message_size=self.maxsize)
         except sysv_ipc.ExistentialError as e:
             logger.warning("queue {0} does not exist: {1}"
                            .format(self.queue_id, e))
             self.mq = sysv_ipc.MessageQueue(self.queue_id,
                                             sysv_ipc.IPC_CREAT,
-                                            mode=0o777)
+                                            mode=0o777,
+                                            max_message_size=self.maxsize)
         pc.stop()
 
     def send(self, msg):
-        """Send the specified message
+        """Send the specified message.  Batches too large for a single
+           queue message are split and sent in order; a message that is too
+           large and cannot be split is spilled, since the spill log has no
+           size limit
            msg: the message to send"""
+        data = ravel.codec.encode(msg)
+        if len(data) > self.maxsize and hasattr(msg, "split") and len(msg) > 1:
+            for part in msg.split():
+                self.send(part)
+            return
+
+        if len(data) > self.maxsize:
+            logger.warning("mq: %s byte message exceeds the queue's %s byte "
+                           "limit, spilling it", len(data), self.maxsize)
+            self._spill(data)
+            return
+
+        # control messages may overtake spilled flow messages
+        lane = getattr(msg, "lane", LaneFlow)
         pc = ravel.profiling.PerfCounter("mq_send")
         pc.start()
         logger.debug("mq: sending message %s", msg)
-        self.mq.send(pickle.dumps(msg))
+        spill = lane >= LaneFlow and self.spill.pending()
+        if spill or not self._send(data, lane):
+            self._spill(data)
+        else:
+            self.sent += 1
+            self.bytes += len(data)
+        pc.stop()
+
+    def _send(self, data, lane):
+        try:
+            self.mq.send(data, block=False, type=lane)
+            return True
+        except sysv_ipc.BusyError:
+            pass
+
+        # the queue is full: back off and retry until the timeout
+        self.stalls += 1
+        pc = ravel.profiling.PerfCounter("mq_stall")
+        pc.start()
+        delay = 0.0005
+        deadline = time.time() + self.timeout
+        while time.time() < deadline:
+            time.sleep(delay)
+            delay = min(delay * 2, 0.02)
+            try:
+                self.mq.send(data, block=False, type=lane)
+                pc.stop()
+                return True
+            except sysv_ipc.BusyError:
+                pass
+        pc.stop()
+        return False
+
+    def _spill(self, data):
+        pc = ravel.profiling.PerfCounter("mq_spill")
+        pc.start()
+        self.spill.append(data)
+        self.spilled += 1
         pc.stop()
 
+    def stats(self):
+        """returns: a dictionary of the sender's message counts, the bytes
+           waiting in the spill log, and the queue's depth and capacity"""
+        stats = OrderedDict()
+        stats["sent"] = self.sent
+        stats["bytes"] = self.bytes
+        stats["stalls"] = self.stalls
+        stats["spilled"] = self.spilled
+        stats["spill_bytes"] = self.spill.size()
+        try:
+            stats["depth"] = self.mq.current_messages
+            stats["max_bytes"] = self.mq.max_size
+        except sysv_ipc.Error:
+            stats["depth"] = None
+            stats["max_bytes"] = None
+        return stats
+
 class MsgQueueReceiver(MessageReceiver):
-    "A message queue-based message receiver"
+    """A message queue-based message receiver.  With more than one worker,
+       messages are partitioned by switch (see ConsumableMessage.partition)
+       so each switch's messages are consumed in order by the same worker
+       while different switches are consumed in parallel.  Messages spilled
+       by senders when the queue was full are drained once the queue
+       empties"""
+
+    spill_interval = 0.1
 
-    def __init__(self, queue_id, consumer=None):
+    def __init__(self, queue_id, consumer=None, workers=1):
         """queue_id: the integer id of the queue to receive messages from
-           consumer: the consuming object for received messages"""
+           consumer: the consuming object for received messages
+           workers: the number of worker threads consuming messages"""
         self.queue_id = queue_id
         self.consumer = consumer
         self.running = False
-        # clear message queue
+        self.workers = max(1, workers or 1)
+        self.queues = []
+        self.threads = []
+        self.received = 0
+        self.drained = 0
+        self.maxdepth = [0] * self.workers
+        # clear message queue and any messages spilled before it was cleared
         clear_queue(self.queue_id)
+        self.spill = SpillLog(spill_path(self.queue_id))
+        self.spill.clear()
         self.mq = sysv_ipc.MessageQueue(self.queue_id,
                                         sysv_ipc.IPC_CREAT,
-                                        mode=0o777)
+                                        mode=0o777,
+                                        max_message_size=msgmax())
 
     def start(self):
         "Start a new thread to receive messages"
         logger.debug("mq_receiver starting")
         self.running = True
+        if self.workers > 1:
+            self.queues = [queue.Queue() for i in range(self.workers)]
+            self.threads = [threading.Thread(target=self._work, args=(q,))
+                            for q in self.queues]
+            for t in self.threads:
+                t.daemon = True
+                t.start()
+
+        self.watcher = threading.Thread(target=self._watch)
+        self.watcher.daemon = True
+        self.watcher.start()
         self.t = threading.Thread(target=self._run)
         self.t.start()
 
-    def _run(self):
+    def _consume(self, obj):
+        try:
+            obj.consume(self.consumer)
+        except Exception as e:
+            logger.warning("mq: error consuming message %s: %s", obj, e)
+        ravel.profiling.flush()
+
+    def _work(self, q):
+        while True:
+            obj = q.get()
+            if obj is None:
+                break
+            self._consume(obj)
+
+    def _dispatch(self, obj):
+        partition = getattr(obj, "partition", None)
+        parts = partition() if partition is not None else [(None, obj)]
+        for key, part in parts:
+            idx = hash(key) % self.workers if key is not None else 0
+            q = self.queues[idx]
+            q.put(part)
+            depth = q.qsize()
+            if depth > self.maxdepth[idx]:
+                self.maxdepth[idx] = depth
+
+    def _watch(self):
+        # wake the receiver to drain the spill log once every message sent
+        # before the spill has been received
         while self.running:
-            s,_ = self.mq.receive() # s is bytes object under python3 instead of str under python2
-            msg = s.decode("utf-8", "ignore") # decode() returns str under python3, returns unicode under python2
-            # obj = pickle.loads(msg)
-            obj = msg
-            logger.debug("mq: received message %s", msg)
-            # if obj is not None:
-            if type(obj) is not str:
-                obj.consume(self.consumer)
+            time.sleep(MsgQueueReceiver.spill_interval)
+            try:
+                if self.spill.pending() and self.mq.current_messages == 0:
+                    self.mq.send(ravel.codec.encode(None), block=False,
+                                 type=LaneFlow)
+            except sysv_ipc.Error:
+                pass
+
+    def _handle(self, data):
+        # returns: true if the message was a wakeup (an encoded None)
+        try:
+            obj = ravel.codec.decode(data)
+        except Exception as e:
+            logger.warning("mq: could not decode message: %s", e)
+            return False
+
+        logger.debug("mq: received message %s", obj)
+        if obj is None:
+            return True
+
+        self.received += 1
+        if self.workers > 1 and getattr(obj, "lane", LaneFlow) >= LaneFlow:
+            self._dispatch(obj)
+        else:
+            self._consume(obj)
+        return False
+
+    def _run(self):
+        # after stop, keep receiving until the stop message or an empty
+        # queue, so messages queued before it are still consumed
+        while True:
+            try:
+                s,_ = self.mq.receive(block=self.running, type=-Lanes)
+            except (sysv_ipc.BusyError, sysv_ipc.ExistentialError):
+                break
+
+            if self._handle(s):
+                for data in self.spill.drain():
+                    self.drained += 1
+                    self._handle(data)
+                if not self.running:
+                    break
+
+        for q in self.queues:
+            q.put(None)
+
+    def stats(self):
+        """returns: a dictionary of the receiver's message counts and queue
+           depths"""
+        stats = OrderedDict()
+        stats["received"] = self.received
+        stats["spill_drained"] = self.drained
+        try:
+            stats["mq_depth"] = self.mq.current_messages
+        except sysv_ipc.Error:
+            stats["mq_depth"] = None
+        stats["workers"] = self.workers
+        stats["depth"] = [q.qsize() for q in self.queues]
+        stats["max_depth"] = self.maxdepth
+        return stats
 
     def stop(self, event=None):
         """Stop the receiver thread
            event: an optional quit message"""
         self.running = False
-        self.mq.send(pickle.dumps(None))
+        # in the last lane, so messages already queued are consumed first.
+        # If the queue is full, the receiver is not blocked waiting for it
+        try:
+            self.mq.send(ravel.codec.encode(None), block=False, type=Lanes)
+        except (sysv_ipc.BusyError, sysv_ipc.ExistentialError):
+            pass
+
+# rpc frames: a request is its length and id followed by the encoded
+# message, and the receiver acknowledges each request with its id and status
+_rpc_request = struct.Struct("!II")
+_rpc_ack = struct.Struct("!IB")
+RpcOk = 0
+RpcError = 1
+
+def _recv_exact(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            return None
+        buf.extend(chunk)
+    return buf
 
 class RpcSender(MessageSender):
-    "A remote procedure call-based message sender"
+    """A remote procedure call-based message sender.  Messages are sent as
+       length-prefixed frames over a persistent TCP connection, and up to
+       window requests are pipelined before the sender waits for the
+       receiver's acknowledgements"""
+
+    window = 64
 
     def __init__(self, host, port):
         """host: the hostname or IP address of the RPC server
            port: the port for the RPC server"""
-        self.addr = "http://{0}:{1}".format(host, port)
+        self.addr = (host, port)
         pc = ravel.profiling.PerfCounter("rpc_connect")
         pc.start()
-        self.proxy = xmlrpc.client.ServerProxy(self.addr, allow_none=True)
+        self.sock = socket.create_connection(self.addr)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         pc.stop()
+        self.nextid = 0
+        self.pending = 0
+        self.buf = bytearray()
 
     def send(self, msg):
         """Send the specified message
@@ -138,79 +516,396 @@ class RpcSender(MessageSender):
         logger.debug("rpc: sending message %s", msg)
         pc = ravel.profiling.PerfCounter("rpc_send")
         pc.start()
-        self.proxy.client_send(pickle.dumps(msg))
+        data = ravel.codec.encode(msg)
+        self.nextid = (self.nextid + 1) & 0xFFFFFFFF
+        self.sock.sendall(_rpc_request.pack(len(data), self.nextid) + data)
+        self.pending += 1
+        self._acks(self.pending >= RpcSender.window)
         pc.stop()
 
+    def flush(self):
+        "Wait for the receiver to acknowledge all sent messages"
+        while self.pending > 0:
+            self._acks(True)
+
+    def _acks(self, block):
+        # read acknowledgements already received, or wait for at least one
+        while self.pending > 0:
+            timeout = None if block else 0
+            readable, _, _ = select.select([self.sock], [], [], timeout)
+            if not readable:
+                return
+
+            data = self.sock.recv(4096)
+            if not data:
+                raise ConnectionError("rpc: connection closed by receiver")
+            self.buf.extend(data)
+
+            n = len(self.buf) // _rpc_ack.size
+            for i in range(n):
+                rid, status = _rpc_ack.unpack_from(self.buf, i * _rpc_ack.size)
+                if status != RpcOk:
+                    logger.warning("rpc: receiver failed to consume "
+                                   "message %s", rid)
+            del self.buf[:n * _rpc_ack.size]
+            self.pending -= n
+            if n > 0:
+                block = False
+
+class _RpcHandler(socketserver.BaseRequestHandler):
+    # one thread per connection, so each sender's messages are consumed in
+    # the order they were sent
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        receiver = self.server.receiver
+        while receiver.running:
+            header = _recv_exact(self.request, _rpc_request.size)
+            if header is None:
+                return
+
+            length, rid = _rpc_request.unpack(header)
+            data = _recv_exact(self.request, length)
+            if data is None:
+                return
+
+            status = RpcOk
+            try:
+                obj = ravel.codec.decode(data)
+                logger.debug("rpc: received message %s", obj)
+                if obj is not None:
+                    obj.consume(receiver.consumer)
+            except Exception as e:
+                logger.warning("rpc: error consuming message: %s", e)
+                status = RpcError
+            ravel.profiling.flush()
+            self.request.sendall(_rpc_ack.pack(rid, status))
+
+class _RpcServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
 class RpcReceiver(MessageReceiver):
     "A remote procedure call-based message receiver"
 
     def __init__(self, host, port, consumer=None):
-        """host: the hostname or IP address of the RPC server
-           port: the port for the RPC server
+        """host: the hostname or IP address to listen on
+           port: the port to listen on
            consumer: the consuming object for received messages"""
         self.host = host
         self.port = port
         self.consumer = consumer
-        self.server = SimpleXMLRPCServer((host, port),
-                                         logRequests=False,
-                                         allow_none=True)
-        self.server.register_function(self._client_send, "client_send")
-        self.msg = None
-
-    def _client_send(self, msg):
-        obj = pickle.loads(msg)
-        logger.debug("rpc: received message %s", msg)
-        if obj is not None:
-            print("CONSUMING MESSAGE", obj)
-            obj.consume(self.consumer)
+        self.running = False
+        self.server = _RpcServer((host, port), _RpcHandler)
+        self.server.receiver = self
 
     def start(self):
         "Start a new thread to receive messages"
         logger.debug("rpc_receiver starting")
         self.running = True
+        self.t = threading.Thread(target=self.server.serve_forever)
+        self.t.start()
+
+    def stop(self, event=None):
+        """Stop the receiver thread
+           event: an optional quit message"""
+        self.running = False
+        self.server.shutdown()
+        self.server.server_close()
+
+class ShmRing(object):
+    """A ring buffer of length-prefixed messages in a memory-mapped file
+       shared by any number of sending processes and one receiving process.
+       Senders serialize on an exclusive lock on the file and advance the
+       head; the receiver reads frames in place without locking and advances
+       the tail.  Frames never wrap: a frame that does not fit before the
+       end of the ring is preceded by padding and written at the start.  A
+       System V semaphore wakes the receiver when it is waiting on an empty
+       ring"""
+
+    magic = b"RVRB"
+    header = struct.Struct("=4sIQQQI")
+    frame = struct.Struct("=I")
+    pad = 0xFFFFFFFF
+    datastart = 64
+
+    # header field offsets
+    capacity_off = 8
+    head_off = 16
+    tail_off = 24
+    waiting_off = 32
+
+    def __init__(self, path, size, sem_id, create=False):
+        """path: the path of the file backing the ring, eg in /dev/shm
+           size: the size of the ring's data area in bytes
+           sem_id: the integer id of the semaphore used for wakeups
+           create: if true, create or reset the ring (done by the receiver)"""
+        self.path = path
+        flags = os.O_RDWR | os.O_CREAT if create else os.O_RDWR
+        self.fd = os.open(path, flags, 0o666)
+        if create:
+            os.ftruncate(self.fd, ShmRing.datastart + size)
+
+        self.buf = mmap.mmap(self.fd, 0)
+        if create:
+            ShmRing.header.pack_into(self.buf, 0, ShmRing.magic, 0, size,
+                                     0, 0, 0)
+        elif self.buf[:4] != ShmRing.magic:
+            raise ValueError("{0} is not a message ring".format(path))
+
+        self.capacity, = struct.unpack_from("=Q", self.buf,
+                                            ShmRing.capacity_off)
+        self.maxsize = self.capacity // 2 - ShmRing.frame.size
+        self.sem = sysv_ipc.Semaphore(sem_id, sysv_ipc.IPC_CREAT,
+                                      mode=0o777, initial_value=0)
+
+    def _get(self, off):
+        return struct.unpack_from("=Q", self.buf, off)[0]
+
+    def _set(self, off, value):
+        struct.pack_into("=Q", self.buf, off, value)
+
+    def depth(self):
+        "returns: the number of bytes written and not yet read"
+        return self._get(ShmRing.head_off) - self._get(ShmRing.tail_off)
+
+    def write(self, data):
+        """Write a message to the ring, if there is space
+           data: the encoded message
+           returns: true if the message was written, false if the ring is
+           full"""
+        n = ShmRing.frame.size + len(data)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            head = self._get(ShmRing.head_off)
+            tail = self._get(ShmRing.tail_off)
+            pos = head % self.capacity
+            pad = self.capacity - pos if self.capacity - pos < n else 0
+            if self.capacity - (head - tail) < pad + n:
+                return False
+
+            if pad >= ShmRing.frame.size:
+                ShmRing.frame.pack_into(self.buf, ShmRing.datastart + pos,
+                                        ShmRing.pad)
+            if pad:
+                pos = 0
+
+            start = ShmRing.datastart + pos
+            ShmRing.frame.pack_into(self.buf, start, len(data))
+            self.buf[start + ShmRing.frame.size:start + n] = data
+
+            # publish the frame only once it is written
+            self._set(ShmRing.head_off, head + pad + n)
+            waiting, = struct.unpack_from("=I", self.buf, ShmRing.waiting_off)
+            if waiting:
+                struct.pack_into("=I", self.buf, ShmRing.waiting_off, 0)
+                self.sem.release()
+            return True
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def read(self):
+        """Read all messages in the ring, without copying them.  Each
+           message's space is released once the caller moves to the next one
+           returns: a generator of memoryviews of the encoded messages"""
+        view = memoryview(self.buf)
+        head = self._get(ShmRing.head_off)
+        tail = self._get(ShmRing.tail_off)
+        while tail < head:
+            pos = tail % self.capacity
+            remaining = self.capacity - pos
+            if remaining < ShmRing.frame.size:
+                tail += remaining
+                continue
+
+            start = ShmRing.datastart + pos
+            n, = ShmRing.frame.unpack_from(self.buf, start)
+            if n == ShmRing.pad:
+                tail += remaining
+                continue
+
+            start += ShmRing.frame.size
+            yield view[start:start + n]
+            tail += ShmRing.frame.size + n
+            self._set(ShmRing.tail_off, tail)
+        self._set(ShmRing.tail_off, tail)
+
+    def wait(self, timeout=None):
+        """Block until a sender writes to the ring
+           timeout: the maximum number of seconds to wait"""
+        struct.pack_into("=I", self.buf, ShmRing.waiting_off, 1)
+        if self.depth() > 0:
+            struct.pack_into("=I", self.buf, ShmRing.waiting_off, 0)
+            return
+
+        try:
+            self.sem.acquire(timeout)
+        except sysv_ipc.BusyError:
+            pass
+
+    def wake(self):
+        "Wake the receiver"
+        self.sem.release()
+
+    def close(self):
+        "Unmap the ring"
+        self.buf.close()
+        os.close(self.fd)
+
+class ShmSender(MessageSender):
+    """A shared memory ring buffer-based message sender.  If the ring is
+       full, the sender retries until timeout seconds have passed"""
+
+    timeout = 5.0
+
+    def __init__(self, path, size, sem_id):
+        """path: the path of the file backing the ring
+           size: the size of the ring's data area in bytes
+           sem_id: the integer id of the ring's wakeup semaphore"""
+        pc = ravel.profiling.PerfCounter("shm_connect")
+        pc.start()
+        try:
+            self.ring = ShmRing(path, size, sem_id)
+        except (OSError, ValueError) as e:
+            logger.warning("ring {0} does not exist: {1}".format(path, e))
+            self.ring = ShmRing(path, size, sem_id, create=True)
+        pc.stop()
+
+    def send(self, msg):
+        """Send the specified message.  Batches too large for the ring are
+           split and sent in order
+           msg: the message to send"""
+        data = ravel.codec.encode(msg)
+        if len(data) > self.ring.maxsize:
+            if hasattr(msg, "split") and len(msg) > 1:
+                for part in msg.split():
+                    self.send(part)
+                return
+            raise ValueError("message of {0} bytes does not fit in ring"
+                             .format(len(data)))
+
+        pc = ravel.profiling.PerfCounter("shm_send")
+        pc.start()
+        delay = 0.001
+        deadline = time.time() + ShmSender.timeout
+        while not self.ring.write(data):
+            if time.time() > deadline:
+                pc.stop()
+                raise IOError("ring {0} is full".format(self.ring.path))
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+        pc.stop()
+
+class ShmReceiver(MessageReceiver):
+    "A shared memory ring buffer-based message receiver"
+
+    def __init__(self, path, size, sem_id, consumer=None):
+        """path: the path of the file backing the ring
+           size: the size of the ring's data area in bytes
+           sem_id: the integer id of the ring's wakeup semaphore
+           consumer: the consuming object for received messages"""
+        self.consumer = consumer
+        self.running = False
+        self.ring = ShmRing(path, size, sem_id, create=True)
+
+    def start(self):
+        "Start a new thread to receive messages"
+        logger.debug("shm_receiver starting")
+        self.running = True
         self.t = threading.Thread(target=self._run)
         self.t.start()
 
     def _run(self):
         while self.running:
-            self.server.handle_request()
+            for data in self.ring.read():
+                try:
+                    obj = ravel.codec.decode(data)
+                except Exception as e:
+                    logger.warning("shm: could not decode message: %s", e)
+                    continue
+
+                logger.debug("shm: received message %s", obj)
+                if obj is None:
+                    continue
+
+                try:
+                    obj.consume(self.consumer)
+                except Exception as e:
+                    logger.warning("shm: error consuming message %s: %s",
+                                   obj, e)
+            ravel.profiling.flush()
+            self.ring.wait(0.1)
 
     def stop(self, event=None):
         """Stop the receiver thread
            event: an optional quit message"""
         self.running = False
-        addr = "http://{0}:{1}".format(self.host, self.port)
-        self.proxy = xmlrpc.client.ServerProxy(addr, allow_none=True)
-        self.proxy.client_send(pickle.dumps(None))
+        self.ring.wake()
 
 class OvsSender(MessageSender):
-    "A message sender using ovs-ofctl to communicate with switches"
-
-    command = "/usr/bin/sudo /usr/bin/ovs-ofctl"
-    subcmds = { OFPFC_ADD : "add-flow",
-                OFPFC_DELETE : "del-flows",
-                OFPFC_DELETE_STRICT : "--strict del-flows"
+    """A message sender using ovs-ofctl to communicate with switches.
+       Flowmods are buffered per bridge and applied with one
+       ovs-ofctl add-flows invocation (as an atomic bundle, if the switch
+       supports it) when a bridge's buffer is full, when the oldest buffered
+       flowmod has waited flush_interval seconds, or on a barrier or the end
+       of a batch"""
+
+    command = ["/usr/bin/sudo", "/usr/bin/ovs-ofctl"]
+    ops = { OFPFC_ADD : "add",
+            OFPFC_DELETE : "delete",
+            OFPFC_DELETE_STRICT : "delete_strict"
     }
 
+    batch_size = 1000
+    flush_interval = 0.05
+
+    # ovs-ofctl's errors when the switch or its OpenFlow version cannot
+    # open a bundle
+    unsupported = re.compile(r"bundle.*(not supported|unsupported|requires)|"
+                             r"OFPBRC_BAD_TYPE|OFPBFC_", re.I)
+
     def __init__(self):
-        pass
+        self.buffers = OrderedDict()
+        self.first = None
+        self.bundle = True
 
     def send(self, msg):
         """Send the specified OpenFlow message
            msg: the message to send"""
 
-        # don't need to handle barrier messages
+        # buffer a batch's flowmods, then apply them
+        if hasattr(msg, 'msgs'):
+            for m in msg.msgs:
+                self._buffer(m)
+            self.flush()
+            return
+
+        # barriers apply everything sent before them
         if not hasattr(msg, 'command'):
+            self.flush()
             return
 
-        pc = ravel.profiling.PerfCounter("ovs_send")
-        pc.start()
+        self._buffer(msg)
+        if time.time() - self.first >= OvsSender.flush_interval:
+            self.flush()
 
-        subcmd = OvsSender.subcmds[msg.command]
+    def _buffer(self, msg):
+        if not hasattr(msg, 'command'):
+            return
 
         # TODO: this is different for remote switches (ie, on physical network)
         dest = msg.switch.name
 
+        lines = self.buffers.setdefault(dest, [])
+        lines.append(self._line(msg))
+        if self.first is None:
+            self.first = time.time()
+
+        if len(lines) >= OvsSender.batch_size:
+            self._apply(dest, self.buffers.pop(dest))
+
+    def _line(self, msg):
         params = []
         if msg.match.nw_src is not None:
             params.append("nw_src={0}".format(msg.match.nw_src))
@@ -227,13 +922,44 @@ class OvsSender(MessageSender):
         actions = ["flood" if a == OFPP_FLOOD else str(a) for a in msg.actions]
 
         if msg.command == OFPFC_ADD:
-            params.append("action=output:" + ",".join(actions))
-
-        paramstr = ",".join(params)
-        cmd = "{0} {1} {2} {3}".format(OvsSender.command,
-                                       subcmd,
-                                       dest,
-                                       paramstr)
-        ret = os.system(cmd)
+            params.append("actions=output:" + ",".join(actions))
+
+        return "{0} {1}".format(OvsSender.ops[msg.command], ",".join(params))
+
+    def flush(self):
+        "Apply all buffered flowmods"
+        buffers = self.buffers
+        self.buffers = OrderedDict()
+        self.first = None
+        for dest, lines in buffers.items():
+            self._apply(dest, lines)
+
+    def _apply(self, dest, lines):
+        pc = ravel.profiling.PerfCounter("ovs_batch")
+        pc.start()
+
+        flows = "\n".join(lines) + "\n"
+        ret, err = self._ofctl(dest, flows, self.bundle)
+        if ret != 0 and self.bundle and OvsSender.unsupported.search(err):
+            # the switch does not support bundles (OpenFlow 1.4+)
+            logger.warning("ovs: %s does not support bundles, applying "
+                           "without bundles", dest)
+            self.bundle = False
+            ret, err = self._ofctl(dest, flows, False)
+
+        if ret != 0:
+            logger.error("ovs: failed to apply %s flowmods to %s: %s",
+                         len(lines), dest, err.strip())
         pc.stop()
         return ret
+
+    def _ofctl(self, dest, flows, bundle):
+        cmd = list(OvsSender.command)
+        if bundle:
+            cmd.append("--bundle")
+        cmd.extend(["add-flows", dest, "-"])
+        proc = subprocess.run(cmd,
+                              input=flows.encode("utf-8"),
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.PIPE)
+        return proc.returncode, proc.stderr.decode("utf-8", "ignore")
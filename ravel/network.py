@@ -16,6 +16,7 @@ through a command line or script).  Flow modifications for the Ravel backend
 import os
 import pickle
 import re
+import struct
 import tempfile
 import threading
 import time
@@ -28,9 +29,27 @@ from mininet.net import Mininet
 from mininet.node import RemoteController
 import sysv_ipc
 
+import ravel.codec
 import ravel.messaging
+import ravel.profiling
+from ravel.cache import TopologyCache
 from ravel.log import logger
 
+# persistent sender to the network provider's queue, reused across trigger
+# calls within a database session
+_sender = None
+
+def sendToProvider(msg):
+    """Send a topology message to the network provider over a persistent
+       message queue connection
+       msg: the message to send"""
+    global _sender
+    if _sender is None:
+        _sender = ravel.messaging.PersistentSender(
+            lambda: ravel.messaging.MsgQueueSender(NetworkProvider.QueueId))
+    _sender.send(msg)
+    ravel.profiling.flush()
+
 class NetworkProvider(object):
     """Superclass for a network provider.  A network provider exposes the
        underlying topology to Ravel's database and CLI.  It also receives
@@ -46,19 +65,39 @@ class NetworkProvider(object):
            db: a ravel.db.RavelDb instance"""
         self.db = db
         self.receiver = ravel.messaging.MsgQueueReceiver(queue_id, self)
-        self.cache_name = {}
-        self.cache_id = {}
+        self.topocache = TopologyCache(db)
+
+    @property
+    def cache_name(self):
+        """returns: a copy of the dictionary mapping node names to ids; use
+           node_id to look up a single node"""
+        return self.topocache.name_map()
+
+    @property
+    def cache_id(self):
+        """returns: a copy of the dictionary mapping node ids to names; use
+           node_name to look up a single node"""
+        return self.topocache.id_map()
+
+    def node_id(self, name):
+        """Look up a node in the topology cache without copying it
+           name: the name of a switch or host
+           returns: the node's id, or None"""
+        return self.topocache.node_id(name)
+
+    def node_name(self, nid):
+        """Look up a node in the topology cache without copying it
+           nid: the id of a switch or host
+           returns: the node's name, or None"""
+        return self.topocache.node_name(nid)
 
     def _on_update(self, msg):
         msg.consume(self)
 
     def cacheNodes(self):
-        """Cache node-name mapping in memory from database"""
-        self.db.cursor.execute("SELECT name, id FROM nodes;")
-        nodes = self.db.cursor.fetchall()
-        for name, nid in nodes:
-            self.cache_name[name] = nid
-            self.cache_id[nid] = name
+        """Load the topology cache from the database.  The cache is then
+           kept current by change notifications from the database"""
+        self.topocache.load()
 
     def addLink(self, msg):
         """Add a link to the topology
@@ -92,11 +131,13 @@ class NetworkProvider(object):
 
     def start(self):
         "Start the network provider and any components in the network"
+        self.topocache.start()
         self.receiver.start()
 
     def stop(self):
         "Stop the network provider and any components in the network"
         self.receiver.stop()
+        self.topocache.stop()
 
     def cli(self, cmd):
         """Pass commands to the network provider's CLI, if it has its own.
@@ -182,11 +223,13 @@ class EmptyNetProvider(NetworkProvider):
     def start(self):
         "Start the network provider"
         self.buildTopo()
+        self.topocache.start()
         self.receiver.start()
 
     def stop(self):
         "Stop the network provider"
         self.receiver.stop()
+        self.topocache.stop()
 
     def cli(self, cmd):
         "EmptyNetProvider has no CLI, raises warning"
@@ -219,9 +262,7 @@ class MininetProvider(NetworkProvider):
             intf = self.net.get(name).intfNames()[-1]
             self.net.get(name).attach(intf)
         else:
-            self.db.cursor.execute("SELECT ip, mac FROM hosts WHERE hid={0}"
-                              .format(hid))
-            results = self.db.cursor.fetchall()
+            results = self.db.query("host_addr", hid).fetchall()
             ip = results[0][0]
             mac = results[0][1]
             self.net.get(name).setIP(ip)
@@ -242,8 +283,8 @@ class MininetProvider(NetworkProvider):
     def addLink(self, msg):
         """Add a link to the Mininet topology
            msg: an AddLinkMessage object"""
-        name1 = self.cache_id[msg.node1]
-        name2 = self.cache_id[msg.node2]
+        name1 = self.topocache.node_name(msg.node1)
+        name2 = self.topocache.node_name(msg.node2)
         self.net.addLink(name1, name2)
         self.net.topo.addLink(name1, name2)
         self._mkLinkIntf(msg.node1, name1)
@@ -255,17 +296,14 @@ class MininetProvider(NetworkProvider):
             isHost = 0
 
         port1, port2 = self.net.topo.port(name1, name2)
-        cursor = self.db.cursor
-        cursor.execute("INSERT INTO PORTS (sid, nid, port) "
-                       "VALUES ({0}, {1}, {2}), ({1}, {0}, {3});"
-                       .format(msg.node1, msg.node2,
-                               port1, port2))
+        self.db.query("port_insert", msg.node1, msg.node2, port1)
+        self.db.query("port_insert", msg.node2, msg.node1, port2)
 
     def removeLink(self, msg):
         """Remove a link from the Mininet topology
            msg: a RemoveLinkMessage object"""
-        name1 = self.cache_id[msg.node1]
-        name2 = self.cache_id[msg.node2]
+        name1 = self.topocache.node_name(msg.node1)
+        name2 = self.topocache.node_name(msg.node2)
         port1, port2 = self.net.topo.port(name1, name2)
 
         # self._destroy(db, net, name1, port1)
@@ -280,23 +318,18 @@ class MininetProvider(NetworkProvider):
 
         if msg.name is None:
             msg.name = "s" + str(msg.sid)
-            cursor = self.db.cursor
-            cursor.execute("UPDATE switches SET name='{0}' WHERE sid={1}"
-                       .format(msg.name, msg.sid))
+            self.db.query("switch_set_name", msg.sid, msg.name)
 
         self.net.addSwitch(msg.name, listenPort=6633, **default)
 
         if msg.dpid is None:
             msg.dpid = self.net.get(msg.name).dpid
-            cursor = self.db.cursor
-            cursor.execute("UPDATE switches SET dpid='{0}' WHERE sid={1}"
-                       .format(msg.dpid, msg.sid))
+            self.db.query("switch_set_dpid", msg.sid, msg.dpid)
 
         sw = self.net.get(msg.name)
         sw.start(self.net.controllers)
         self.net.topo.addSwitch(msg.name)
-        self.cache_name[msg.name] = msg.sid
-        self.cache_id[msg.sid] = msg.name
+        self.topocache.add_name(msg.sid, msg.name)
 
     def removeSwitch(self, msg):
         """Remove a switch from the Mininet topology
@@ -309,20 +342,16 @@ class MininetProvider(NetworkProvider):
         self.net.topo.g.node.pop(msg.name, None)
         self.net.switches = [s for s in self.net.switches if s.name != msg.name]
         del self.net.nameToNode[msg.name]
-        del self.cache_name[msg.name]
-        del self.cache_id[msg.sid]
+        self.topocache.remove_name(msg.sid, msg.name)
 
     def addHost(self, msg):
         """Add a host to the Mininet topology
            msg: an AddHostMessage object"""
         if msg.name is None:
             msg.name = "h" + str(msg.hid)
-            cursor = self.db.cursor
-            cursor.execute("UPDATE hosts SET name='{0}' WHERE hid={1}"
-                       .format(msg.name, msg.hid))
+            self.db.query("host_set_name", msg.hid, msg.name)
 
-        self.cache_name[msg.name] = msg.hid
-        self.cache_id[msg.hid] = msg.name
+        self.topocache.add_name(msg.hid, msg.name)
         self.net.addHost(msg.name)
         host = self.net.get(msg.name)
         self.net.topo.addHost(msg.name)
@@ -334,15 +363,11 @@ class MininetProvider(NetworkProvider):
             nextIp = len(self.net.hosts) + 1
             msg.ip = ipAdd(nextIp, ipBaseNum=ipBaseNum, prefixLen=prefixLen)
 
-            cursor = self.db.cursor
-            cursor.execute("UPDATE hosts SET ip='{0}' WHERE hid={1}"
-                       .format(msg.ip, msg.hid))
+            self.db.query("host_set_ip", msg.hid, msg.ip)
 
         if msg.mac is None:
             msg.mac = macColonHex(nextIp)
-            cursor = self.db.cursor
-            cursor.execute("UPDATE hosts SET mac='{0}' WHERE hid={1}"
-                           .format(msg.mac, msg.hid))
+            self.db.query("host_set_mac", msg.hid, msg.mac)
 
     def removeHost(self, msg):
         """Remove a host from the Mininet topology
@@ -371,8 +396,7 @@ class MininetProvider(NetworkProvider):
         swobj.detach(intf)
         del swobj.nameToIntf[intf]
         del swobj.intfs[swport]
-        del self.cache_name[msg.name]
-        del self.cache_id[msg.hid]
+        self.topocache.remove_name(msg.hid, msg.name)
 
     def getNodeByName(self, node):
         """Find a node by its name
@@ -382,12 +406,14 @@ class MininetProvider(NetworkProvider):
 
     def start(self):
         "Start the Mininet network"
+        self.topocache.start()
         self.receiver.start()
         self.net.start()
 
     def stop(self):
         "Stop the Mininet network"
         self.receiver.stop()
+        self.topocache.stop()
         self.net.stop()
         if self.controller is not None:
             self.controller.stop()
@@ -411,6 +437,9 @@ class MininetProvider(NetworkProvider):
 class AddLinkMessage(ravel.messaging.ConsumableMessage):
     "A consumable message for adding a new link"
 
+    __slots__ = ("node1", "node2", "ishost", "isactive")
+    lane = ravel.messaging.LaneControl
+
     def __init__(self, node1, node2, ishost, isactive):
         """node1: node to link together
            node2: node to link together
@@ -429,6 +458,9 @@ class AddLinkMessage(ravel.messaging.ConsumableMessage):
 class RemoveLinkMessage(ravel.messaging.ConsumableMessage):
     "A consumable message for removing a link"
 
+    __slots__ = ("node1", "node2")
+    lane = ravel.messaging.LaneControl
+
     def __init__(self, node1, node2):
         """node1: node connected to one end of the link
            node2: node connected to the other end of the link"""
@@ -443,6 +475,9 @@ class RemoveLinkMessage(ravel.messaging.ConsumableMessage):
 class AddSwitchMessage(ravel.messaging.ConsumableMessage):
     "A consumable message for adding a switch"
 
+    __slots__ = ("sid", "name", "dpid", "ip", "mac")
+    lane = ravel.messaging.LaneControl
+
     def __init__(self, sid, name, dpid, ip, mac):
         """sid: the id of the switch
            name: the name of the switch
@@ -463,6 +498,9 @@ class AddSwitchMessage(ravel.messaging.ConsumableMessage):
 class RemoveSwitchMessage(ravel.messaging.ConsumableMessage):
     "A consumable message for removing a switch"
 
+    __slots__ = ("sid", "name")
+    lane = ravel.messaging.LaneControl
+
     def __init__(self, sid, name):
         """sid: the id of the switch
            name: the name of the switch"""
@@ -477,6 +515,9 @@ class RemoveSwitchMessage(ravel.messaging.ConsumableMessage):
 class AddHostMessage(ravel.messaging.ConsumableMessage):
     "A consumable message for adding a host"
 
+    __slots__ = ("hid", "name", "ip", "mac")
+    lane = ravel.messaging.LaneControl
+
     def __init__(self, hid, name, ip, mac):
         """hid: the id of the host
            name: the name of the host
@@ -494,6 +535,10 @@ class AddHostMessage(ravel.messaging.ConsumableMessage):
 
 class RemoveHostMessage(ravel.messaging.ConsumableMessage):
     "A consumable message for removing a host"
+
+    __slots__ = ("hid", "name")
+    lane = ravel.messaging.LaneControl
+
     def __init__(self, hid, name):
         """hid: the id of the host
            name: the name of the host"""
@@ -504,3 +549,72 @@ class RemoveHostMessage(ravel.messaging.ConsumableMessage):
         """Consume the message
            provider: a NetworkProvider object to consume the message"""
         provider.removeHost(self)
+
+# binary layouts for ravel.codec
+_AddLinkCode = 10
+_RemoveLinkCode = 11
+_AddSwitchCode = 12
+_RemoveSwitchCode = 13
+_AddHostCode = 14
+_RemoveHostCode = 15
+
+_link = struct.Struct("!iiii")
+_unlink = struct.Struct("!ii")
+_nodeid = struct.Struct("!i")
+
+def _encode_strs(nid, *strs):
+    return _nodeid.pack(nid) + b"".join(ravel.codec.pack_str(x) for x in strs)
+
+def _decode_strs(data, offset, count):
+    nid, = _nodeid.unpack_from(data, offset)
+    offset += _nodeid.size
+    strs = []
+    for i in range(count):
+        x, offset = ravel.codec.unpack_str(data, offset)
+        strs.append(x)
+    return [nid] + strs, offset
+
+def _decode_addlink(data, offset):
+    fields = _link.unpack_from(data, offset)
+    return AddLinkMessage(*fields), offset + _link.size
+
+def _decode_removelink(data, offset):
+    fields = _unlink.unpack_from(data, offset)
+    return RemoveLinkMessage(*fields), offset + _unlink.size
+
+def _decode_addswitch(data, offset):
+    fields, offset = _decode_strs(data, offset, 4)
+    return AddSwitchMessage(*fields), offset
+
+def _decode_removeswitch(data, offset):
+    fields, offset = _decode_strs(data, offset, 1)
+    return RemoveSwitchMessage(*fields), offset
+
+def _decode_addhost(data, offset):
+    fields, offset = _decode_strs(data, offset, 3)
+    return AddHostMessage(*fields), offset
+
+def _decode_removehost(data, offset):
+    fields, offset = _decode_strs(data, offset, 1)
+    return RemoveHostMessage(*fields), offset
+
+ravel.codec.register(_AddLinkCode, AddLinkMessage,
+                     lambda m: _link.pack(m.node1, m.node2,
+                                          m.ishost, m.isactive),
+                     _decode_addlink)
+ravel.codec.register(_RemoveLinkCode, RemoveLinkMessage,
+                     lambda m: _unlink.pack(m.node1, m.node2),
+                     _decode_removelink)
+ravel.codec.register(_AddSwitchCode, AddSwitchMessage,
+                     lambda m: _encode_strs(m.sid, m.name, m.dpid,
+                                            m.ip, m.mac),
+                     _decode_addswitch)
+ravel.codec.register(_RemoveSwitchCode, RemoveSwitchMessage,
+                     lambda m: _encode_strs(m.sid, m.name),
+                     _decode_removeswitch)
+ravel.codec.register(_AddHostCode, AddHostMessage,
+                     lambda m: _encode_strs(m.hid, m.name, m.ip, m.mac),
+                     _decode_addhost)
+ravel.codec.register(_RemoveHostCode, RemoveHostMessage,
+                     lambda m: _encode_strs(m.hid, m.name),
+                     _decode_removehost)
@@ -63,9 +63,12 @@ class OfManager(object):
         "returns: true if the manager is running"
         pass
 
-    def sendBarrier(self, dpid):
+    def sendBarrier(self, dpid, fids=None, sent=None):
         """Send a barrier to the underlying controller implementation
-           dpid: the datapath ID of the switch to receive the message"""
+           dpid: the datapath ID of the switch to receive the message
+           fids: ids of the flows to confirm when the switch replies
+           sent: when the flows' flowmods were sent, in seconds since the
+           epoch"""
         pass
 
     def sendFlowmod(self, msg):
@@ -73,6 +76,13 @@ class OfManager(object):
            msg: a ravel.flow.OfMessage instance"""
         pass
 
+    def sendFlowmodBatch(self, batch):
+        """Send a batch of flow modifications and barriers.  By default,
+           each message in the batch is consumed in order
+           batch: a ravel.flow.FlowModBatch instance"""
+        for msg in batch.msgs:
+            msg.consume(self)
+
     def requestStats(self):
         """Send the switches a port stats request"""
         pass
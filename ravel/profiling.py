@@ -7,12 +7,18 @@ removing a flow execute in two processes: the database trigger and the OpenFlow
 manager.  Results then are reported to a third process: the CLI.
 """
 
-import pickle
+import atexit
+import datetime
+import json
+import os
+import struct
+import sys
 import sysv_ipc
 import threading
 import time
 from collections import OrderedDict
 
+import ravel.codec
 import ravel.messaging
 from ravel.log import logger
 
@@ -20,6 +26,32 @@ ProfileQueueId = 99999
 ProfileOff = "1"
 ProfileOn = "2"
 
+# counters are buffered in each process and sent to the profile queue in
+# batches of up to FlushSize, or when the oldest has waited FlushInterval
+# seconds, or on flush()
+FlushSize = 64
+FlushInterval = 0.5
+
+# seconds between attempts to attach the flag before profiling is first
+# enabled
+AttachInterval = 1.0
+
+# the name of this process in exported traces; processes without a command
+# line are PostgreSQL backends running Ravel's triggers
+_argv = getattr(sys, "argv", None)
+ProcessName = os.path.basename(_argv[0]) if _argv and _argv[0] else "postgres"
+
+# the profiling flag, attached once per process and read in place
+_On = ord(ProfileOn)
+_OnBytes = ProfileOn.encode()
+_flag = None
+_flag_attached = 0
+
+_buffer = []
+_buffer_time = None
+_buffer_lock = threading.Lock()
+_mq = None
+
 def enable_profiling():
     "Enable profiling"
     shm = sysv_ipc.SharedMemory(ProfileQueueId,
@@ -29,6 +61,8 @@ def enable_profiling():
                                 init_character=" ")
     shm.write(str(ProfileOn))
     shm.detach()
+    if _flag is None:
+        _attach_flag()
 
 def disable_profiling():
     "Disable profiling"
@@ -40,37 +74,103 @@ def disable_profiling():
     shm.write(str(ProfileOff))
     shm.detach()
 
-def is_profiled():
-    "Check if profiling is enabled"
+def _attach_flag():
+    global _flag, _flag_attached
+    _flag_attached = time.time()
     try:
         shm = sysv_ipc.SharedMemory(ProfileQueueId)
-        return shm.read().strip("\0") == ProfileOn
-    except sysv_ipc.ExistentialError as e:
-        logger.warning("profile queue doesn't exist: %", e)
-        return False
+    except sysv_ipc.ExistentialError:
+        return
+
+    try:
+        _flag = memoryview(shm)
+    except TypeError:
+        # sysv_ipc without buffer support, read through the segment instead
+        _flag = shm
+
+def is_profiled():
+    """Check if profiling is enabled.  The flag's shared memory segment is
+       attached on the first call, so later calls read a single byte"""
+    if _flag is None:
+        if time.time() - _flag_attached < AttachInterval:
+            return False
+        _attach_flag()
+        if _flag is None:
+            return False
+
+    if isinstance(_flag, memoryview):
+        return _flag[0] == _On
+    return _flag.read(1) == _OnBytes
+
+def _queue():
+    global _mq
+    if _mq is None:
+        _mq = sysv_ipc.MessageQueue(ProfileQueueId, mode=0o777)
+    return _mq
+
+def flush():
+    """Send the performance counters buffered in this process to the
+       profile queue.  Counters never block the operation being profiled:
+       if the queue is full, they are dropped"""
+    global _buffer, _buffer_time, _mq
+    with _buffer_lock:
+        if not _buffer:
+            return
+        counters = _buffer
+        _buffer = []
+        _buffer_time = None
+
+    try:
+        _send_batch(_queue(), counters, ravel.messaging.msgmax())
+    except sysv_ipc.BusyError:
+        logger.debug("profile queue full, dropped counters")
+    except sysv_ipc.ExistentialError:
+        _mq = None
+    except Exception as e:
+        logger.warning("could not report performance counters: %s", e)
+
+def _send_batch(mq, counters, maxsize):
+    # split batches too large for a single queue message
+    data = ravel.codec.encode(CounterBatch(counters))
+    if len(data) > maxsize and len(counters) > 1:
+        half = len(counters) // 2
+        _send_batch(mq, counters[:half], maxsize)
+        _send_batch(mq, counters[half:], maxsize)
+        return
+    mq.send(data, block=False, type=ravel.messaging.LaneProfile)
+
+atexit.register(flush)
 
 class PerfCounter(object):
     "Store timing information for a single operation"
 
-    def __init__(self, name, time_ms=None):
+    def __init__(self, name, time_ms=None, ts=None, pid=None, proc=None):
         """name: the name of the operation
            time_ms: the execution time of the operation, if already
-           recorded"""
+           recorded
+           ts: when the operation started, in seconds since the epoch
+           pid: the id of the process running the operation, defaults to
+           the current process
+           proc: the name of the process, defaults to ProcessName"""
         self.name = name
         self.start_time = None
         self.time_ms = time_ms
         if self.time_ms is not None:
-            self.time_ms = round(float(time_ms), 3)
+            self.time_ms = float(time_ms)
+        self.ts = ts
+        self.pid = pid if pid is not None else os.getpid()
+        self.proc = proc if proc is not None else ProcessName
 
     def start(self):
         "Start recording execution time of an operation"
         if is_profiled():
-            self.start_time = time.time()
+            self.ts = time.time()
+            self.start_time = time.perf_counter_ns()
 
     def stop(self):
         "Stop recording execution time of an operation"
         if self.start_time is not None:
-            self.time_ms = round((time.time() - self.start_time) * 1000, 3)
+            self.time_ms = (time.perf_counter_ns() - self.start_time) / 1e6
             self.report()
 
     def consume(self, consumer):
@@ -79,13 +179,21 @@ class PerfCounter(object):
         consumer.handler(self)
 
     def report(self):
-        "Report the performance counter by adding it to the message queue"
-        try:
-            if is_profiled():
-                mq = sysv_ipc.MessageQueue(ProfileQueueId, mode=0o777)
-                mq.send(pickle.dumps(self))
-        except Exception as e:
-            print(e)
+        """Report the performance counter by buffering it to be sent to the
+           message queue with the process's other counters"""
+        global _buffer_time
+        if not is_profiled():
+            return
+
+        now = time.time()
+        with _buffer_lock:
+            _buffer.append(self)
+            if _buffer_time is None:
+                _buffer_time = now
+            full = (len(_buffer) >= FlushSize or
+                    now - _buffer_time >= FlushInterval)
+        if full:
+            flush()
 
     def __repr__(self):
         return str(self)
@@ -93,44 +201,391 @@ class PerfCounter(object):
     def __str__(self):
         return "{0}:{1}".format(self.name, self.time_ms)
 
+class StatementCounter(PerfCounter):
+    "Store timing information for a single SQL statement"
+
+    def __init__(self, statement, time_ms, rows, ts=None, pid=None,
+                 proc=None):
+        """statement: the normalized text of the statement
+           time_ms: the execution time of the statement
+           rows: the number of rows returned or affected by the statement
+           ts: when the statement started, in seconds since the epoch
+           pid: the id of the process executing the statement
+           proc: the name of the process executing the statement"""
+        super(StatementCounter, self).__init__("sql", time_ms, ts, pid, proc)
+        self.statement = statement
+        self.rows = rows
+
+    def __str__(self):
+        return "{0}:{1}:{2}".format(self.statement, self.time_ms, self.rows)
+
+class CounterBatch(object):
+    "A batch of performance counters reported by one process"
+
+    __slots__ = ("counters",)
+
+    def __init__(self, counters):
+        "counters: a list of PerfCounter objects"
+        self.counters = counters
+
+    def consume(self, consumer):
+        """Consume each performance counter in the batch
+           consumer: a ProfiledExecution instance to consume the counters"""
+        for counter in self.counters:
+            consumer.handler(counter)
+
+# binary layouts for ravel.codec
+_PerfCounterCode = 20
+_StatementCounterCode = 21
+_CounterBatchCode = 22
+
+_counter = struct.Struct("!ddi")
+_rows = struct.Struct("!q")
+_count = struct.Struct("!I")
+_item = struct.Struct("!BI")
+
+def _pack_counter(c):
+    ts = c.ts if c.ts is not None else float("nan")
+    return _counter.pack(c.time_ms, ts, c.pid) + ravel.codec.pack_str(c.proc)
+
+def _unpack_counter(data, offset):
+    time_ms, ts, pid = _counter.unpack_from(data, offset)
+    if ts != ts:
+        ts = None
+    proc, offset = ravel.codec.unpack_str(data, offset + _counter.size)
+    return time_ms, ts, pid, proc, offset
+
+def _decode_counter(data, offset):
+    name, offset = ravel.codec.unpack_str(data, offset)
+    time_ms, ts, pid, proc, offset = _unpack_counter(data, offset)
+    return PerfCounter(name, time_ms, ts, pid, proc), offset
+
+def _decode_statement(data, offset):
+    statement, offset = ravel.codec.unpack_str(data, offset)
+    time_ms, ts, pid, proc, offset = _unpack_counter(data, offset)
+    rows, = _rows.unpack_from(data, offset)
+    return (StatementCounter(statement, time_ms, rows, ts, pid, proc),
+            offset + _rows.size)
+
+def _encode_batch(batch):
+    out = [_count.pack(len(batch.counters))]
+    for counter in batch.counters:
+        code, body = ravel.codec.encode_body(counter)
+        out.append(_item.pack(code, len(body)))
+        out.append(body)
+    return b"".join(out)
+
+def _decode_batch(data, offset):
+    n, = _count.unpack_from(data, offset)
+    offset += _count.size
+    counters = []
+    for i in range(n):
+        code, length = _item.unpack_from(data, offset)
+        offset += _item.size
+        counter, _ = ravel.codec.decode_body(code, data, offset,
+                                             offset + length)
+        counters.append(counter)
+        offset += length
+    return CounterBatch(counters), offset
+
+ravel.codec.register(_PerfCounterCode, PerfCounter,
+                     lambda c: ravel.codec.pack_str(c.name) +
+                               _pack_counter(c),
+                     _decode_counter)
+ravel.codec.register(_StatementCounterCode, StatementCounter,
+                     lambda c: ravel.codec.pack_str(c.statement) +
+                               _pack_counter(c) +
+                               _rows.pack(c.rows),
+                     _decode_statement)
+ravel.codec.register(_CounterBatchCode, CounterBatch, _encode_batch,
+                     _decode_batch)
+
+def dump_counters(counters, path):
+    """Save performance counters to a binary file
+       counters: a list of PerfCounter objects
+       path: the path of the file"""
+    with open(path, "wb") as f:
+        f.write(ravel.codec.encode(CounterBatch(counters)))
+
+def load_counters(path):
+    """Load performance counters saved with dump_counters
+       path: the path of the file
+       returns: a list of PerfCounter objects"""
+    with open(path, "rb") as f:
+        return ravel.codec.decode(f.read()).counters
+
+def write_trace(counters, path, names=None):
+    """Export performance counters in the Chrome trace event format, viewable
+       in chrome://tracing or Perfetto, with one track per process
+       counters: a list of PerfCounter objects
+       path: the path of the JSON file
+       names: an optional dictionary of process ids to process names,
+       overriding the names the counters were reported with"""
+    labels = {}
+    for counter in counters:
+        if counter.pid not in labels:
+            labels[counter.pid] = "{0} ({1})".format(counter.proc,
+                                                     counter.pid)
+    labels.update(names or {})
+
+    events = []
+    for pid, name in labels.items():
+        events.append({ "name" : "process_name",
+                        "ph" : "M",
+                        "pid" : pid,
+                        "args" : { "name" : name } })
+
+    for counter in counters:
+        if counter.ts is None:
+            continue
+        event = { "name" : counter.name,
+                  "cat" : "ravel",
+                  "ph" : "X",
+                  "ts" : counter.ts * 1e6,
+                  "dur" : counter.time_ms * 1e3,
+                  "pid" : counter.pid,
+                  "tid" : counter.pid }
+        if isinstance(counter, StatementCounter):
+            event["args"] = { "statement" : counter.statement,
+                              "rows" : counter.rows }
+        events.append(event)
+
+    with open(path, "w") as f:
+        json.dump({ "traceEvents" : events, "displayTimeUnit" : "ms" }, f)
+
+class Histogram(object):
+    """A histogram of durations in nanoseconds, in the style of an HDR
+       histogram: values are counted in log-linear buckets whose width is
+       within 1/SubBuckets of the value, so percentiles are accurate to
+       that precision at any scale.  Bucket boundaries do not depend on the
+       recorded values, so histograms from different runs can be compared
+       or merged"""
+
+    SubBits = 7
+    SubBuckets = 1 << SubBits
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    @classmethod
+    def _bucket(cls, value):
+        shift = max(value.bit_length() - cls.SubBits - 1, 0)
+        return shift, value >> shift
+
+    @classmethod
+    def _upper(cls, bucket):
+        # the highest value counted in a bucket
+        shift, sub = bucket
+        return ((sub + 1) << shift) - 1
+
+    def record(self, value):
+        """Record a value
+           value: the duration in nanoseconds"""
+        value = max(int(value), 0)
+        bucket = Histogram._bucket(value)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Add another histogram's values to this one
+           other: a Histogram instance"""
+        for bucket, n in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + n
+        self.count += other.count
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is not None:
+                if self.min is None or value < self.min:
+                    self.min = value
+                if self.max is None or value > self.max:
+                    self.max = value
+
+    def percentile(self, p):
+        """Get the value below which a percentage of recorded values fall
+           p: the percentile, from 0 to 100
+           returns: the value in nanoseconds, or None if no values were
+           recorded"""
+        if self.count == 0:
+            return None
+
+        rank = max(1, int(round(p / 100.0 * self.count)))
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(Histogram._upper(bucket), self.max)
+        return self.max
+
 class ProfiledExecution(object):
     "Start a new profiled execution and collect performance counters"
 
+    percentiles = [50, 90, 99]
+
     def __init__(self):
         self.counters = []
+        self.started = None
+        self.elapsed = None
         self.receiver = ravel.messaging.MsgQueueReceiver(ProfileQueueId, self)
 
-    def print_summary(self):
-        "Print results of collected performance counters"
+    def histograms(self):
+        """Build a histogram of each counter's durations
+           returns: an OrderedDict of counter names to Histogram instances,
+           sorted by name"""
+        hists = {}
+        for counter in self.counters:
+            hist = hists.get(counter.name)
+            if hist is None:
+                hist = hists[counter.name] = Histogram()
+            hist.record(counter.time_ms * 1e6)
+        return OrderedDict(sorted(hists.items()))
+
+    def summary(self):
+        """Summarize each counter's durations, in milliseconds.  Counters
+           are sorted by name and always have the same fields, so summaries
+           of different runs can be compared
+           returns: an OrderedDict of counter names to OrderedDicts with
+           keys count, total, min, p50, p90, p99, max and rate (counters per
+           second of the profiled execution)"""
+        summ = OrderedDict()
+        for name, hist in self.histograms().items():
+            stats = OrderedDict()
+            stats["count"] = hist.count
+            stats["total"] = hist.total / 1e6
+            stats["min"] = hist.min / 1e6
+            for p in ProfiledExecution.percentiles:
+                stats["p{0}".format(p)] = hist.percentile(p) / 1e6
+            stats["max"] = hist.max / 1e6
+            stats["rate"] = hist.count / self.elapsed if self.elapsed else None
+            summ[name] = stats
+        return summ
+
+    def print_summary(self, baseline=None):
+        """Print results of collected performance counters
+           baseline: an optional summary of an earlier run, from summary(),
+           to print each counter's change in p50 against"""
         if len(self.counters) == 0:
             print("No performance counters found")
             return
 
-        agg = OrderedDict()
-        summ = 0
-        print("-" * 40)
-        for counter in self.counters:
-            summ += counter.time_ms
+        summ = self.summary()
+        cols = ["count", "total", "min"] + \
+               ["p{0}".format(p) for p in ProfiledExecution.percentiles] + \
+               ["max"]
+        width = max([len("counter (ms)")] + [len(name) for name in summ])
+        header = "{0:<{1}} {2:>7}".format("counter (ms)", width, "count") + \
+                 "".join("{0:>10}".format(c) for c in cols[1:]) + \
+                 "{0:>10}".format("/s")
+        if baseline is not None:
+            header += "{0:>10}".format("p50 diff")
 
-            if counter.name not in list(agg.keys()):
-                agg[counter.name] = (1, counter.time_ms)
+        print("-" * len(header))
+        print(header)
+        print("-" * len(header))
+        total = 0
+        for name, stats in summ.items():
+            total += stats["total"]
+            line = "{0:<{1}} {2:>7}".format(name, width, stats["count"]) + \
+                   "".join("{0:>10.3f}".format(stats[c]) for c in cols[1:])
+            if stats["rate"] is not None:
+                line += "{0:>10.0f}".format(stats["rate"])
             else:
-                count,ms =  agg[counter.name]
-                agg[counter.name] = (count + 1, ms + counter.time_ms)
+                line += "{0:>10}".format("-")
+            if baseline is not None:
+                if name in baseline and baseline[name]["p50"]:
+                    diff = (stats["p50"] / baseline[name]["p50"] - 1) * 100
+                    line += "{0:>+9.1f}%".format(diff)
+                else:
+                    line += "{0:>10}".format("new")
+            print(line)
+
+        print("-" * len(header))
+        print("Total: {0:.3f}ms".format(total))
+
+        self.print_statements()
+
+    def print_statements(self, top=10):
+        """Print the slowest and most frequent SQL statements, if statements
+           were profiled
+           top: the number of statements to print in each list"""
+        agg = {}
+        for counter in self.counters:
+            if not isinstance(counter, StatementCounter):
+                continue
+            count, ms, rows = agg.get(counter.statement, (0, 0, 0))
+            agg[counter.statement] = (count + 1,
+                                      ms + counter.time_ms,
+                                      rows + max(counter.rows, 0))
+
+        if len(agg) == 0:
+            return
+
+        def show(title, key):
+            print("-" * 40)
+            print(title)
+            ranked = sorted(agg.items(), key=key, reverse=True)[:top]
+            for stmt, (count, ms, rows) in ranked:
+                print("{0:>6} {1:>10.3f}ms {2:>8} rows  {3}"
+                      .format(count, ms, rows, stmt[:120]))
+
+        show("Slowest statements (total time):", lambda x: x[1][1])
+        show("Most frequent statements:", lambda x: x[1][0])
+
+    def save(self, db, command=None):
+        """Save the collected performance counters to the perf_counters
+           table as a new run
+           db: a ravel.db.RavelDb instance
+           command: the profiled command
+           returns: the id of the run"""
+        db.cursor.execute("SELECT coalesce(max(run), 0) + 1 "
+                          "FROM perf_counters;")
+        run = db.cursor.fetchall()[0][0]
+        rows = []
+        for counter in self.counters:
+            ts = None
+            if counter.ts is not None:
+                ts = datetime.datetime.fromtimestamp(
+                    counter.ts, datetime.timezone.utc).isoformat()
+            rows.append((run, command, counter.name, counter.pid, ts,
+                         counter.time_ms,
+                         getattr(counter, "statement", None),
+                         getattr(counter, "rows", None)))
+
+        db.copy_rows("perf_counters",
+                     ("run", "command", "name", "pid", "ts", "time_ms",
+                      "statement", "rows"),
+                     rows)
+        return run
 
-        for counter, tup in agg.items():
-            print("{0}({1}): {2}ms".format(counter, tup[0], tup[1]))
+    def dump(self, path):
+        """Save the collected performance counters to a binary file, to be
+           read with load_counters
+           path: the path of the file"""
+        dump_counters(self.counters, path)
 
-        print("-" * 40)
-        print("Total: {0}ms".format(summ))
+    def trace(self, path):
+        """Export the collected performance counters as a Chrome trace
+           path: the path of the JSON file"""
+        write_trace(self.counters, path)
 
     def start(self):
         "Enable profiling and start receiving performance counters"
         enable_profiling()
+        self.started = time.perf_counter()
         self.receiver.start()
 
     def stop(self):
         "Disable profiling and stop receiving performance counters"
+        flush()
+        self.elapsed = time.perf_counter() - self.started
         self.receiver.stop()
         disable_profiling()
 
@@ -37,6 +37,21 @@ CREATE UNLOGGED TABLE cf (
 CREATE INDEX ON cf(fid,sid);
 
 
+/* ARP flood rule references - the number of flows through each switch
+ * relying on the switch's ARP flood rule for a host
+ * sid: switch id
+ * mac: the host's MAC address (dl_src of the rule)
+ * refs: number of flows referencing the rule
+ */
+DROP TABLE IF EXISTS arp_refs CASCADE;
+CREATE UNLOGGED TABLE arp_refs (
+	sid      integer,
+	mac      varchar(17),
+	refs     integer,
+	PRIMARY KEY (sid, mac)
+);
+
+
 /* Reachability matrix - end-to-end reachability matrix
  * fid: flow id
  * src: the IP address of the source node
@@ -118,6 +133,329 @@ CREATE UNLOGGED TABLE ports (
 	nid      integer,
 	port     integer
 );
+CREATE INDEX ON ports (sid, nid);
+
+
+
+------------------------------------------------------------
+-- TOPOLOGY CACHE NOTIFICATIONS
+------------------------------------------------------------
+
+/* Topology change notification - notify listeners on channel ravel_topo
+ * (see ravel.cache) of a changed row in switches, hosts, ports or tp.
+ * The payload is a JSON object with the table, the operation and the
+ * new (or deleted) row, plus the old row for updates
+ */
+CREATE OR REPLACE FUNCTION topo_notify_fun ()
+RETURNS TRIGGER
+AS $$
+    BEGIN
+        IF TG_OP = 'TRUNCATE' THEN
+            PERFORM pg_notify('ravel_topo', json_build_object(
+                    'table', TG_TABLE_NAME,
+                    'op', TG_OP)::text);
+        ELSIF TG_OP = 'DELETE' THEN
+            PERFORM pg_notify('ravel_topo', json_build_object(
+                    'table', TG_TABLE_NAME,
+                    'op', TG_OP,
+                    'row', row_to_json(OLD))::text);
+        ELSIF TG_OP = 'UPDATE' THEN
+            PERFORM pg_notify('ravel_topo', json_build_object(
+                    'table', TG_TABLE_NAME,
+                    'op', TG_OP,
+                    'row', row_to_json(NEW),
+                    'old', row_to_json(OLD))::text);
+        ELSE
+            PERFORM pg_notify('ravel_topo', json_build_object(
+                    'table', TG_TABLE_NAME,
+                    'op', TG_OP,
+                    'row', row_to_json(NEW))::text);
+        END IF;
+        RETURN NULL;
+    END;
+$$ LANGUAGE plpgsql VOLATILE;
+
+CREATE TRIGGER switches_notify_trigger
+	AFTER INSERT OR UPDATE OR DELETE ON switches
+	FOR EACH ROW EXECUTE PROCEDURE topo_notify_fun();
+CREATE TRIGGER switches_truncate_trigger
+	AFTER TRUNCATE ON switches
+	FOR EACH STATEMENT EXECUTE PROCEDURE topo_notify_fun();
+
+CREATE TRIGGER hosts_notify_trigger
+	AFTER INSERT OR UPDATE OR DELETE ON hosts
+	FOR EACH ROW EXECUTE PROCEDURE topo_notify_fun();
+CREATE TRIGGER hosts_truncate_trigger
+	AFTER TRUNCATE ON hosts
+	FOR EACH STATEMENT EXECUTE PROCEDURE topo_notify_fun();
+
+CREATE TRIGGER ports_notify_trigger
+	AFTER INSERT OR UPDATE OR DELETE ON ports
+	FOR EACH ROW EXECUTE PROCEDURE topo_notify_fun();
+CREATE TRIGGER ports_truncate_trigger
+	AFTER TRUNCATE ON ports
+	FOR EACH STATEMENT EXECUTE PROCEDURE topo_notify_fun();
+
+CREATE TRIGGER tp_notify_trigger
+	AFTER INSERT OR UPDATE OR DELETE ON tp
+	FOR EACH ROW EXECUTE PROCEDURE topo_notify_fun();
+CREATE TRIGGER tp_truncate_trigger
+	AFTER TRUNCATE ON tp
+	FOR EACH STATEMENT EXECUTE PROCEDURE topo_notify_fun();
+
+
+
+------------------------------------------------------------
+-- FLOW INSTALLATION LOOKUP
+------------------------------------------------------------
+
+/* Flow lookup table - one row per cf row with everything needed to build
+ * its flowmods.  Rows are added and removed by the flow triggers on cf
+ * (flows.sql) and kept current by the triggers below on changes to
+ * switches, hosts, ports and rm
+ * fid, pid, sid, nid: the cf row
+ * sw_name, sw_ip, sw_dpid: the switch's name, IP address and datapath id
+ * src, dst: the flow's source and destination host ids
+ * src_ip, src_mac, dst_ip, dst_mac: the hosts' addresses
+ * outport: outport on sid toward nid (forward flow)
+ * revoutport: outport on sid toward pid (reverse flow)
+ */
+DROP TABLE IF EXISTS flow_lookup CASCADE;
+CREATE UNLOGGED TABLE flow_lookup (
+	fid        integer,
+	pid        integer,
+	sid        integer,
+	nid        integer,
+	sw_name    varchar(16),
+	sw_ip      varchar(16),
+	sw_dpid    varchar(16),
+	src        integer,
+	dst        integer,
+	src_ip     varchar(16),
+	src_mac    varchar(17),
+	dst_ip     varchar(16),
+	dst_mac    varchar(17),
+	outport    integer,
+	revoutport integer
+);
+CREATE INDEX ON flow_lookup (fid, sid);
+CREATE INDEX ON flow_lookup (sid, nid);
+CREATE INDEX ON flow_lookup (sid, pid);
+CREATE INDEX ON flow_lookup (src);
+CREATE INDEX ON flow_lookup (dst);
+
+
+CREATE OR REPLACE FUNCTION flow_lookup_switch_fun ()
+RETURNS TRIGGER
+AS $$
+    BEGIN
+        IF TG_OP = 'UPDATE' OR TG_OP = 'DELETE' THEN
+            UPDATE flow_lookup
+               SET sw_name = NULL, sw_ip = NULL, sw_dpid = NULL
+             WHERE sid = OLD.sid;
+        END IF;
+        IF TG_OP = 'INSERT' OR TG_OP = 'UPDATE' THEN
+            UPDATE flow_lookup
+               SET sw_name = NEW.name, sw_ip = NEW.ip, sw_dpid = NEW.dpid
+             WHERE sid = NEW.sid;
+        END IF;
+        RETURN NULL;
+    END;
+$$ LANGUAGE plpgsql VOLATILE;
+
+CREATE TRIGGER flow_lookup_switch_trigger
+	AFTER INSERT OR UPDATE OR DELETE ON switches
+	FOR EACH ROW EXECUTE PROCEDURE flow_lookup_switch_fun();
+
+
+/* Move ARP flood rule references (arp_refs) with a change to the MAC
+ * addresses cached in flow_lookup: called with sign -1 before the change
+ * and sign 1 after it, for the lookup rows of the given hosts or flows.
+ * Each row holds one reference per distinct MAC, as counted by
+ * ravel.flow.arpDelta
+ */
+CREATE OR REPLACE FUNCTION flow_lookup_arp_refs (hids integer[],
+                                                 fids integer[],
+                                                 sign integer)
+RETURNS void
+AS $$
+    BEGIN
+        INSERT INTO arp_refs (sid, mac, refs)
+        SELECT l.sid, m.mac, sign * count(*)
+          FROM flow_lookup l,
+               LATERAL (SELECT DISTINCT x
+                          FROM unnest(ARRAY[l.src_mac, l.dst_mac]) AS x
+                         WHERE x IS NOT NULL) AS m(mac)
+         WHERE l.src = ANY(hids) OR l.dst = ANY(hids) OR l.fid = ANY(fids)
+         GROUP BY l.sid, m.mac
+            ON CONFLICT (sid, mac)
+            DO UPDATE SET refs = arp_refs.refs + EXCLUDED.refs;
+        IF sign > 0 THEN
+            DELETE FROM arp_refs WHERE refs <= 0;
+        END IF;
+    END;
+$$ LANGUAGE plpgsql VOLATILE;
+
+
+CREATE OR REPLACE FUNCTION flow_lookup_host_fun ()
+RETURNS TRIGGER
+AS $$
+    DECLARE
+        hids integer[];
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            hids := ARRAY[NEW.hid];
+        ELSIF TG_OP = 'DELETE' THEN
+            hids := ARRAY[OLD.hid];
+        ELSE
+            hids := ARRAY[OLD.hid, NEW.hid];
+        END IF;
+        PERFORM flow_lookup_arp_refs(hids, ARRAY[]::integer[], -1);
+
+        IF TG_OP = 'UPDATE' OR TG_OP = 'DELETE' THEN
+            UPDATE flow_lookup SET src_ip = NULL, src_mac = NULL
+             WHERE src = OLD.hid;
+            UPDATE flow_lookup SET dst_ip = NULL, dst_mac = NULL
+             WHERE dst = OLD.hid;
+        END IF;
+        IF TG_OP = 'INSERT' OR TG_OP = 'UPDATE' THEN
+            UPDATE flow_lookup SET src_ip = NEW.ip, src_mac = NEW.mac
+             WHERE src = NEW.hid;
+            UPDATE flow_lookup SET dst_ip = NEW.ip, dst_mac = NEW.mac
+             WHERE dst = NEW.hid;
+        END IF;
+
+        PERFORM flow_lookup_arp_refs(hids, ARRAY[]::integer[], 1);
+        RETURN NULL;
+    END;
+$$ LANGUAGE plpgsql VOLATILE;
+
+CREATE TRIGGER flow_lookup_host_trigger
+	AFTER INSERT OR UPDATE OR DELETE ON hosts
+	FOR EACH ROW EXECUTE PROCEDURE flow_lookup_host_fun();
+
+
+CREATE OR REPLACE FUNCTION flow_lookup_port_fun ()
+RETURNS TRIGGER
+AS $$
+    BEGIN
+        IF TG_OP = 'UPDATE' OR TG_OP = 'DELETE' THEN
+            UPDATE flow_lookup SET outport = NULL
+             WHERE sid = OLD.sid AND nid = OLD.nid;
+            UPDATE flow_lookup SET revoutport = NULL
+             WHERE sid = OLD.sid AND pid = OLD.nid;
+        END IF;
+        IF TG_OP = 'INSERT' OR TG_OP = 'UPDATE' THEN
+            UPDATE flow_lookup SET outport = NEW.port
+             WHERE sid = NEW.sid AND nid = NEW.nid;
+            UPDATE flow_lookup SET revoutport = NEW.port
+             WHERE sid = NEW.sid AND pid = NEW.nid;
+        END IF;
+        RETURN NULL;
+    END;
+$$ LANGUAGE plpgsql VOLATILE;
+
+CREATE TRIGGER flow_lookup_port_trigger
+	AFTER INSERT OR UPDATE OR DELETE ON ports
+	FOR EACH ROW EXECUTE PROCEDURE flow_lookup_port_fun();
+
+
+/* Deleting a flow from rm keeps its lookup rows, since the flow's
+ * rules are removed from cf (and the switches) after rm is updated
+ */
+CREATE OR REPLACE FUNCTION flow_lookup_rm_fun ()
+RETURNS TRIGGER
+AS $$
+    BEGIN
+        PERFORM flow_lookup_arp_refs(ARRAY[]::integer[], ARRAY[NEW.fid], -1);
+        UPDATE flow_lookup l
+           SET src = NEW.src, dst = NEW.dst,
+               src_ip = h1.ip, src_mac = h1.mac,
+               dst_ip = h2.ip, dst_mac = h2.mac
+          FROM (SELECT 1) AS x
+          LEFT JOIN hosts h1 ON h1.hid = NEW.src
+          LEFT JOIN hosts h2 ON h2.hid = NEW.dst
+         WHERE l.fid = NEW.fid;
+        PERFORM flow_lookup_arp_refs(ARRAY[]::integer[], ARRAY[NEW.fid], 1);
+        RETURN NULL;
+    END;
+$$ LANGUAGE plpgsql VOLATILE;
+
+CREATE TRIGGER flow_lookup_rm_trigger
+	AFTER UPDATE OF src, dst ON rm
+	FOR EACH ROW EXECUTE PROCEDURE flow_lookup_rm_fun();
+
+
+
+------------------------------------------------------------
+-- FLOW INSTALLATION STATUS
+------------------------------------------------------------
+
+/* Flow status table - confirmation that a switch applied a flow's rules,
+ * written by the OpenFlow manager when the switch replies to the barrier
+ * ending the batch that installed the flow
+ * fid: flow id
+ * dpid: datapath id of the switch
+ * requested: when the flow trigger sent the batch
+ * installed: when the barrier reply was received
+ */
+DROP TABLE IF EXISTS flow_status CASCADE;
+CREATE UNLOGGED TABLE flow_status (
+	fid        integer,
+	dpid       varchar(16),
+	requested  timestamptz,
+	installed  timestamptz
+);
+CREATE INDEX ON flow_status (fid, requested);
+
+
+/* Flow latency view - distribution of install latency, in milliseconds,
+ * per switch
+ */
+DROP VIEW IF EXISTS flow_latency CASCADE;
+CREATE OR REPLACE VIEW flow_latency AS (
+	SELECT dpid,
+	       count(*) AS flows,
+	       min(ms) AS min,
+	       percentile_cont(0.5) WITHIN GROUP (ORDER BY ms) AS p50,
+	       percentile_cont(0.9) WITHIN GROUP (ORDER BY ms) AS p90,
+	       percentile_cont(0.99) WITHIN GROUP (ORDER BY ms) AS p99,
+	       max(ms) AS max
+	FROM (SELECT dpid,
+	             EXTRACT(epoch FROM installed - requested) * 1000 AS ms
+	      FROM flow_status) AS latency
+	GROUP BY dpid
+	ORDER BY dpid
+);
+
+
+------------------------------------------------------------
+-- PROFILING
+------------------------------------------------------------
+
+/* Performance counters table - counters collected by the profile command
+ * with --save, one run per profiled command.  The table keeps its rows
+ * when the schema is reloaded
+ * run: id of the profiled run
+ * command: the profiled command
+ * name: counter name
+ * pid: id of the process reporting the counter
+ * ts: when the operation started
+ * time_ms: execution time of the operation
+ * statement: normalized SQL text, for statement counters
+ * rows: rows returned or affected, for statement counters
+ */
+CREATE TABLE IF NOT EXISTS perf_counters (
+	run        integer,
+	command    text,
+	name       text,
+	pid        integer,
+	ts         timestamptz,
+	time_ms    double precision,
+	statement  text,
+	rows       bigint
+);
+CREATE INDEX IF NOT EXISTS perf_counters_run_idx ON perf_counters (run);
 
 
 
@@ -257,22 +595,32 @@ plpy.notice ("spv_constraint1_fun")
 if TD["new"]["status"] == 'on':
     rm = plpy.execute ("SELECT * FROM rm_delta;")
 
+    # collect the per-switch rules of all flows so cf is modified with one
+    # statement each for deletes and inserts, firing the statement-level
+    # flow triggers once per batch instead of once per hop
+    adds = []
+    dels = []
     for t in rm:
-	    if t["isadd"] == 1:
-	        f = t["fid"]
-	        s = t["src"]
-	        d = t["dst"]
-	        pv = plpy.execute("SELECT array(SELECT dij.node FROM pgr_dijkstra('SELECT 1 as id, sid as source, nid as target, 1.0::float8 as cost FROM tp WHERE isactive = 1'," +str (s) + "," + str (d)  + ", FALSE) as dij )")[0]['array']
-
-
-	        l = len (pv)
-	        for i in range (l):
-		        if i + 2 < l:
-		            plpy.execute ("INSERT INTO cf (fid,pid,sid,nid) VALUES (" + str (f) + "," + str (pv[i]) + "," +str (pv[i+1]) +"," + str (pv[i+2])+  ");")
-
-	    elif t["isadd"] == 0:
-	        f = t["fid"]
-	        plpy.execute ("DELETE FROM cf WHERE fid =" +str (f) +";")
+        if t["isadd"] == 1:
+            f = t["fid"]
+            s = t["src"]
+            d = t["dst"]
+            pv = plpy.execute("SELECT array(SELECT dij.node FROM pgr_dijkstra('SELECT 1 as id, sid as source, nid as target, 1.0::float8 as cost FROM tp WHERE isactive = 1'," +str (s) + "," + str (d)  + ", FALSE) as dij )")[0]['array']
+
+            l = len (pv)
+            for i in range (l):
+                if i + 2 < l:
+                    adds.append ("(" + str (f) + "," + str (pv[i]) + "," +str (pv[i+1]) +"," + str (pv[i+2]) + ")")
+
+        elif t["isadd"] == 0:
+            dels.append (str (t["fid"]))
+
+    # a flow deleted and re-added in the same tick appears as a delete
+    # followed by an add in rm_delta, so deletes go first
+    if dels:
+        plpy.execute ("DELETE FROM cf WHERE fid = ANY (ARRAY[" + ",".join (dels) + "]);")
+    if adds:
+        plpy.execute ("INSERT INTO cf (fid,pid,sid,nid) VALUES " + ",".join (adds) + ";")
 
     plpy.execute ("DELETE FROM rm_delta;")
 return None;
@@ -2,254 +2,161 @@
 -- FLOW MODIFICATION FUNCTIONS
 ------------------------------------------------------------
 
-/* Add flow preprocessing - gather match fields to install a flow
- * in a single switch (a flow with n hops will invoke this function
- * n times)
- * NEW.fid: flow id
- * NEW.sid: id of the switch where the flow is to be installed
- * NEW.pid: host1, the previous-hop node
- * NEW.nid: host2, the next-hop node
+/* Add flows - proxy for ravel.flow.installFlows
+ * Statement-level trigger: gather match fields for every per-switch rule
+ * inserted by the statement with one join over the transition table,
+ * saving them in flow_lookup, then hand the whole batch to the OpenFlow
+ * manager.  The new rows are not in flow_lookup yet, so each is probed
+ * against the base tables by key (rm and hosts by primary key, switches by
+ * primary key, ports by its (sid, nid) index); flow_lookup serves the
+ * delete path and the maintenance triggers.  ARP flood rules are reference
+ * counted per switch and host in arp_refs
+ * new_cf: rows inserted into cf (fid, pid, sid, nid)
  */
-CREATE OR REPLACE FUNCTION add_flow_pre ()
+CREATE OR REPLACE FUNCTION add_flows_fun ()
 RETURNS TRIGGER
 AS $$
-    DECLARE
-        sw_name varchar(16);
-        sw_ip varchar(16);
-        sw_dpid varchar(16);
-
-        src_id int;
-        src_ip varchar(16);
-        src_mac varchar(17);
-
-        dst_id int;
-        dst_ip varchar(16);
-        dst_mac varchar(17);
-
-        outport int;
-        revoutport int;
-
-        start_time timestamptz;
-        end_time timestamptz;
-        diff interval;
-
-    BEGIN
-        start_time := clock_timestamp();
-
-        SELECT port INTO outport
-               FROM ports
-               WHERE sid=NEW.sid AND nid=NEW.nid;
-
-        SELECT port INTO revoutport
-               FROM ports
-               WHERE sid=NEW.sid AND nid=NEW.pid;
-
-        /* get src, dst host uids */
-        SELECT src, dst INTO src_id, dst_id
-               FROM rm
-               WHERE fid=NEW.fid;
-
-        SELECT name, ip, dpid INTO sw_name, sw_ip, sw_dpid
-               FROM switches
-               WHERE sid=NEW.sid;
-
-        /* get src, dst addresses */
-        SELECT ip, mac INTO src_ip, src_mac
-               FROM hosts
-               WHERE hid=src_id;
-
-        SELECT ip, mac INTO dst_ip, dst_mac
-               FROM hosts
-               WHERE hid=dst_id;
-
-        /* for profiling */
-        end_time := clock_timestamp();
-        diff := (EXTRACT(epoch FROM end_time) - EXTRACT(epoch FROM start_time));
-
-        PERFORM add_flow_fun(NEW.fid,
-                             sw_name, sw_ip, sw_dpid,
-                             src_ip, src_mac,
-                             dst_ip, dst_mac,
-                             outport, revoutport,
-                             to_char(diff, 'MS.US'));
-
-        return NEW;
-    END;
-$$ LANGUAGE plpgsql VOLATILE SECURITY DEFINER;
-
-
-/* Add flow - proxy for ravel.flow.installFlow
- * flow_id: id of flow to be installed
- * sw_name: switch name (in Mininet)
- * sw_ip: switch IP address (if a physical, remote switch)
- * sw_mac: switch MAC address
- * src_ip: source IP address
- * src_mac: source MAC address
- * dst_ip: destination IP address
- * src_mac: destination MAC address
- * outport: outport on sw_name for the forward flow (src->dst)
- * revoutport: outport on sw_name for the reverse flow (dst->src)
- * diff: time to query for flow fields
- */
-CREATE OR REPLACE FUNCTION add_flow_fun (flow_id integer,
-       sw_name varchar(16), sw_ip varchar(16), sw_dpid varchar(16),
-       src_ip varchar(16), src_mac varchar(17),
-       dst_ip varchar(16), dst_mac varchar(17),
-       outport integer, revoutport integer,
-       diff varchar(16))
-RETURNS integer
-AS $$
-import os
-import sys
 import time
 
-if "PYTHONPATH" in os.environ:
-    sys.path = os.environ["PYTHONPATH"].split(":") + sys.path
-sys.path.append("/home/ravel/ravel-python3")
-
-from ravel.flow import installFlow, Switch
-from ravel.profiling import PerfCounter
-
-pc = PerfCounter("db_select", float(diff))
+# set up the path and imports once per session
+if "ravel_path" not in GD:
+    import os
+    import sys
+
+    if "PYTHONPATH" in os.environ:
+        sys.path = os.environ["PYTHONPATH"].split(":") + sys.path
+    sys.path.append("/home/ravel/ravel-python3")
+    GD["ravel_path"] = True
+
+if "ravel.flow" not in GD:
+    import ravel.flow
+    import ravel.profiling
+    GD["ravel.flow"] = ravel.flow
+    GD["ravel.profiling"] = ravel.profiling
+
+flow = GD["ravel.flow"]
+profiling = GD["ravel.profiling"]
+
+start = time.time()
+flows = plpy.execute("""
+    INSERT INTO flow_lookup
+    SELECT c.fid, c.pid, c.sid, c.nid,
+           s.name, s.ip, s.dpid,
+           r.src, r.dst,
+           h1.ip, h1.mac, h2.ip, h2.mac,
+           p1.port, p2.port
+      FROM new_cf c
+      LEFT JOIN rm r ON r.fid = c.fid
+      LEFT JOIN switches s ON s.sid = c.sid
+      LEFT JOIN ports p1 ON p1.sid = c.sid AND p1.nid = c.nid
+      LEFT JOIN ports p2 ON p2.sid = c.sid AND p2.nid = c.pid
+      LEFT JOIN hosts h1 ON h1.hid = r.src
+      LEFT JOIN hosts h2 ON h2.hid = r.dst
+    RETURNING *;""")
+
+# count the flows relying on each switch's ARP flood rules; a rule is
+# installed only when its count goes from 0 to 1
+if "add_arp_plan" not in GD:
+    GD["add_arp_plan"] = plpy.prepare("""
+        WITH delta AS (
+            SELECT * FROM unnest($1, $2, $3) AS d(sid, mac, n)),
+        up AS (
+            INSERT INTO arp_refs (sid, mac, refs)
+            SELECT sid, mac, n FROM delta WHERE true
+                ON CONFLICT (sid, mac)
+                DO UPDATE SET refs = arp_refs.refs + EXCLUDED.refs
+            RETURNING sid, mac, refs)
+        SELECT up.sid, up.mac
+          FROM up
+          JOIN delta d ON d.sid = up.sid AND d.mac = up.mac
+         WHERE up.refs = d.n;""", ["integer[]", "varchar[]", "integer[]"])
+
+refs = plpy.execute(GD["add_arp_plan"], flow.arpDelta(flows))
+arps = flow.arpRules(flows, refs)
+
+pc = profiling.PerfCounter("db_select", (time.time() - start) * 1000, start)
 pc.report()
-sw = Switch(sw_name, sw_ip, sw_dpid)
-installFlow(flow_id, sw, src_ip, src_mac, dst_ip, dst_mac, outport, revoutport)
 
-return 0
+flow.installFlows(flows, arps)
+return None;
 $$ LANGUAGE plpython3u VOLATILE SECURITY DEFINER;
 
 
-/* Add flow trigger - for each per-switch rule, invoke add_flow_pre
- * to install flow in that switch
- */
+/* Add flow trigger - once per statement inserting into cf */
 CREATE TRIGGER add_flow_trigger
        AFTER INSERT ON cf
-       FOR EACH ROW
-       EXECUTE PROCEDURE add_flow_pre();
+       REFERENCING NEW TABLE AS new_cf
+       FOR EACH STATEMENT
+       EXECUTE PROCEDURE add_flows_fun();
 
 
-/* Delete flow preprocessing - gather match fields to install a flow
- * in a single switch (a flow with n hops will invoke this function
- * n times)
- * OLD.fid: flow id
- * OLD.sid: id of the switch where the flow is to be removed
- * OLD.pid: host1, the previous-hop node
- * OLD.nid: host2, the next-hop node
+/* Delete flows - proxy for ravel.flow.removeFlows
+ * Statement-level trigger: remove the match fields of every per-switch
+ * rule deleted by the statement from flow_lookup, then hand the whole
+ * batch to the OpenFlow manager.  ARP flood rules are reference counted
+ * per switch and host in arp_refs
+ * old_cf: rows deleted from cf (fid, pid, sid, nid)
  */
-CREATE OR REPLACE FUNCTION del_flow_pre ()
+CREATE OR REPLACE FUNCTION del_flows_fun ()
 RETURNS TRIGGER
 AS $$
-    DECLARE
-        sw_name varchar(16);
-        sw_ip varchar(16);
-        sw_dpid varchar(16);
-
-        src_id int;
-        src_ip varchar(16);
-        src_mac varchar(17);
-
-        dst_id int;
-        dst_ip varchar(16);
-        dst_mac varchar(17);
-
-        outport int;
-        revoutport int;
-
-        start_time timestamptz;
-        end_time timestamptz;
-        diff interval;
-    BEGIN
-        start_time := clock_timestamp();
-
-        SELECT port INTO outport
-               FROM ports
-               WHERE sid=OLD.sid and nid=OLD.nid;
-
-        SELECT port INTO revoutport
-               FROM ports
-               WHERE sid=OLD.sid and nid=OLD.pid;
-
-        /* get src, dst host uids */
-        SELECT src, dst INTO src_id, dst_id
-               FROM rm_delta
-               WHERE fid=OLD.fid;
-
-        /* get src, dst addresses */
-        SELECT name, ip, dpid INTO sw_name, sw_ip, sw_dpid
-               FROM switches
-               WHERE sid=OLD.sid;
-
-        /* get src, dst addresses */
-        SELECT ip, mac INTO src_ip, src_mac
-               FROM hosts
-               WHERE hid=src_id;
-
-        SELECT ip, mac INTO dst_ip, dst_mac
-               FROM hosts
-               WHERE hid=dst_id;
-
-        /* for profiling */
-        end_time := clock_timestamp();
-        diff := (extract(epoch from end_time) - extract(epoch from start_time));
-
-        PERFORM del_flow_fun(OLD.fid,
-                             sw_name, sw_ip, sw_dpid,
-                             src_ip, src_mac,
-                             dst_ip, dst_mac,
-                             outport, revoutport,
-                             to_char(diff, 'MS.US'));
-
-        return OLD;
-    END;
-$$ LANGUAGE plpgsql VOLATILE SECURITY DEFINER;
-
-
-/* Delete flow - proxy for ravel.flow.removeFlow
- * flow_id: id of flow to be removed
- * sw_name: switch name (in Mininet)
- * sw_ip: switch IP address (if a physical, remote switch)
- * sw_mac: switch MAC address
- * src_ip: source IP address
- * src_mac: source MAC address
- * dst_ip: destination IP address
- * src_mac: destination MAC address
- * outport: outport on sw_name for the forward flow (src->dst)
- * revoutport: outport on sw_name for the reverse flow (dst->src)
- * diff: time to query for flow fields
- */
-CREATE OR REPLACE FUNCTION del_flow_fun (flow_id integer,
-       sw_name varchar(16), sw_ip varchar(16), sw_dpid varchar(16),
-       src_ip varchar(16), src_mac varchar(17),
-       dst_ip varchar(16), dst_mac varchar(17),
-       outport integer, revoutport integer,
-       diff varchar(16))
-RETURNS integer
-AS $$
-import os
-import sys
 import time
 
-if "PYTHONPATH" in os.environ:
-    sys.path = os.environ["PYTHONPATH"].split(":") + sys.path
-sys.path.append("/home/ravel/ravel-python3")
-
-from ravel.flow import removeFlow, Switch
-from ravel.profiling import PerfCounter
-
-pc = PerfCounter("db_select", float(diff))
+# set up the path and imports once per session
+if "ravel_path" not in GD:
+    import os
+    import sys
+
+    if "PYTHONPATH" in os.environ:
+        sys.path = os.environ["PYTHONPATH"].split(":") + sys.path
+    sys.path.append("/home/ravel/ravel-python3")
+    GD["ravel_path"] = True
+
+if "ravel.flow" not in GD:
+    import ravel.flow
+    import ravel.profiling
+    GD["ravel.flow"] = ravel.flow
+    GD["ravel.profiling"] = ravel.profiling
+
+flow = GD["ravel.flow"]
+profiling = GD["ravel.profiling"]
+
+start = time.time()
+flows = plpy.execute("""
+    DELETE FROM flow_lookup l
+     USING old_cf c
+     WHERE l.fid = c.fid AND l.sid = c.sid
+       AND l.pid IS NOT DISTINCT FROM c.pid
+       AND l.nid IS NOT DISTINCT FROM c.nid
+    RETURNING l.*;""")
+
+# a flow's ARP flood rules are removed only when no other flow through
+# the switch relies on them
+if "del_arp_plan" not in GD:
+    GD["del_arp_plan"] = plpy.prepare("""
+        WITH delta AS (
+            SELECT * FROM unnest($1, $2, $3) AS d(sid, mac, n))
+        UPDATE arp_refs a SET refs = a.refs - d.n
+          FROM delta d
+         WHERE a.sid = d.sid AND a.mac = d.mac
+        RETURNING a.sid, a.mac, a.refs;""",
+        ["integer[]", "varchar[]", "integer[]"])
+
+refs = plpy.execute(GD["del_arp_plan"], flow.arpDelta(flows))
+arps = flow.arpRules(flows, [r for r in refs if r["refs"] <= 0])
+plpy.execute("DELETE FROM arp_refs WHERE refs <= 0;")
+
+pc = profiling.PerfCounter("db_select", (time.time() - start) * 1000, start)
 pc.report()
 
-sw = Switch(sw_name, sw_ip, sw_dpid)
-removeFlow(flow_id, sw, src_ip, src_mac, dst_ip, dst_mac, outport, revoutport)
-
-return 0
+flow.removeFlows(flows, arps)
+return None;
 $$ LANGUAGE plpython3u VOLATILE SECURITY DEFINER;
 
 
-/* Delete flow trigger - for each per-switch rule, invoke del_flow_pre
- * to delete flow from that switch
- */
+/* Delete flow trigger - once per statement deleting from cf */
 CREATE TRIGGER del_flow_trigger
        AFTER DELETE ON cf
-       FOR EACH ROW
-       EXECUTE PROCEDURE del_flow_pre();
+       REFERENCING OLD TABLE AS old_cf
+       FOR EACH STATEMENT
+       EXECUTE PROCEDURE del_flows_fun();
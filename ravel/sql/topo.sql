@@ -10,24 +10,29 @@
 CREATE OR REPLACE FUNCTION add_link_fun ()
 RETURNS TRIGGER
 AS $$
-import os
-import sys
+# set up the path and imports once per session
+if "ravel_path" not in GD:
+    import os
+    import sys
 
-if "PYTHONPATH" in os.environ:
-    sys.path = os.environ["PYTHONPATH"].split(":") + sys.path
-sys.path.append("/home/ravel/ravel-python3")
+    if "PYTHONPATH" in os.environ:
+        sys.path = os.environ["PYTHONPATH"].split(":") + sys.path
+    sys.path.append("/home/ravel/ravel-python3")
+    GD["ravel_path"] = True
 
-from ravel.network import AddLinkMessage, NetworkProvider
-from ravel.messaging import MsgQueueSender
+if "ravel.network" not in GD:
+    import ravel.network
+    GD["ravel.network"] = ravel.network
+
+network = GD["ravel.network"]
 
 sid = TD["new"]["sid"]
 nid = TD["new"]["nid"]
 isHost = TD["new"]["ishost"]
 isActive = TD["new"]["ishost"]
 
-msg = AddLinkMessage(sid, nid, isHost, isActive)
-sender = MsgQueueSender(NetworkProvider.QueueId)
-sender.send(msg)
+msg = network.AddLinkMessage(sid, nid, isHost, isActive)
+network.sendToProvider(msg)
 
 return None;
 $$ LANGUAGE 'plpython3u' VOLATILE SECURITY DEFINER;
@@ -47,22 +52,27 @@ CREATE TRIGGER add_link_trigger
 CREATE OR REPLACE FUNCTION del_link_fun ()
 RETURNS TRIGGER
 AS $$
-import os
-import sys
+# set up the path and imports once per session
+if "ravel_path" not in GD:
+    import os
+    import sys
+
+    if "PYTHONPATH" in os.environ:
+        sys.path = os.environ["PYTHONPATH"].split(":") + sys.path
+    sys.path.append("/home/ravel/ravel-python3")
+    GD["ravel_path"] = True
 
-if "PYTHONPATH" in os.environ:
-    sys.path = os.environ["PYTHONPATH"].split(":") + sys.path
-sys.path.append("/home/ravel/ravel-python3")
+if "ravel.network" not in GD:
+    import ravel.network
+    GD["ravel.network"] = ravel.network
 
-from ravel.network import RemoveLinkMessage, NetworkProvider
-from ravel.messaging import MsgQueueSender
+network = GD["ravel.network"]
 
 sid = TD["old"]["sid"]
 nid = TD["old"]["nid"]
 
-msg = RemoveLinkMessage(sid, nid)
-sender = MsgQueueSender(NetworkProvider.QueueId)
-sender.send(msg)
+msg = network.RemoveLinkMessage(sid, nid)
+network.sendToProvider(msg)
 
 return None;
 $$ LANGUAGE 'plpython3u' VOLATILE SECURITY DEFINER;
@@ -85,15 +95,21 @@ CREATE TRIGGER del_link_trigger
 CREATE OR REPLACE FUNCTION add_switch_fun ()
 RETURNS TRIGGER
 AS $$
-import os
-import sys
+# set up the path and imports once per session
+if "ravel_path" not in GD:
+    import os
+    import sys
+
+    if "PYTHONPATH" in os.environ:
+        sys.path = os.environ["PYTHONPATH"].split(":") + sys.path
+    sys.path.append("/home/ravel/ravel-python3")
+    GD["ravel_path"] = True
 
-if "PYTHONPATH" in os.environ:
-    sys.path = os.environ["PYTHONPATH"].split(":") + sys.path
-sys.path.append("/home/ravel/ravel-python3")
+if "ravel.network" not in GD:
+    import ravel.network
+    GD["ravel.network"] = ravel.network
 
-from ravel.network import AddSwitchMessage, NetworkProvider
-from ravel.messaging import MsgQueueSender
+network = GD["ravel.network"]
 
 sid = TD["new"]["sid"]
 name = TD["new"]["name"]
@@ -101,9 +117,8 @@ dpid = TD["new"]["dpid"]
 ip = TD["new"]["ip"]
 mac = TD["new"]["mac"]
 
-msg = AddSwitchMessage(sid, name, dpid, ip, mac)
-sender = MsgQueueSender(NetworkProvider.QueueId)
-sender.send(msg)
+msg = network.AddSwitchMessage(sid, name, dpid, ip, mac)
+network.sendToProvider(msg)
 
 return None;
 $$ LANGUAGE 'plpython3u' VOLATILE SECURITY DEFINER;
@@ -123,22 +138,27 @@ CREATE TRIGGER add_switch_trigger
 CREATE OR REPLACE FUNCTION del_switch_fun ()
 RETURNS TRIGGER
 AS $$
-import os
-import sys
+# set up the path and imports once per session
+if "ravel_path" not in GD:
+    import os
+    import sys
 
-if "PYTHONPATH" in os.environ:
-    sys.path = os.environ["PYTHONPATH"].split(":") + sys.path
-sys.path.append("/home/ravel/ravel-python3")
+    if "PYTHONPATH" in os.environ:
+        sys.path = os.environ["PYTHONPATH"].split(":") + sys.path
+    sys.path.append("/home/ravel/ravel-python3")
+    GD["ravel_path"] = True
 
-from ravel.network import RemoveSwitchMessage, NetworkProvider
-from ravel.messaging import MsgQueueSender
+if "ravel.network" not in GD:
+    import ravel.network
+    GD["ravel.network"] = ravel.network
+
+network = GD["ravel.network"]
 
 sid = TD["old"]["sid"]
 name = TD["old"]["name"]
 
-msg = RemoveSwitchMessage(sid, name)
-sender = MsgQueueSender(NetworkProvider.QueueId)
-sender.send(msg)
+msg = network.RemoveSwitchMessage(sid, name)
+network.sendToProvider(msg)
 
 return None;
 $$ LANGUAGE 'plpython3u' VOLATILE SECURITY DEFINER;
@@ -160,24 +180,29 @@ CREATE TRIGGER del_switch_trigger
 CREATE OR REPLACE FUNCTION add_host_fun ()
 RETURNS TRIGGER
 AS $$
-import os
-import sys
+# set up the path and imports once per session
+if "ravel_path" not in GD:
+    import os
+    import sys
+
+    if "PYTHONPATH" in os.environ:
+        sys.path = os.environ["PYTHONPATH"].split(":") + sys.path
+    sys.path.append("/home/ravel/ravel-python3")
+    GD["ravel_path"] = True
 
-if "PYTHONPATH" in os.environ:
-    sys.path = os.environ["PYTHONPATH"].split(":") + sys.path
-sys.path.append("/home/ravel/ravel-python3")
+if "ravel.network" not in GD:
+    import ravel.network
+    GD["ravel.network"] = ravel.network
 
-from ravel.network import AddHostMessage, NetworkProvider
-from ravel.messaging import MsgQueueSender
+network = GD["ravel.network"]
 
 hid = TD["new"]["hid"]
 name = TD["new"]["name"]
 ip = TD["new"]["ip"]
 mac = TD["new"]["mac"]
 
-msg = AddHostMessage(hid, name, ip, mac)
-sender = MsgQueueSender(NetworkProvider.QueueId)
-sender.send(msg)
+msg = network.AddHostMessage(hid, name, ip, mac)
+network.sendToProvider(msg)
 
 return None;
 $$ LANGUAGE 'plpython3u' VOLATILE SECURITY DEFINER;
@@ -197,22 +222,27 @@ CREATE TRIGGER add_host_trigger
 CREATE OR REPLACE FUNCTION del_host_fun ()
 RETURNS TRIGGER
 AS $$
-import os
-import sys
+# set up the path and imports once per session
+if "ravel_path" not in GD:
+    import os
+    import sys
+
+    if "PYTHONPATH" in os.environ:
+        sys.path = os.environ["PYTHONPATH"].split(":") + sys.path
+    sys.path.append("/home/ravel/ravel-python3")
+    GD["ravel_path"] = True
 
-if "PYTHONPATH" in os.environ:
-    sys.path = os.environ["PYTHONPATH"].split(":") + sys.path
-sys.path.append("/home/ravel/ravel-python3")
+if "ravel.network" not in GD:
+    import ravel.network
+    GD["ravel.network"] = ravel.network
 
-from ravel.network import RemoveHostMessage, NetworkProvider
-from ravel.messaging import MsgQueueSender
+network = GD["ravel.network"]
 
 hid = TD["old"]["hid"]
 name = TD["old"]["name"]
 
-msg = RemoveHostMessage(hid, name)
-sender = MsgQueueSender(NetworkProvider.QueueId)
-sender.send(msg)
+msg = network.RemoveHostMessage(hid, name)
+network.sendToProvider(msg)
 
 return None;
 $$ LANGUAGE 'plpython3u' VOLATILE SECURITY DEFINER;
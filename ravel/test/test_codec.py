@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+import unittest
+from runner import addRavelPath
+
+addRavelPath()
+
+import ravel.codec
+from ravel.flow import BarrierMessage, FlowModBatch, Match, OfMessage, Switch
+from ravel.network import AddHostMessage, AddSwitchMessage, RemoveLinkMessage
+from ravel.of import OFPFC_ADD, OFPP_FLOOD
+from ravel.profiling import CounterBatch, PerfCounter, StatementCounter
+
+def flowmod(nw_src="10.0.0.1", nw_dst="10.0.0.2", dl_src=None):
+    return OfMessage(command=OFPFC_ADD,
+                     priority=10,
+                     switch=Switch("s1", "127.0.0.1", "0000000000000001"),
+                     match=Match(nw_src=nw_src, nw_dst=nw_dst, dl_src=dl_src,
+                                 dl_type=0x0800),
+                     actions=[1, OFPP_FLOOD])
+
+class testCodec(unittest.TestCase):
+
+    def roundTrip(self, msg):
+        return ravel.codec.decode(ravel.codec.encode(msg))
+
+    def assertFlowmodEqual(self, msg, decoded):
+        self.assertEqual(decoded.command, msg.command)
+        self.assertEqual(decoded.priority, msg.priority)
+        self.assertEqual(decoded.actions, msg.actions)
+        for field in Switch.__slots__:
+            self.assertEqual(getattr(decoded.switch, field),
+                             getattr(msg.switch, field))
+        for field in Match.__slots__:
+            self.assertEqual(getattr(decoded.match, field),
+                             getattr(msg.match, field))
+
+    def testNull(self):
+        self.assertIsNone(self.roundTrip(None))
+
+    def testOfMessage(self):
+        msg = flowmod(dl_src="00:00:00:00:00:01")
+        self.assertFlowmodEqual(msg, self.roundTrip(msg))
+
+    def testOfMessageTextAddresses(self):
+        # addresses that are not dotted IPv4 are sent as strings
+        msg = flowmod(nw_dst="10.0.0.0/8")
+        self.assertFlowmodEqual(msg, self.roundTrip(msg))
+
+    def testBarrierMessage(self):
+        for sent in [None, 1500000000.25]:
+            msg = self.roundTrip(BarrierMessage("0000000000000001",
+                                                [1, 2, 3], sent))
+            self.assertEqual(msg.dpid, "0000000000000001")
+            self.assertEqual(msg.fids, [1, 2, 3])
+            self.assertEqual(msg.sent, sent)
+
+    def testFlowModBatch(self):
+        msgs = [flowmod(), flowmod(nw_src="10.0.0.3"),
+                BarrierMessage("0000000000000001", [7])]
+        batch = self.roundTrip(FlowModBatch(msgs))
+        self.assertEqual(len(batch), 3)
+        self.assertFlowmodEqual(msgs[0], batch.msgs[0])
+        self.assertFlowmodEqual(msgs[1], batch.msgs[1])
+        self.assertEqual(batch.msgs[2].fids, [7])
+
+    def testFlowModBatchSplit(self):
+        msgs = [flowmod(nw_src="10.0.0.{0}".format(i)) for i in range(5)]
+        parts = FlowModBatch(msgs).split()
+        self.assertEqual(len(parts), 2)
+        self.assertEqual([m for part in parts for m in part.msgs], msgs)
+        self.assertEqual([len(part) for part in parts], [2, 3])
+
+    def testNetworkMessages(self):
+        msg = self.roundTrip(AddSwitchMessage(1, "s1", "0000000000000001",
+                                              "127.0.0.1", None))
+        self.assertEqual((msg.sid, msg.name, msg.dpid, msg.ip, msg.mac),
+                         (1, "s1", "0000000000000001", "127.0.0.1", None))
+        msg = self.roundTrip(AddHostMessage(2, "h1", "10.0.0.1/8",
+                                            "00:00:00:00:00:01"))
+        self.assertEqual((msg.hid, msg.name, msg.ip, msg.mac),
+                         (2, "h1", "10.0.0.1/8", "00:00:00:00:00:01"))
+        msg = self.roundTrip(RemoveLinkMessage(1, 2))
+        self.assertEqual((msg.node1, msg.node2), (1, 2))
+
+    def testCounterBatch(self):
+        counters = [PerfCounter("db_select", 1.5, 1500000000.5, 10, "pox"),
+                    PerfCounter("mq_send", 0.25),
+                    StatementCounter("SELECT * FROM rm WHERE fid = ?", 2.0,
+                                     1, None, 11, "postgres")]
+        decoded = self.roundTrip(CounterBatch(counters)).counters
+        self.assertEqual(len(decoded), 3)
+        for counter, copy in zip(counters, decoded):
+            self.assertEqual(type(copy), type(counter))
+            for field in ["name", "time_ms", "ts", "pid", "proc"]:
+                self.assertEqual(getattr(copy, field),
+                                 getattr(counter, field))
+        self.assertEqual(decoded[2].statement, counters[2].statement)
+        self.assertEqual(decoded[2].rows, 1)
+
+    def testUnregisteredType(self):
+        self.assertRaises(ravel.codec.CodecError, ravel.codec.encode,
+                          object())
+
+    def testRejectedMessages(self):
+        header = ravel.codec._header
+        # the retired pickled type code
+        self.assertRaises(ravel.codec.CodecError, ravel.codec.decode,
+                          header.pack(ravel.codec.Version, 1) + b"data")
+        self.assertRaises(ravel.codec.CodecError, ravel.codec.decode,
+                          header.pack(ravel.codec.Version - 1,
+                                      ravel.codec.Null))
+        self.assertRaises(ravel.codec.CodecError, ravel.codec.decode, b"")
+
+if __name__ == "__main__":
+    unittest.main()
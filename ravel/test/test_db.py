@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+import unittest
+from runner import addRavelPath
+
+addRavelPath()
+
+from ravel.db import _copy_value, normalize
+
+class testNormalize(unittest.TestCase):
+
+    def testLiterals(self):
+        self.assertEqual(normalize("SELECT * FROM rm WHERE fid = 12"),
+                         "SELECT * FROM rm WHERE fid = ?")
+        self.assertEqual(normalize("UPDATE hosts SET ip = '10.0.0.1' "
+                                   "WHERE hid = 3.5"),
+                         "UPDATE hosts SET ip = ? WHERE hid = ?")
+
+    def testQuotedQuotes(self):
+        self.assertEqual(normalize("SELECT 'it''s', 'x'"), "SELECT ?, ?")
+
+    def testIdentifiersKept(self):
+        self.assertEqual(normalize("SELECT s1, h2 FROM tp1"),
+                         "SELECT s1, h2 FROM tp1")
+
+    def testWhitespace(self):
+        self.assertEqual(normalize("  SELECT *\n\tFROM   rm ;  "),
+                         "SELECT * FROM rm ;")
+
+class testCopyValue(unittest.TestCase):
+
+    def testNull(self):
+        self.assertEqual(_copy_value(None), "\\N")
+
+    def testEscapes(self):
+        self.assertEqual(_copy_value("a\tb"), "a\\tb")
+        self.assertEqual(_copy_value("a\nb"), "a\\nb")
+        self.assertEqual(_copy_value("a\\b"), "a\\\\b")
+        self.assertEqual(_copy_value("\\N"), "\\\\N")
+
+    def testValues(self):
+        self.assertEqual(_copy_value(12), "12")
+        self.assertEqual(_copy_value(1.5), "1.5")
+        self.assertEqual(_copy_value("10.0.0.1"), "10.0.0.1")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import unittest
+from runner import addRavelPath
+
+addRavelPath()
+
+import sysv_ipc
+
+import ravel.codec
+import ravel.messaging
+from ravel.flow import BarrierMessage, FlowModBatch
+from ravel.messaging import MsgQueueSender, PersistentSender, ShmRing
+from ravel.messaging import SpillLog
+from ravel.util import Config
+
+TestQueueId = 0x52560001
+TestSemId = 0x52560002
+
+class FailingSender(object):
+    "A sender that raises an error on its first send"
+
+    def __init__(self, error, sent):
+        self.error = error
+        self.sent = sent
+
+    def send(self, msg):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+        self.sent.append(msg)
+
+class testPersistentSender(unittest.TestCase):
+
+    def connect(self, error):
+        self.connections = 0
+        self.sent = []
+
+        def factory():
+            self.connections += 1
+            return FailingSender(error if self.connections == 1 else None,
+                                 self.sent)
+        return PersistentSender(factory)
+
+    def testReconnect(self):
+        sender = self.connect(ConnectionError("closed"))
+        sender.send("msg")
+        self.assertEqual(self.connections, 2)
+        self.assertEqual(self.sent, ["msg"])
+
+    def testEncodingError(self):
+        sender = self.connect(ravel.codec.CodecError("cannot encode"))
+        self.assertRaises(ravel.codec.CodecError, sender.send, "msg")
+        self.assertEqual(self.connections, 1)
+        sender.send("msg")
+        self.assertEqual(self.connections, 1)
+        self.assertEqual(self.sent, ["msg"])
+
+class testSpillLog(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.log = SpillLog(os.path.join(self.dir, "spill"))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testEmpty(self):
+        self.assertFalse(self.log.pending())
+        self.assertEqual(self.log.drain(), [])
+
+    def testDrainInOrder(self):
+        msgs = [b"", b"a", b"b" * 100, b"c" * (1 << 21)]
+        for msg in msgs:
+            self.log.append(msg)
+        self.assertTrue(self.log.pending())
+        self.assertEqual(self.log.drain(), msgs)
+        self.assertFalse(self.log.pending())
+        self.assertEqual(self.log.drain(), [])
+
+class testShmRing(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.ring = ShmRing(os.path.join(self.dir, "ring"), 256, TestSemId,
+                            create=True)
+
+    def tearDown(self):
+        self.ring.close()
+        shutil.rmtree(self.dir)
+
+    def read(self):
+        return [bytes(view) for view in self.ring.read()]
+
+    def testReadWrite(self):
+        self.assertTrue(self.ring.write(b"one"))
+        self.assertTrue(self.ring.write(b"two"))
+        self.assertEqual(self.read(), [b"one", b"two"])
+        self.assertEqual(self.ring.depth(), 0)
+
+    def testFull(self):
+        msg = b"x" * 60
+        written = 0
+        while self.ring.write(msg):
+            written += 1
+        self.assertEqual(written, 256 // (len(msg) + ShmRing.frame.size))
+        self.assertEqual(len(self.read()), written)
+        self.assertTrue(self.ring.write(msg))
+
+    def testWrapAround(self):
+        # frames that do not fit before the end of the ring are padded and
+        # written at the start, so every message reads back whole
+        sent = []
+        received = []
+        for i in range(50):
+            msg = bytes([i]) * (10 + i % 37)
+            self.assertTrue(self.ring.write(msg))
+            sent.append(msg)
+            if i % 3 == 2:
+                received.extend(self.read())
+        received.extend(self.read())
+        self.assertEqual(received, sent)
+
+class testMsgQueueSender(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.spilldir = Config.SpillDir
+        Config.SpillDir = self.dir
+        self.mq = sysv_ipc.MessageQueue(
+            TestQueueId, sysv_ipc.IPC_CREAT, mode=0o600,
+            max_message_size=ravel.messaging.msgmax())
+        self.sender = MsgQueueSender(TestQueueId, timeout=0)
+
+    def tearDown(self):
+        self.mq.remove()
+        Config.SpillDir = self.spilldir
+        shutil.rmtree(self.dir)
+
+    def receive(self):
+        msgs = []
+        while True:
+            try:
+                data, lane = self.mq.receive(block=False)
+            except sysv_ipc.BusyError:
+                return msgs
+            msgs.append(ravel.codec.decode(data))
+
+    def testSplit(self):
+        msgs = [BarrierMessage(str(i), list(range(20))) for i in range(40)]
+        batch = FlowModBatch(msgs)
+        self.sender.maxsize = len(ravel.codec.encode(batch)) // 3
+        self.sender.send(batch)
+
+        parts = self.receive()
+        self.assertGreater(len(parts), 1)
+        for part in parts:
+            self.assertLessEqual(len(ravel.codec.encode(part)),
+                                 self.sender.maxsize)
+        self.assertEqual([m.dpid for part in parts for m in part.msgs],
+                         [m.dpid for m in msgs])
+
+    def testOversizeSpilled(self):
+        msg = BarrierMessage("1", list(range(100)))
+        self.sender.maxsize = 64
+        self.sender.send(msg)
+
+        self.assertEqual(self.receive(), [])
+        spilled = self.sender.spill.drain()
+        self.assertEqual(len(spilled), 1)
+        self.assertEqual(ravel.codec.decode(spilled[0]).fids, msg.fids)
+        self.assertEqual(self.sender.stats()["spilled"], 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+import random
+import unittest
+from runner import addRavelPath
+
+addRavelPath()
+
+from ravel.profiling import Histogram
+
+class testHistogram(unittest.TestCase):
+
+    def testEmpty(self):
+        self.assertIsNone(Histogram().percentile(50))
+
+    def testSmallValuesExact(self):
+        # values below 2 * SubBuckets have their own bucket
+        h = Histogram()
+        for value in range(1, 101):
+            h.record(value)
+        self.assertEqual(h.percentile(50), 50)
+        self.assertEqual(h.percentile(90), 90)
+        self.assertEqual(h.percentile(100), 100)
+        self.assertEqual((h.min, h.max, h.count), (1, 100, 100))
+
+    def testPrecision(self):
+        rnd = random.Random(1)
+        values = sorted(rnd.randrange(1, 10 ** 10) for i in range(10000))
+        h = Histogram()
+        for value in values:
+            h.record(value)
+
+        for p in [50, 90, 99]:
+            exact = values[int(round(p / 100.0 * len(values))) - 1]
+            estimate = h.percentile(p)
+            self.assertGreaterEqual(estimate, exact)
+            self.assertLessEqual(estimate - exact,
+                                 exact / float(Histogram.SubBuckets))
+
+    def testBucketWidth(self):
+        for value in [255, 256, 1000, 123456789, 2 ** 40 + 1]:
+            bucket = Histogram._bucket(value)
+            low = bucket[1] << bucket[0]
+            high = Histogram._upper(bucket)
+            self.assertTrue(low <= value <= high)
+            self.assertLessEqual(high - low + 1,
+                                 max(1, value // Histogram.SubBuckets))
+
+    def testMerge(self):
+        a = Histogram()
+        b = Histogram()
+        for value in range(1, 51):
+            a.record(value)
+        for value in range(51, 101):
+            b.record(value)
+        a.merge(b)
+        self.assertEqual((a.min, a.max, a.count), (1, 100, 100))
+        self.assertEqual(a.percentile(50), 50)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -89,6 +89,12 @@ class testCommands(unittest.TestCase):
         p.sendline("p select count(*) from cf")
         p.expect("0")
 
+        # a flow that was never orchestrated is not confirmed
+        p.sendline("rt wait 999 timeout=0.5")
+        p.expect("Failure: flows not confirmed -- 999")
+        p.sendline("rt addflow --wait h1 h2")
+        p.expect("Invalid option --wait")
+
         p.sendline("orch auto on")
         p.sendline("rt addflow h1 h2")
         p.expect("Success")
@@ -6,42 +6,50 @@ import configparser
 import os
 import re
 import sys
+import tempfile
 
 from ravel.log import logger
 
 class ConnectionType:
     """A enum for connection protocols between database triggers and the
        OpenFlow manager.  Types include Rpc (remote procedure call), Mq
-       (message queues), and ovs (ovs-ofctl tool)."""
+       (message queues), ovs (ovs-ofctl tool), and Shm (shared memory ring
+       buffer)."""
 
     Ovs = 0
     Rpc = 1
     Mq = 2
+    Shm = 3
     Name = { "ovs" : Ovs,
              "rpc" : Rpc,
-             "mq" : Mq
+             "mq" : Mq,
+             "shm" : Shm
          }
 
 
+def set_trigger_path(content, path):
+    """Set PYTHONPATH within the Python-based triggers in a SQL script
+       content: the text of the SQL script
+       path: the path to append to PYTHONPATH
+       returns: the text with the triggers' path replaced"""
+    path = os.path.expanduser(path)
+    newstr = 'sys.path.append("{0}")'.format(path)
+    pattern = re.compile(r"sys.path.append\(\S+\)")
+    return re.sub(pattern, lambda m: newstr, content)
+
 def update_trigger_path(filename, path):
     """Update PYTHONPATH within a Python-based trigger implemented within the
        SQL file specified in filename.
        filename: the file containing the SQL trigger implementation
        path: the path to append to PYTHONPATH"""
-    path = os.path.expanduser(path)
     if not os.path.isfile(filename):
         logger.warning("cannot find sql file %s", filename)
         return
 
     with open(filename, "r") as f:
-        lines = []
         content = f.read()
 
-    newstr = 'sys.path.append("{0}")'.format(path)
-    pattern = re.compile(r"sys.path.append\(\S+\)")
-    content = re.sub(pattern, newstr, content)
-
-    open(filename, "w").write(content)
+    open(filename, "w").write(set_trigger_path(content, path))
 
 def append_path(path):
     """Append a path to PYTHONPATH
@@ -119,9 +127,22 @@ class ConfigParameters(object):
         self.AppDirs = []
         self.DbName = None
         self.DbUser = None
+        self.DbPoolSize = None
+        self.DbTemplate = True
+        self.DbFetchSize = None
+        self.DbRowLimit = None
+        self.SnapshotDir = os.path.join(tempfile.gettempdir(),
+                                        "ravel_snapshots")
+        self.ProfileStatements = False
         self.RpcHost = None
         self.RpcPort = None
         self.QueueId = None
+        self.Workers = 1
+        self.SendTimeout = 0.5
+        self.SpillDir = "/tmp"
+        self.ShmPath = "/dev/shm/ravel_ring"
+        self.ShmSize = 4194304
+        self.ShmSemId = 9998
         self.Connection = None
         self.PoxDir = None
         self.PoxPort = None
@@ -162,6 +183,25 @@ class ConfigParameters(object):
         if parser.has_option("db", "user"):
             self.DbUser = parser.get("db", "user")
 
+        if parser.has_option("db", "poolsize"):
+            self.DbPoolSize = parser.getint("db", "poolsize")
+
+        if parser.has_option("db", "template"):
+            self.DbTemplate = parser.getboolean("db", "template")
+
+        if parser.has_option("db", "fetchsize"):
+            self.DbFetchSize = parser.getint("db", "fetchsize")
+
+        if parser.has_option("db", "rowlimit"):
+            self.DbRowLimit = parser.getint("db", "rowlimit")
+
+        if parser.has_option("db", "snapshotdir"):
+            self.SnapshotDir = parser.get("db", "snapshotdir")
+
+        if parser.has_option("profiling", "statements"):
+            self.ProfileStatements = parser.getboolean("profiling",
+                                                       "statements")
+
         if parser.has_option("rpc", "rpchost"):
             self.RpcHost = parser.get("rpc", "rpchost")
         if parser.has_option("rpc", "rpcport"):
@@ -170,4 +210,20 @@ class ConfigParameters(object):
         if parser.has_option("mq", "queueid"):
             self.QueueId = parser.getint("mq", "queueid")
 
+        if parser.has_option("mq", "workers"):
+            self.Workers = parser.getint("mq", "workers")
+
+        if parser.has_option("mq", "sendtimeout"):
+            self.SendTimeout = parser.getfloat("mq", "sendtimeout")
+
+        if parser.has_option("mq", "spilldir"):
+            self.SpillDir = parser.get("mq", "spilldir")
+
+        if parser.has_option("shm", "path"):
+            self.ShmPath = parser.get("shm", "path")
+        if parser.has_option("shm", "size"):
+            self.ShmSize = parser.getint("shm", "size")
+        if parser.has_option("shm", "semaphoreid"):
+            self.ShmSemId = parser.getint("shm", "semaphoreid")
+
 Config = ConfigParameters()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks for the messaging path between the database triggers and the
+OpenFlow manager.
+
+mq: send flowmods over a System V message queue to a receiver that counts
+them, either one message per flowmod or as FlowModBatch messages, with the
+given number of receiver workers.
+codec: time encoding and decoding of messages with pickle and with
+ravel.codec, and compare their sizes.
+transport: send barriers one at a time over each transport (mq, rpc, shm)
+and report throughput and the latency from send to consume.
+profiling: time PerfCounter start and stop with profiling off and on.
+Usage: util/benchmark.py mq [flows] [hops] [workers]
+       util/benchmark.py codec [count]
+       util/benchmark.py transport [count]
+       util/benchmark.py profiling [count]
+"""
+
+import os
+import pickle
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                ".."))
+
+import ravel.codec
+import ravel.profiling
+from ravel.flow import _flow_msgs, _arp_msg
+from ravel.flow import BarrierMessage, FlowModBatch, Switch
+from ravel.messaging import MsgQueueSender, MsgQueueReceiver
+from ravel.messaging import RpcSender, RpcReceiver
+from ravel.messaging import ShmSender, ShmReceiver
+from ravel.of import OfManager, OFPFC_ADD
+
+QueueId = 424242
+RpcPort = 9424
+ShmPath = "/dev/shm/ravel_benchmark"
+ShmSize = 4194304
+SemId = 424243
+
+class CountingManager(OfManager):
+    "An OpenFlow manager that counts the messages it consumes"
+
+    def __init__(self, expected):
+        "expected: the number of flowmods to wait for"
+        super(CountingManager, self).__init__()
+        self.expected = expected
+        self.flowmods = 0
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+
+    def sendFlowmod(self, msg):
+        with self.lock:
+            self.flowmods += 1
+            if self.flowmods >= self.expected:
+                self.done.set()
+
+    def sendBarrier(self, dpid, fids=None, sent=None):
+        pass
+
+class LatencyManager(OfManager):
+    "An OpenFlow manager that records the latency of the barriers it consumes"
+
+    def __init__(self, expected):
+        "expected: the number of barriers to wait for"
+        super(LatencyManager, self).__init__()
+        self.expected = expected
+        self.latencies = []
+        self.done = threading.Event()
+
+    def sendBarrier(self, dpid, fids=None, sent=None):
+        self.latencies.append(time.time() - sent)
+        if len(self.latencies) >= self.expected:
+            self.done.set()
+
+def make_msgs(flows, hops):
+    """Build the flowmods and barriers for installing flows
+       flows: the number of flows
+       hops: the number of switches on each flow's path"""
+    msgs = []
+    for fid in range(flows):
+        for hop in range(hops):
+            sw = Switch("s{0}".format(hop), None, hop + 1)
+            msgs.extend(_flow_msgs(OFPFC_ADD, sw, "10.0.0.1", "10.0.0.2",
+                                   1, 2))
+            msgs.append(_arp_msg(OFPFC_ADD, sw, "00:00:00:00:00:01"))
+            msgs.append(_arp_msg(OFPFC_ADD, sw, "00:00:00:00:00:02"))
+            msgs.append(BarrierMessage(sw.dpid))
+    return msgs
+
+def run(msgs, batched, workers=1):
+    """Send messages to a counting receiver and time it
+       msgs: the messages to send
+       batched: if true, send as a FlowModBatch, otherwise one at a time
+       workers: the number of receiver workers
+       returns: flowmods per second"""
+    expected = len([m for m in msgs if hasattr(m, "command")])
+    manager = CountingManager(expected)
+    receiver = MsgQueueReceiver(QueueId, manager, workers)
+    receiver.start()
+    sender = MsgQueueSender(QueueId)
+
+    start = time.time()
+    if batched:
+        sender.send(FlowModBatch(msgs))
+    else:
+        for msg in msgs:
+            sender.send(msg)
+    manager.done.wait()
+    elapsed = time.time() - start
+
+    receiver.stop()
+    receiver.t.join()
+    return expected / elapsed
+
+def bench_mq(args):
+    flows = int(args[0]) if len(args) > 0 else 1000
+    hops = int(args[1]) if len(args) > 1 else 4
+    workers = int(args[2]) if len(args) > 2 else 1
+    msgs = make_msgs(flows, hops)
+
+    print("{0} flows, {1} hops, {2} workers".format(flows, hops, workers))
+    for name, batched in [("per-message", False), ("FlowModBatch", True)]:
+        rate = run(msgs, batched, workers)
+        print("  {0:<14} {1:>12.0f} flowmods/s".format(name, rate))
+
+def bench_transport(args):
+    count = int(args[0]) if len(args) > 0 else 10000
+    transports = [
+        ("mq", lambda c: MsgQueueReceiver(QueueId, c),
+         lambda: MsgQueueSender(QueueId)),
+        ("rpc", lambda c: RpcReceiver("localhost", RpcPort, c),
+         lambda: RpcSender("localhost", RpcPort)),
+        ("shm", lambda c: ShmReceiver(ShmPath, ShmSize, SemId, c),
+         lambda: ShmSender(ShmPath, ShmSize, SemId))
+    ]
+
+    print("{0} barriers".format(count))
+    for name, receiver_factory, sender_factory in transports:
+        manager = LatencyManager(count)
+        receiver = receiver_factory(manager)
+        receiver.start()
+        sender = sender_factory()
+
+        start = time.time()
+        for i in range(count):
+            sender.send(BarrierMessage("1", [i], time.time()))
+        manager.done.wait()
+        elapsed = time.time() - start
+
+        receiver.stop()
+        receiver.t.join()
+        lat = sorted(manager.latencies)
+        print("  {0:<4} {1:>10.0f} msg/s  p50 {2:>8.1f} us  p99 {3:>8.1f} us"
+              .format(name, count / elapsed, lat[len(lat) // 2] * 1e6,
+                      lat[int(len(lat) * 0.99)] * 1e6))
+
+    if os.path.exists(ShmPath):
+        os.remove(ShmPath)
+
+def bench_codec(args):
+    count = int(args[0]) if len(args) > 0 else 100000
+    msg = make_msgs(1, 1)[0]
+    codecs = [("pickle", pickle.dumps, pickle.loads),
+              ("ravel.codec", ravel.codec.encode, ravel.codec.decode)]
+
+    print("{0} flowmods".format(count))
+    for name, encode, decode in codecs:
+        start = time.time()
+        for i in range(count):
+            data = encode(msg)
+        enc = time.time() - start
+
+        start = time.time()
+        for i in range(count):
+            decode(data)
+        dec = time.time() - start
+
+        print("  {0:<12} encode {1:>10.0f} msg/s  decode {2:>10.0f} msg/s  "
+              "{3:>4} bytes/msg".format(name, count / enc, count / dec,
+                                        len(data)))
+
+def bench_profiling(args):
+    count = int(args[0]) if len(args) > 0 else 100000
+
+    def run():
+        start = time.time()
+        for i in range(count):
+            pc = ravel.profiling.PerfCounter("bench")
+            pc.start()
+            pc.stop()
+        ravel.profiling.flush()
+        return (time.time() - start) / count
+
+    print("{0} counters".format(count))
+    ravel.profiling.disable_profiling()
+    off = run()
+    print("  {0:<4} {1:>8.3f} us/counter".format("off", off * 1e6))
+
+    pe = ravel.profiling.ProfiledExecution()
+    pe.start()
+    on = run()
+    pe.stop()
+    pe.receiver.t.join()
+    print("  {0:<4} {1:>8.3f} us/counter  {2} of {3} received".format(
+        "on", on * 1e6, len(pe.counters), count))
+
+def main():
+    benchmarks = { "mq" : bench_mq,
+                   "codec" : bench_codec,
+                   "transport" : bench_transport,
+                   "profiling" : bench_profiling }
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        print(__doc__.strip())
+        sys.exit(1)
+
+    benchmarks[sys.argv[1]](sys.argv[2:])
+
+if __name__ == "__main__":
+    main()